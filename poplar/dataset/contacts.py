@@ -1,16 +1,25 @@
+import os
 import torch
 import glob
-import math
-from torch.utils.data import Dataset, DataLoader, RandomSampler
+from torch.utils.data import Dataset, IterableDataset
+from poplar.dataset.sequences import SequenceStore
+from poplar.dataset.stream import shard, shuffle_buffer
+from poplar.util import check_random_state, to_tokens
 import numpy as np
 import pandas as pd
 
 
+# residue pairs of a packed contact map, i <= j
+CONTACT_DTYPE = np.dtype([
+    ('i', np.uint16), ('j', np.uint16), ('value', np.float32)])
+
+
 class ContactMapDataset(Dataset):
 
     def __init__(self, directory):
         self.directory = directory
-        self.files = glob.glob(f'{directory}/*.npz')
+        # sorted, so that every worker sees the files in the same order
+        self.files = sorted(glob.glob(f'{directory}/*.npz'))
 
     def __len__(self):
         return len(self.files)
@@ -21,22 +30,305 @@ class ContactMapDataset(Dataset):
         return res['sequence'], res['A_ca_10A']
 
     def __iter__(self):
-        worker_info = torch.utils.data.get_worker_info()
-        worker_id = worker_info.id
-        w = float(worker_info.num_workers)
-        start = 0
-        end = self.__len__()
-
-        if worker_info is None:  # single-process data loading
-            for i in range(end):
-                yield self.__getitem__[i]
+        """ Streams the contact maps.
+
+        When this is iterated in a dataloader, the files are split
+        across the workers and distributed ranks.
+        """
+        for i in shard(range(len(self))):
+            yield self[i]
+
+
+class ContactMapStream(IterableDataset):
+    """ Streams contact maps from a directory of npz files.
+
+    The files are split across the dataloader workers and distributed
+    ranks, and are shuffled within a bounded buffer.
+    """
+    def __init__(self, directory, buffer_size=100, shuffle=True, seed=0):
+        """
+        Parameters
+        ----------
+        directory : filepath
+            Directory of npz files.
+        buffer_size : int
+            Number of contact maps held in the shuffle buffer.
+        shuffle : bool
+            Shuffle the contact maps.
+        seed : int
+            Random seed.
+        """
+        self.dataset = ContactMapDataset(directory)
+        self.buffer_size = buffer_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        """ Sets the epoch, which determines the order of the files. """
+        self.epoch = epoch
+
+    def __iter__(self):
+        n = len(self.dataset)
+        order = range(n)
+        if self.shuffle:
+            # every shard needs to see the files in the same order
+            state = np.random.RandomState([self.seed, self.epoch])
+            order = state.permutation(n)
+        maps = (self.dataset[i] for i in shard(order))
+        if self.shuffle:
+            maps = shuffle_buffer(maps, self.buffer_size, state)
+        return iter(maps)
+
+
+def sparse_contacts(contact_map):
+    """ Converts a symmetric contact map to its nonzero upper triangle.
+
+    Parameters
+    ----------
+    contact_map : np.array
+        Dense contact map of shape (length, length).
+
+    Returns
+    -------
+    np.array of CONTACT_DTYPE
+        Residues i <= j and the value of each nonzero pair.
+    """
+    i, j = np.nonzero(np.triu(contact_map))
+    res = np.empty(len(i), dtype=CONTACT_DTYPE)
+    res['i'], res['j'] = i, j
+    res['value'] = contact_map[i, j]
+    return res
+
+
+class ContactMapStore(object):
+    """ Sparse contact maps of many proteins.
+
+    The nonzero upper triangles of all of the contact maps are
+    concatenated into a single array of `CONTACT_DTYPE` coordinates,
+    which is indexed by an array of offsets, and the sequences are
+    kept in a `poplar.dataset.sequences.SequenceStore`.
+
+    When the store is saved to disk, the contacts are opened with
+    `np.memmap`, so that dataloader workers share a single page cached
+    copy, and dense contact maps are only built for each batch,
+    see `PackedContactMapDataset.collate`.
+    """
+    def __init__(self, sequences, contacts, offsets, path=None):
+        """
+        Parameters
+        ----------
+        sequences : poplar.dataset.sequences.SequenceStore
+            Sequence of each protein.
+        contacts : np.array of CONTACT_DTYPE
+            Concatenated contacts.
+        offsets : np.array of np.int64
+            Start position of the contacts of each protein. The last
+            entry is the total number of contacts.
+        path : filepath
+            Directory that the store was loaded from (optional).
+        """
+        self.sequences = sequences
+        self.contacts = contacts
+        self.offsets = offsets
+        self.path = path
+
+    @classmethod
+    def from_directory(cls, directory, path=None, key='A_ca_10A'):
+        """ Packs a directory of npz contact maps.
+
+        Parameters
+        ----------
+        directory : filepath
+            Directory of npz files, see `ContactMapDataset`.
+        path : filepath
+            Output directory. If this is specified, the contacts are
+            streamed to disk and the store is memory mapped.
+            Otherwise, the store is held in memory.
+        key : str
+            Contact map to pack.
+
+        Returns
+        -------
+        ContactMapStore
+        """
+        dataset = ContactMapDataset(directory)
+        ids, tokens, offsets, chunks = [], [], [0], []
+        fh = None
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            fh = open(os.path.join(path, 'contacts.bin'), 'wb')
+        try:
+            for fname in dataset.files:
+                res = np.load(fname)
+                if len(res[key]) > np.iinfo(np.uint16).max:
+                    raise ValueError(f'{fname} is too long to be packed')
+                contacts = sparse_contacts(res[key])
+                ids.append(os.path.splitext(os.path.basename(fname))[0])
+                tokens.append(to_tokens(str(res['sequence'])))
+                offsets.append(offsets[-1] + len(contacts))
+                if fh is None:
+                    chunks.append(contacts)
+                else:
+                    fh.write(contacts.tobytes())
+        finally:
+            if fh is not None:
+                fh.close()
+
+        seq_offsets = np.cumsum([0] + [len(t) for t in tokens])
+        sequences = SequenceStore(
+            np.concatenate(tokens) if tokens else np.zeros(0, np.uint8),
+            seq_offsets.astype(np.int64), ids)
+        offsets = np.array(offsets, dtype=np.int64)
+        if path is None:
+            contacts = np.concatenate(chunks) if chunks else np.zeros(
+                0, dtype=CONTACT_DTYPE)
+            return cls(sequences, contacts, offsets)
+        sequences.save(os.path.join(path, 'sequences'))
+        np.save(os.path.join(path, 'offsets.npy'), offsets)
+        return cls.load(path)
+
+    @classmethod
+    def load(cls, path):
+        """ Opens a contact map store saved in `path` as a memory map. """
+        sequences = SequenceStore.load(os.path.join(path, 'sequences'))
+        offsets = np.load(os.path.join(path, 'offsets.npy'))
+        if offsets[-1] > 0:
+            contacts = np.memmap(os.path.join(path, 'contacts.bin'),
+                                 dtype=CONTACT_DTYPE, mode='r')
         else:
-            t = (end - start)
-            w = float(worker_info.num_workers)
-            per_worker = int(math.ceil(t / w))
-            worker_id = worker_info.id
-            iter_start = start + worker_id * per_worker
-            iter_end = min(iter_start + per_worker, end)
-            for i in range(iter_start, iter_end):
-                yield self.__getitem__[i]
+            contacts = np.zeros(0, dtype=CONTACT_DTYPE)
+        return cls(sequences, contacts, offsets, path=path)
+
+    def save(self, path):
+        """ Writes the contact map store to the directory `path`. """
+        os.makedirs(path, exist_ok=True)
+        self.sequences.save(os.path.join(path, 'sequences'))
+        with open(os.path.join(path, 'contacts.bin'), 'wb') as fh:
+            fh.write(np.asarray(self.contacts).tobytes())
+        np.save(os.path.join(path, 'offsets.npy'), self.offsets)
+
+    @property
+    def ids(self):
+        return self.sequences.ids
+
+    @property
+    def lengths(self):
+        """ Length of each protein. """
+        return self.sequences.lengths
+
+    def dense(self, i):
+        """ Rebuilds the dense contact map of protein `i`. """
+        n = self.sequences.lengths[i]
+        res = np.zeros((n, n), dtype=np.float32)
+        c = self[i][1]
+        res[c['i'], c['j']] = c['value']
+        res[c['j'], c['i']] = c['value']
+        return res
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        """ Retrieves the tokens and contacts of protein `i`.
+
+        Neither are copied.
+        """
+        contacts = self.contacts[self.offsets[i]:self.offsets[i + 1]]
+        return self.sequences[i], contacts
+
+    def __getstate__(self):
+        # memory mapped stores are reopened rather than copied
+        # when they are sent to dataloader workers
+        if self.path is not None:
+            return {'path': self.path}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if 'contacts' not in state:
+            state = ContactMapStore.load(state['path']).__dict__
+        self.__dict__.update(state)
+
+
+class PackedContactMapDataset(Dataset):
+    """ Contact maps from a `ContactMapStore`.
+
+    Items are the tokens and sparse contacts of each protein, and the
+    dense contact maps are only built in `collate`.
+    """
+    def __init__(self, store, crop_size=None, seed=0):
+        """
+        Parameters
+        ----------
+        store : ContactMapStore
+            Packed contact maps.
+        crop_size : int
+            Proteins that are longer than this are cropped to a random
+            window of `crop_size` residues (optional).
+        seed : int
+            Random seed of the crop windows.
+        """
+        self.store = store
+        self.crop_size = crop_size
+        self.seed = seed
+        self.reseed(seed)
+
+    def reseed(self, seed):
+        """ Restarts the stream of crop windows. """
+        self.state = check_random_state(seed)
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, i):
+        return self.store[i]
+
+    def crop(self, tokens, contacts):
+        """ Crops a protein to a random window of `crop_size` residues. """
+        n = len(tokens)
+        if self.crop_size is None or n <= self.crop_size:
+            return tokens, contacts
+        start = self.state.randint(n - self.crop_size + 1)
+        end = start + self.crop_size
+        keep = ((contacts['i'] >= start) & (contacts['j'] < end))
+        contacts = contacts[keep]
+        res = np.empty(len(contacts), dtype=CONTACT_DTYPE)
+        res['i'] = contacts['i'] - start
+        res['j'] = contacts['j'] - start
+        res['value'] = contacts['value']
+        return tokens[start:end], res
+
+    def collate(self, batch):
+        """ Builds dense contact maps for a batch of proteins.
+
+        Parameters
+        ----------
+        batch : list of tuple
+            Tokens and sparse contacts of each protein.
 
+        Returns
+        -------
+        tokens : list of np.array
+            The uint8 tokens of each protein.
+        contacts : torch.Tensor
+            Symmetric contact maps padded to the longest protein,
+            of shape (batch, length, length).
+        mask : torch.Tensor of torch.bool
+            Residues that aren't padding, of shape (batch, length).
+        """
+        batch = [self.crop(t, c) for t, c in batch]
+        tokens = [t for t, _ in batch]
+        lengths = np.array([len(t) for t in tokens], dtype=np.int64)
+        width = lengths.max() if len(lengths) > 0 else 0
+        res = torch.zeros(len(batch), width, width)
+        if len(batch) > 0:
+            b = np.repeat(np.arange(len(batch)), [len(c) for _, c in batch])
+            c = np.concatenate([c for _, c in batch])
+            b = torch.from_numpy(b)
+            i = torch.from_numpy(c['i'].astype(np.int64))
+            j = torch.from_numpy(c['j'].astype(np.int64))
+            v = torch.from_numpy(c['value'].astype(np.float32))
+            res[b, i, j] = v
+            res[b, j, i] = v
+        mask = torch.from_numpy(np.arange(width) < lengths[:, None])
+        return tokens, res, mask
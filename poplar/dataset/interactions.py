@@ -1,11 +1,18 @@
+import io
+import os
 import torch
 import glob
-import math
-from torch.utils.data import Dataset, DataLoader, RandomSampler
+import itertools
+from torch.utils.data import Dataset, IterableDataset, DataLoader
 from poplar.util import dictionary, check_random_state, encode
+from poplar.dataset.sequences import read_sequences
+from poplar.dataset.positives import PositiveIndex
+from poplar.dataset.samplers import LengthBatchSampler
+from poplar.dataset.links import (
+    SPLITS, read_links, count_links, is_binary, check_proteins)
+from poplar.dataset.stream import shard, shard_info, shuffle_buffer
 import numpy as np
 import pandas as pd
-from Bio import SeqIO
 
 
 def clean(x, threshold=1024):
@@ -16,34 +23,82 @@ def clean(x, threshold=1024):
         return x
 
 
-def preprocess(seqdict, links):
+def preprocess(store, links):
     """ Preprocesses sequences / links.
 
-    seqdict: dict of seq
+    store : poplar.dataset.sequences.SequenceStore
        Sequence lookup table
 
+    Returns
+    -------
+    pairs : np.array of np.int32
+       Rows of protein 1 and protein 2 in the sequence store.
+
     TODO: Return taxa specific information.
     """
     # 0 = protein 1
     # 1 = protein 2
-
-    pairs = links.apply(
-        lambda x: (np.array(seqdict[x[0]].seq),
-                   np.array(seqdict[x[1]].seq)),
-        axis=1)
-    pairs = np.array(list(pairs.values))
+    pairs = np.empty((len(links), 2), dtype=np.int32)
+    pairs[:, 0] = store.index(links[0].values)
+    pairs[:, 1] = store.index(links[1].values)
     return pairs
 
 
+def links_frame(store, pairs, taxa):
+    """ Table of links, with the columns of a links file that
+    `ValidationDataset` requires.
+
+    Parameters
+    ----------
+    store : poplar.dataset.sequences.SequenceStore
+        Sequence lookup table.
+    pairs : np.array
+        Sequence store rows of protein 1 and protein 2.
+    taxa : np.array
+        Taxonomy of each link.
+
+    Returns
+    -------
+    pd.DataFrame
+        The ids of protein 1 (0) and protein 2 (1) and the
+        taxonomy (3) of each link.
+    """
+    return pd.DataFrame({0: np.asarray(store.ids[pairs[:, 0]]),
+                         1: np.asarray(store.ids[pairs[:, 1]]),
+                         3: np.asarray(taxa)})
+
+
+def nbytes(dataloaders):
+    """ Estimates the memory used by the output of `parse`.
+
+    The sequences are shared across links files, so they aren't
+    counted.
+    """
+    total = 0
+    for d in dataloaders:
+        if d is None:
+            continue
+        d = getattr(d, 'dataset', d)
+        total += d.pairs.nbytes
+        links = getattr(d, 'links', None)
+        if links is not None:
+            total += int(links.memory_usage(deep=True).sum())
+    return total
+
+
 def parse(fasta_file, links_file, training_column=4,
-          batch_size=10, num_neg=10, num_workers=1, arm_the_gpu=False):
+          batch_size=10, num_neg=10, num_workers=1, arm_the_gpu=False,
+          sequences=None, sampling='uniform', reject_positives=False,
+          positives=None, max_tokens=None, seed=0,
+          multiprocessing_context=None):
     """ Reads in data and creates dataloaders.
     Parameters
     ----------
     fasta_file : filepath
         Fasta file of sequences of interest.
     link_file : filepath
-        Table of tab delimited interactions.
+        Table of tab delimited interactions, or a binary links file
+        written by `poplar.dataset.links.convert_links`.
     training_column : str
         Specifies which samples are for training and testing,
         in the links file. These must be labeled as
@@ -54,97 +109,444 @@ def parse(fasta_file, links_file, training_column=4,
         Number of workers for training (1 worker for testing).
     arm_the_gpu : bool
         Use a gpu or not.
+    sequences : poplar.dataset.sequences.SequenceStore
+        Preloaded output of `read_sequences`. If this is not
+        specified, the sequences are read from `fasta_file`.
+    sampling : str
+        Distribution of the negative samples, one of 'uniform',
+        'degree' or 'taxon'. See `NegativeSampler`.
+    reject_positives : bool
+        Redraw negatives that are known to interact with the
+        protein of interest.
+    positives : poplar.dataset.positives.PositiveIndex
+        Known interacting pairs. By default, these are the
+        links in `links_file`.
+    max_tokens : int
+        Maximum number of padded tokens of the proteins of interest
+        and of the positives of a training batch. If this is
+        specified, training pairs of similar lengths are batched
+        together, instead of batches of `batch_size` random pairs.
+        See `poplar.dataset.samplers.LengthBatchSampler`. The
+        negatives are drawn at random lengths, so they are bounded
+        where they are padded, see `poplar.model.PPIBinder`.
+    seed : int
+        Random seed of the training batches and negative samples.
+        The validation negatives don't depend on it, so that they
+        are the same across epochs.
+    multiprocessing_context : str
+        Start method of the training dataloader workers, i.e.
+        'forkserver' (optional). By default, workers are forked.
     """
-    seqs = list(SeqIO.parse(fasta_file, format='fasta'))
-    links = pd.read_table(links_file, header=None, sep='\s+')
-    train_links = links.loc[links[training_column] == 'Train']
-    test_links = links.loc[links[training_column] == 'Test']
-    valid_links = links.loc[links[training_column] == 'Validate']
-
-    # obtain sequences
-    truncseqs = list(map(clean, seqs))
-    seqids = list(map(lambda x: x.id, truncseqs))
-    seqdict = dict(zip(seqids, truncseqs))
-    # create pairs
-    train_pairs = preprocess(seqdict, train_links)
-    test_pairs = preprocess(seqdict, test_links)
-    valid_pairs = preprocess(seqdict, valid_links)
+    if sequences is None:
+        sequences = read_sequences(fasta_file)
+    links = read_links(links_file, sequences, training_column)
+    pairs = np.stack([links['protein1'], links['protein2']], axis=1)
+    pairs = pairs.astype(np.int32)
+    split = links['split']
 
-    sampler = NegativeSampler(seqs)
+    # create pairs
+    train_pairs = pairs[split == SPLITS['Train']]
+    test_pairs = pairs[split == SPLITS['Test']]
+    valid_pairs = pairs[split == SPLITS['Validate']]
+
+    sampler = NegativeSampler.from_pairs(
+        sequences, pairs, distribution=sampling,
+        taxa=links['taxonomy'], reject_positives=reject_positives,
+        positives=positives)
     train_dataloader, test_dataloader, valid_dataloader = None, None, None
 
     if len(train_pairs) > 0:
-        train_dataset = InteractionDataset(train_pairs, sampler, num_neg=num_neg)
-        train_dataloader = DataLoader(train_dataset, batch_size=batch_size,
-                                      shuffle=True, num_workers=num_workers,
-                                      drop_last=False, pin_memory=arm_the_gpu)
+        train_dataset = InteractionDataset(train_pairs, sequences,
+                                           sampler, num_neg=num_neg,
+                                           seed=seed)
+        if max_tokens is None:
+            batching = dict(batch_size=batch_size, shuffle=True,
+                            drop_last=False)
+        else:
+            lengths = sequences.lengths
+            lengths = np.maximum(lengths[train_pairs[:, 0]],
+                                 lengths[train_pairs[:, 1]])
+            batching = dict(batch_sampler=LengthBatchSampler(
+                lengths, max_tokens, seed=seed))
+        if num_workers > 0:
+            batching['multiprocessing_context'] = multiprocessing_context
+        train_dataloader = DataLoader(train_dataset, num_workers=num_workers,
+                                      pin_memory=arm_the_gpu,
+                                      collate_fn=train_dataset.collate,
+                                      worker_init_fn=worker_init_fn,
+                                      **batching)
     if len(test_pairs) > 0:
-        test_dataloader = ValidationDataset(test_pairs, test_links,
+        test_links = links_frame(
+            sequences, test_pairs, links['taxonomy'][split == SPLITS['Test']])
+        test_dataloader = ValidationDataset(test_pairs, test_links, sequences,
                                             sampler, num_neg=num_neg)
     if len(valid_pairs) > 0:
+        valid_links = links_frame(
+            sequences, valid_pairs,
+            links['taxonomy'][split == SPLITS['Validate']])
         valid_dataloader = ValidationDataset(valid_pairs, valid_links,
-                                             sampler, num_neg=num_neg)
+                                             sequences, sampler,
+                                             num_neg=num_neg)
 
     return train_dataloader, test_dataloader, valid_dataloader
 
 
+def alias_table(weights):
+    """ Builds Walker's alias table for O(1) draws from a distribution.
+
+    Parameters
+    ----------
+    weights : np.array
+        Non-negative weights of each outcome.
+
+    Returns
+    -------
+    prob : np.array of np.float64
+        Probability of keeping each outcome.
+    alias : np.array of np.int64
+        Outcome to return instead, when it isn't kept.
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    n = len(weights)
+    prob = weights * n / weights.sum()
+    alias = np.arange(n, dtype=np.int64)
+    small = list(np.where(prob < 1)[0])
+    large = list(np.where(prob >= 1)[0])
+    while small and large:
+        s, g = small.pop(), large.pop()
+        alias[s] = g
+        prob[g] = prob[g] + prob[s] - 1
+        (small if prob[g] < 1 else large).append(g)
+    # the leftovers are only off by round off error
+    prob[small + large] = 1
+    return np.minimum(prob, 1), alias
+
+
 class NegativeSampler(object):
-    """ Sampler for negative data """
-    def __init__(self, seqs):
-        self.seqs = seqs
+    """ Sampler for negative data
+
+    Negatives are drawn as rows of the sequence store, in vectorised
+    batches, from its own random stream.
+    """
+    def __init__(self, store, distribution='uniform', degrees=None,
+                 taxa=None, positives=None, power=0.75, max_tries=10,
+                 seed=0):
+        """
+        Parameters
+        ----------
+        store : poplar.dataset.sequences.SequenceStore
+            Sequences to draw from.
+        distribution : str
+            'uniform' draws every sequence with equal probability,
+            'degree' draws sequences with probability proportional to
+            their number of links to the power `power`, and 'taxon'
+            draws uniformly among the sequences from the same taxon
+            as the protein of interest.
+        degrees : np.array
+            Number of links of each row of the store (required for
+            the 'degree' distribution).
+        taxa : np.array of int
+            Taxon of each row of the store, -1 if it is unknown
+            (required for the 'taxon' distribution).
+        positives : poplar.dataset.positives.PositiveIndex or np.array
+            Known interacting pairs, or an array of their rows. If
+            these are specified, negatives that are known to interact
+            with the protein of interest are redrawn.
+        power : float
+            Exponent applied to the degrees.
+        max_tries : int
+            Maximum number of times that known positives are redrawn.
+        seed : int
+            Random seed.
+        """
+        self.store = store
+        self.n = len(store)
+        self.distribution = distribution
+        self.max_tries = max_tries
+        self.seed = seed
+        self.state = check_random_state(seed)
+        if distribution == 'degree':
+            if degrees is None:
+                raise ValueError('degrees are required to draw by degree')
+            self.prob, self.alias = alias_table(
+                np.asarray(degrees, dtype=np.float64) ** power)
+        elif distribution == 'taxon':
+            if taxa is None:
+                raise ValueError('taxa are required to draw by taxon')
+            self.taxa = np.asarray(taxa, dtype=np.int64)
+            # rows grouped by taxon, and the extent of each group
+            self.order = np.argsort(self.taxa, kind='stable')
+            self.groups, self.starts, self.counts = np.unique(
+                self.taxa[self.order], return_index=True, return_counts=True)
+        elif distribution != 'uniform':
+            raise ValueError(f'Unknown distribution {distribution}')
+        if positives is not None and not isinstance(positives,
+                                                    PositiveIndex):
+            positives = PositiveIndex.from_pairs(positives)
+        self.positives = positives
+
+    @classmethod
+    def from_pairs(cls, store, pairs, distribution='uniform', taxa=None,
+                   reject_positives=False, positives=None, **kwargs):
+        """ Creates a sampler from the links that it trains on.
 
-    def draw(self):
-        """ Draw at random. """
-        i = np.random.randint(0, len(self.seqs))
-        return self.seqs[i].seq
+        Parameters
+        ----------
+        store : poplar.dataset.sequences.SequenceStore
+            Sequences to draw from.
+        pairs : np.array
+            Rows of the interacting pairs.
+        distribution : str
+            See `NegativeSampler`.
+        taxa : np.array of int
+            Taxon of each pair (required for the 'taxon' distribution).
+        reject_positives : bool
+            Redraw negatives that are known positives.
+        positives : poplar.dataset.positives.PositiveIndex
+            Known positives to reject. By default, these are `pairs`.
+        """
+        pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+        degrees = np.bincount(pairs.ravel(), minlength=len(store))
+        row_taxa = None
+        if taxa is not None:
+            row_taxa = np.full(len(store), -1, dtype=np.int64)
+            taxa = np.asarray(taxa, dtype=np.int64)
+            row_taxa[pairs[:, 0]] = taxa
+            row_taxa[pairs[:, 1]] = taxa
+        if not reject_positives:
+            positives = None
+        elif positives is None:
+            positives = PositiveIndex.from_pairs(pairs)
+        return cls(store, distribution=distribution, degrees=degrees,
+                   taxa=row_taxa, positives=positives, **kwargs)
+
+    def _draw(self, gene, size, state):
+        if self.distribution == 'uniform':
+            return state.randint(0, self.n, size=size)
+        if self.distribution == 'degree':
+            i = state.randint(0, self.n, size=size)
+            keep = state.random_sample(size) < self.prob[i]
+            return np.where(keep, i, self.alias[i])
+        # same taxon draws, with uniform draws for unknown taxa
+        g = np.searchsorted(self.groups, self.taxa[gene])
+        g = np.minimum(g, len(self.groups) - 1)
+        known = (self.groups[g] == self.taxa[gene]) & (self.taxa[gene] >= 0)
+        offset = (state.random_sample(size) * self.counts[g]).astype(np.int64)
+        res = self.order[self.starts[g] + offset]
+        unknown = ~known
+        res[unknown] = state.randint(0, self.n, size=unknown.sum())
+        return res
+
+    def draw(self, gene=None, size=None, random_state=None):
+        """ Draws random rows of the sequence store.
+
+        Parameters
+        ----------
+        gene : int or np.array of int
+            Rows of the proteins of interest that the negatives are
+            drawn for. These are required to draw by taxon or to
+            reject known positives.
+        size : int
+            Number of rows to draw. If this is not specified, a single
+            row is drawn for each `gene`, or a single row if no `gene`
+            is specified.
+        random_state : np.random.RandomState
+            Random stream to draw from. By default, the sampler's
+            own stream is used.
+
+        Returns
+        -------
+        int or np.array of np.int64
+        """
+        scalar = size is None and (gene is None or np.ndim(gene) == 0)
+        if size is None:
+            size = 1 if gene is None else np.size(gene)
+        if gene is not None:
+            gene = np.broadcast_to(np.asarray(gene, dtype=np.int64), size)
+        elif self.distribution == 'taxon' or self.positives is not None:
+            raise ValueError('A protein of interest is required')
+        state = self.state if random_state is None else random_state
+        res = self._draw(gene, size, state)
+        if self.positives is not None:
+            for _ in range(self.max_tries):
+                bad = self.positives.contains(gene, res)
+                if not bad.any():
+                    break
+                res[bad] = self._draw(gene[bad], bad.sum(), state)
+        return int(res[0]) if scalar else res
+
+
+def worker_init_fn(worker_id):
+    """ Gives each dataloader worker its own negative sampling stream.
+
+    The seed of each worker is derived from the torch seed of the
+    dataloader, so that the draws are reproducible.
+    """
+    info = torch.utils.data.get_worker_info()
+    info.dataset.reseed(info.seed % 2 ** 32)
 
 
 class InteractionDataDirectory(Dataset):
+    """ Creates dataloaders for a directory of links files.
+
+    The fasta file is only read once, and the resulting sequence
+    table is shared across all of the links files.
 
+    If the directory was written by `poplar.dataset.links.convert_links`,
+    only its binary links files are read.
+    """
     def __init__(self, fasta_file, links_directory,
                  training_column=4, num_neg=5,
-                 batch_size=10, num_workers=1, arm_the_gpu=False):
+                 batch_size=10, num_workers=1, arm_the_gpu=False,
+                 sequence_path=None, sampling='uniform',
+                 reject_positives=False, positive_path=None,
+                 max_tokens=None, multiprocessing_context=None):
         print('links_directory', links_directory)
         self.fasta_file = fasta_file
-        self.filenames = glob.glob(f'{links_directory}/*')
+        self.sequence_path = sequence_path
+        self._sequences = None
+        self.links_directory = links_directory
+        self.filenames = sorted(glob.glob(f'{links_directory}/*.npy'))
+        self.binary = len(self.filenames) > 0
+        if not self.binary:
+            self.filenames = sorted(glob.glob(f'{links_directory}/*'))
         self.training_column = training_column
         self.batch_size = batch_size
         self.num_workers = num_workers
         self.arm_the_gpu = arm_the_gpu
         self.num_neg = num_neg
-        self.index = 0
+        self.sampling = sampling
+        self.reject_positives = reject_positives
+        self.positive_path = positive_path
+        self.max_tokens = max_tokens
+        self.multiprocessing_context = multiprocessing_context
+        self._positives = None
+        self.epoch = 0
+        self.start = 0
 
     def __len__(self):
         return len(self.filenames)
 
+    @property
+    def sequences(self):
+        """ Sequence table, read from the fasta file on first access. """
+        if self._sequences is None:
+            store = read_sequences(self.fasta_file, path=self.sequence_path)
+            if self.binary:
+                check_proteins(self.links_directory, store)
+            self._sequences = store
+        return self._sequences
+
+    @property
+    def positives(self):
+        """ Known interacting pairs across all of the links files.
+
+        The index is built on first access. If `positive_path` is
+        specified, it is saved there and memory mapped, and an
+        existing index of the same links files is reused.
+        """
+        if self._positives is None:
+            if (self.positive_path is not None
+                    and os.path.exists(self.positive_path)):
+                self._positives = PositiveIndex.load(
+                    self.positive_path, PositiveIndex.fingerprint(
+                        self.sequences, self.filenames))
+            else:
+                self._positives = PositiveIndex.from_links(
+                    self.sequences, self.filenames, path=self.positive_path)
+        return self._positives
+
+    def set_epoch(self, epoch, start=0):
+        """ Sets the position of the next pass over the directory.
+
+        Parameters
+        ----------
+        epoch : int
+            Epoch, which determines the seeds of the dataloaders.
+        start : int
+            Index of the first links file, to resume a pass.
+        """
+        self.epoch = epoch
+        self.start = start
+
     def total(self):
-        fname = self.filenames[0]
-        res = parse(self.fasta_file, fname, self.training_column,
-                    self.batch_size, self.num_neg, self.num_workers,
-                    self.arm_the_gpu)
-        # number of sequences in a dataset = (num batch) x (batch size)
-        t = len(res[0]) * res[0].batch_size
-        return t * len(self.filenames)
+        """ Number of training links across all files. The files
+        are scanned, but not parsed, see `count_links`. """
+        return sum(count_links(fname, 'Train') for fname in self.filenames)
+
+    def stream(self, chunk_size=10000, buffer_size=10000, seed=0):
+        """ Creates a dataloader that streams the training links of
+        all of the files, without holding them in memory.
+
+        Parameters
+        ----------
+        chunk_size : int
+            Number of lines per block, see `InteractionStream`.
+        buffer_size : int
+            Number of triples held in the shuffle buffer.
+        seed : int
+            Random seed.
+
+        Returns
+        -------
+        torch.utils.data.DataLoader
+            Dataloader of `InteractionStream`. Call `set_epoch` on
+            its dataset before each epoch.
+
+        Notes
+        -----
+        Only uniform negative sampling is supported, since the
+        other distributions require all of the links upfront.
+        """
+        if self.sampling != 'uniform':
+            raise ValueError('Only uniform negative sampling can be '
+                             'streamed')
+        positives = self.positives if self.reject_positives else None
+        sampler = NegativeSampler(self.sequences, positives=positives)
+        dataset = InteractionStream(
+            self.filenames, self.sequences, sampler,
+            training_column=self.training_column, num_neg=self.num_neg,
+            chunk_size=chunk_size, buffer_size=buffer_size, seed=seed)
+        context = None
+        if self.num_workers > 0:
+            context = self.multiprocessing_context
+        return DataLoader(dataset, batch_size=self.batch_size,
+                          num_workers=self.num_workers,
+                          pin_memory=self.arm_the_gpu,
+                          collate_fn=dataset.collate,
+                          multiprocessing_context=context)
 
     def __iter__(self):
+        # every pass over the directory is a new epoch, with new seeds
+        seed = self.epoch * len(self.filenames)
+        start, self.start = self.start, 0
+        self.epoch += 1
         return (
             parse(self.fasta_file, fname, self.training_column,
                   self.batch_size, self.num_neg, self.num_workers,
-                  self.arm_the_gpu)
-            for fname in self.filenames
+                  self.arm_the_gpu, sequences=self.sequences,
+                  sampling=self.sampling,
+                  reject_positives=self.reject_positives,
+                  positives=(self.positives if self.reject_positives
+                             else None),
+                  max_tokens=self.max_tokens, seed=seed + i,
+                  multiprocessing_context=self.multiprocessing_context)
+            for i, fname in enumerate(self.filenames) if i >= start
         )
 
 
 class InteractionDataset(Dataset):
     """ Dataset for training and testing. """
-    def __init__(self, pairs, sampler=None, num_neg=10, seed=0):
+    def __init__(self, pairs, store, sampler=None, num_neg=10, seed=0):
         """ Read in pairs of proteins
 
         Parameters
         ----------
-        pairs: np.array of str
-            Pairs of proteins that are experimentally validated to have
-            an interaction.
+        pairs: np.array of np.int32
+            Sequence store rows of pairs of proteins that are
+            experimentally validated to have an interaction.
+        store : poplar.dataset.sequences.SequenceStore
+            Sequence lookup table.
         sampler : poplar.sample.NegativeSampler
             Model for drawing negative samples for training
         num_neg : int
@@ -156,17 +558,37 @@ class InteractionDataset(Dataset):
             Random seed
         """
         self.pairs = pairs
+        self.store = store
         self.num_neg = num_neg
+        self.seed = seed
         self.state = check_random_state(seed)
         self.sampler = sampler
         if sampler is None:
             self.num_neg = 1
 
-    def random_peptide(self):
+    def reseed(self, seed):
+        """ Restarts the negative sampling stream. """
+        self.state = check_random_state(seed)
+
+    def random_peptide(self, gene=None, size=None, random_state=None):
+        """ Draws negatives, see `NegativeSampler.draw`. """
         if self.sampler is None:
-            raise ("No negative sampler specified")
+            raise ValueError("No negative sampler specified")
+        if random_state is None:
+            random_state = self.state
+        return self.sampler.draw(gene, size, random_state=random_state)
+
+    def sequences(self, rows):
+        """ Retrieves the tokens of a list of sequence store rows. """
+        return [self.store[i] for i in rows]
 
-        return self.sampler.draw()
+    def collate(self, batch):
+        """ Collates a batch of rows into lists of tokens.
+
+        The sequences have variable lengths, so they are kept as lists
+        of uint8 token arrays rather than being stacked.
+        """
+        return tuple(map(self.sequences, zip(*batch)))
 
     def __len__(self):
         return self.pairs.shape[0]
@@ -180,43 +602,156 @@ class InteractionDataset(Dataset):
 
         Returns
         -------
-        gene : torch.Tensor
-           Encoded representation of protein of interest
-        pos : torch.Tensor
-           Encoded representation of protein that interacts with `gene`.
-        neg : torch.Tensor
-           Encoded representation of protein that probably doesn't
+        gene : int
+           Row of protein of interest
+        pos : int
+           Row of protein that interacts with `gene`.
+        neg : int
+           Row of protein that probably doesn't
            interact with `gene`.
         """
         gene = self.pairs[i, 0]
         pos = self.pairs[i, 1]
-        neg = self.random_peptide()
-        gene = ''.join(gene)
-        pos = ''.join(pos)
-        neg = ''.join(neg)
+        neg = self.random_peptide(gene)
         return gene, pos, neg
 
+    def __getitems__(self, indices):
+        """ Retrieves a batch of triples, drawing the negatives at once. """
+        indices = np.asarray(indices)
+        gene = self.pairs[indices, 0]
+        pos = self.pairs[indices, 1]
+        neg = self.random_peptide(gene)
+        return list(zip(gene, pos, neg))
+
     def __iter__(self):
-        worker_info = torch.utils.data.get_worker_info()
-        start = 0
-        end = len(self.pairs)
-
-        if worker_info is None:  # single-process data loading
-            for i in range(end):
-                for _ in range(self.num_neg):
-                    yield self.__getitem__(i)
-        else:
-            worker_id = worker_info.id
-            w = float(worker_info.num_workers)
-            t = (end - start)
-            w = float(worker_info.num_workers)
-            per_worker = int(math.ceil(t / w))
-            worker_id = worker_info.id
-            iter_start = start + worker_id * per_worker
-            iter_end = min(iter_start + per_worker, end)
-            for i in range(iter_start, iter_end):
-                for _ in range(self.num_neg):
-                    yield self.__getitem__(i)
+        """ Streams `num_neg` triples per pair.
+
+        When this is iterated in a dataloader, the pairs are split
+        across the workers and distributed ranks.
+        """
+        for i in shard(range(len(self.pairs))):
+            gene = self.pairs[i, 0]
+            pos = self.pairs[i, 1]
+            for neg in self.random_peptide(gene, self.num_neg):
+                yield gene, pos, neg
+
+
+class InteractionStream(IterableDataset):
+    """ Streams training triples from links files on disk.
+
+    Unlike `InteractionDataset`, the pairs are never all held in
+    memory. The links files are read in blocks of lines, the blocks
+    are split across the dataloader workers and distributed ranks,
+    and the triples are shuffled within a bounded buffer.
+    """
+    def __init__(self, filenames, store, sampler=None, training_column=4,
+                 split='Train', num_neg=1, chunk_size=10000,
+                 buffer_size=10000, shuffle=True, seed=0):
+        """
+        Parameters
+        ----------
+        filenames : list of filepath
+            Tables of tab delimited interactions.
+        store : poplar.dataset.sequences.SequenceStore
+            Sequence lookup table.
+        sampler : poplar.dataset.interactions.NegativeSampler
+            Model for drawing negative samples for training.
+        training_column : int
+            Column of the links files with the split of each link.
+        split : str
+            Links to keep, i.e. 'Train'.
+        num_neg : int
+            Number of negative samples per pair.
+        chunk_size : int
+            Number of lines per block.
+        buffer_size : int
+            Number of triples held in the shuffle buffer.
+        shuffle : bool
+            Shuffle the files and the triples.
+        seed : int
+            Random seed.
+        """
+        self.filenames = list(filenames)
+        self.store = store
+        self.sampler = sampler
+        self.training_column = training_column
+        self.split = split
+        self.num_neg = num_neg if sampler is not None else 1
+        self.chunk_size = chunk_size
+        self.buffer_size = buffer_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        """ Sets the epoch, which determines the order of the triples.
+
+        Dataloader workers get a copy of the dataset, so this needs
+        to be called before every epoch.
+        """
+        self.epoch = epoch
+
+    def blocks(self):
+        """ Streams the links files in blocks.
+
+        The blocks are lists of lines for text files, and slices of
+        the memory map for binary links files.
+        """
+        filenames = self.filenames
+        if self.shuffle:
+            # every shard needs to see the files in the same order
+            state = check_random_state(self.seed + self.epoch)
+            filenames = [filenames[i]
+                         for i in state.permutation(len(filenames))]
+        for fname in filenames:
+            if is_binary(fname):
+                links = read_links(fname, self.store)
+                for i in range(0, len(links), self.chunk_size):
+                    yield links[i:i + self.chunk_size]
+                continue
+            with open(fname) as fh:
+                while True:
+                    block = list(itertools.islice(fh, self.chunk_size))
+                    if len(block) == 0:
+                        break
+                    yield block
+
+    def pairs(self, block):
+        """ Sequence store rows of the links in a block. """
+        if isinstance(block, np.ndarray):
+            block = block[block['split'] == SPLITS[self.split]]
+            return np.stack([block['protein1'], block['protein2']], axis=1)
+        links = pd.read_table(io.StringIO(''.join(block)), header=None,
+                              sep=r'\s+')
+        links = links.loc[links[self.training_column] == self.split]
+        return preprocess(self.store, links)
+
+    def triples(self, state):
+        for block in shard(self.blocks()):
+            pairs = self.pairs(block)
+            gene = np.repeat(pairs[:, 0], self.num_neg)
+            pos = np.repeat(pairs[:, 1], self.num_neg)
+            if self.sampler is None:
+                yield from zip(gene, pos)
+                continue
+            neg = self.sampler.draw(gene, random_state=state)
+            yield from zip(gene, pos, neg)
+
+    def __iter__(self):
+        shard_id, _ = shard_info()
+        state = np.random.RandomState([self.seed, self.epoch, shard_id])
+        triples = self.triples(state)
+        if self.shuffle:
+            triples = shuffle_buffer(triples, self.buffer_size, state)
+        return iter(triples)
+
+    def sequences(self, rows):
+        """ Retrieves the tokens of a list of sequence store rows. """
+        return [self.store[i] for i in rows]
+
+    def collate(self, batch):
+        """ Collates a batch of rows into lists of tokens. """
+        return tuple(map(self.sequences, zip(*batch)))
 
 
 class ValidationDataset(InteractionDataset):
@@ -232,16 +767,19 @@ class ValidationDataset(InteractionDataset):
 
     This class likely does not need multiple workers either.
     """
-    def __init__(self, pairs, links, sampler=None, num_neg=10, seed=0):
+    def __init__(self, pairs, links, store, sampler=None,
+                 num_neg=10, seed=0):
         """ Read in pairs of proteins
 
         Parameters
         ----------
-        pairs: np.array of str
-            Pairs of proteins that are experimentally validated to have
-            an interaction.
+        pairs: np.array of np.int32
+            Sequence store rows of pairs of proteins that are
+            experimentally validated to have an interaction.
         links : pd.DataFrame
             The original links dataframe
+        store : poplar.dataset.sequences.SequenceStore
+            Sequence lookup table.
         sampler : poplar.sample.NegativeSampler
             Model for drawing negative samples for training
         num_neg : int
@@ -249,12 +787,12 @@ class ValidationDataset(InteractionDataset):
         seed : int
             Random seed
         """
-        super().__init__(pairs, sampler, num_neg, seed)
+        super().__init__(pairs, store, sampler, num_neg, seed)
         # sort values by protein 1 and taxonomy
-        self.links = links.sort_values([0, 3])
+        self.links = links.reset_index(drop=True).sort_values([0, 3])
 
-        # index to keep track
-        self.links['i'] = np.arange(len(self.links))
+        # index of the pairs to keep track
+        self.links['i'] = self.links.index
 
 
     def __getitem__(self, i):
@@ -262,12 +800,12 @@ class ValidationDataset(InteractionDataset):
 
         Returns
         -------
-        gene : str
-            Protein of interest
-        pos : str
-            Positive interacting protein
-        rnd : str
-            Random protein
+        gene : int
+            Row of protein of interest
+        pos : int
+            Row of positive interacting protein
+        rnd : int
+            Row of random protein
         protid : str
             ID of protein 1
         taxa : str
@@ -280,13 +818,11 @@ class ValidationDataset(InteractionDataset):
         """
         gene = self.pairs[i, 0]
         pos = self.pairs[i, 1]
-        rnd = self.random_peptide()
+        rnd = self.random_peptide(gene)
         protid = self.links.loc[i, 0]
         taxa = self.links.loc[i, 3]
 
-        return (
-            ''.join(gene), ''.join(pos), ''.join(rnd), protid, taxa
-        )
+        return gene, pos, rnd, protid, taxa
 
     def __len__(self):
         """
@@ -302,27 +838,35 @@ class ValidationDataset(InteractionDataset):
 
         Returns
         -------
-        gene : str
-            Protein of interest
-        pos : str
-            Positive interacting protein
-        rnd : str
-            Random protein
+        gene : int
+            Row of protein of interest
+        pos : int
+            Row of positive interacting protein
+        rnd : int
+            Row of random protein
         taxa : str
             ID of taxa
         protid : str
             ID of protein 1
+        link : int
+            Index of the positive link, which is shared by all of its
+            negative draws.
 
         Notes
         -----
         0 : protein 1 id
         3 : taxonomy id
+
+        The negatives are drawn from a stream that restarts on every
+        pass, so that every evaluation sees the same negatives.
         """
+        state = check_random_state(self.seed)
         for idx, group in self.links.groupby([3, 0]):
             tax, protid = idx
             for i in group['i']:
                 gene = self.pairs[i, 0]
                 pos = self.pairs[i, 1]
-                for _ in range(self.num_neg):
-                    rnd = self.random_peptide()
-                    yield gene, pos, rnd, tax, protid
+                rnds = self.random_peptide(gene, self.num_neg,
+                                           random_state=state)
+                for rnd in rnds:
+                    yield gene, pos, rnd, tax, protid, i
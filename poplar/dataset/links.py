@@ -0,0 +1,180 @@
+import os
+import re
+import hashlib
+import numpy as np
+import pandas as pd
+
+
+# codes of the values of the training column
+SPLITS = {'Train': 0, 'Test': 1, 'Validate': 2}
+UNKNOWN_SPLIT = 255
+
+# columns of a binary links file
+LINK_DTYPE = np.dtype([
+    ('protein1', np.int32), ('protein2', np.int32),
+    ('taxonomy', np.int64), ('split', np.uint8)])
+
+# dictionary of the protein ids of a binary links directory
+PROTEINS_FILE = 'proteins.txt'
+
+
+def count_lines(filename, chunk_size=1 << 20):
+    """ Counts the number of lines in a file without parsing it. """
+    n = 0
+    with open(filename, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b''):
+            n += chunk.count(b'\n')
+    return n
+
+
+def count_field(filename, value, chunk_size=1 << 20):
+    """ Counts the lines of a whitespace delimited file with a field
+    equal to `value`, by scanning its bytes without parsing it. """
+    pattern = re.compile(rb'(?<!\S)' + re.escape(value.encode())
+                         + rb'(?!\S)')
+    n, rest = 0, b''
+    with open(filename, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b''):
+            # only whole lines are scanned
+            chunk = rest + chunk
+            end = chunk.rfind(b'\n') + 1
+            chunk, rest = chunk[:end], chunk[end:]
+            n += len(pattern.findall(chunk))
+    return n + len(pattern.findall(rest))
+
+
+def count_links(links_file, split=None):
+    """ Counts the number of links in a text or binary links file,
+    without parsing it.
+
+    Parameters
+    ----------
+    links_file : filepath
+        Table of tab delimited interactions, or a binary links file.
+    split : str
+        Only count the links of this split, i.e. 'Train' (optional).
+        In text files, these are the lines with a 'Train' field.
+    """
+    if is_binary(links_file):
+        links = np.load(links_file, mmap_mode='r')
+        if split is None:
+            return len(links)
+        return int(np.count_nonzero(links['split'] == SPLITS[split]))
+    if split is None:
+        return count_lines(links_file)
+    return count_field(links_file, split)
+
+
+def encode_split(values):
+    """ Converts 'Train', 'Test' and 'Validate' labels to uint8 codes. """
+    codes = pd.Series(values).map(SPLITS).fillna(UNKNOWN_SPLIT)
+    return codes.values.astype(np.uint8)
+
+
+def is_binary(links_file):
+    """ Whether a links file is in the binary format. """
+    return str(links_file).endswith('.npy')
+
+
+def _encode(store, links, training_column):
+    res = np.empty(len(links), dtype=LINK_DTYPE)
+    res['protein1'] = store.index(links[0].values)
+    res['protein2'] = store.index(links[1].values)
+    res['taxonomy'] = links[3].values
+    res['split'] = encode_split(links[training_column].values)
+    return res
+
+
+def read_links(links_file, store, training_column=4):
+    """ Reads a links file into a columnar array.
+
+    Parameters
+    ----------
+    links_file : filepath
+        Table of tab delimited interactions, or a binary links
+        file written by `convert_links`, which is memory mapped.
+    store : poplar.dataset.sequences.SequenceStore
+        Sequence lookup table.
+    training_column : int
+        Column with the 'Train', 'Test' and 'Validate' labels
+        of the links (text files only).
+
+    Returns
+    -------
+    np.array of LINK_DTYPE
+        The rows of protein 1 and protein 2 in the sequence store,
+        the taxonomy and the split code of each link.
+    """
+    if is_binary(links_file):
+        return np.load(links_file, mmap_mode='r')
+    links = pd.read_table(links_file, header=None, sep=r'\s+')
+    return _encode(store, links, training_column)
+
+
+def proteins_hash(ids):
+    """ Hash of the protein ids of a sequence store. """
+    return hashlib.sha1('\n'.join(ids).encode()).hexdigest()
+
+
+def check_proteins(links_directory, store):
+    """ Checks that binary links refer to the rows of `store`.
+
+    Raises
+    ------
+    ValueError
+        If the links were converted with a different sequence store.
+    """
+    with open(os.path.join(links_directory, PROTEINS_FILE)) as fh:
+        ids = fh.read().split('\n')
+    if proteins_hash(ids) != proteins_hash(store.ids):
+        raise ValueError(f'The links in {links_directory} were converted '
+                         'with a different fasta file')
+
+
+def convert_links(links_files, store, output_directory, training_column=4,
+                  chunk_size=1000000):
+    """ Converts links files to the binary format.
+
+    Each links file is written to a `.npy` file of `LINK_DTYPE`, in
+    which proteins are encoded by their rows in the sequence store,
+    and the ids of the sequence store are written to `proteins.txt`.
+
+    Parameters
+    ----------
+    links_files : list of filepath
+        Tables of tab delimited interactions.
+    store : poplar.dataset.sequences.SequenceStore
+        Sequence lookup table.
+    output_directory : filepath
+        Output directory, which can be read with
+        `poplar.dataset.interactions.InteractionDataDirectory`.
+    training_column : int
+        Column with the 'Train', 'Test' and 'Validate' labels.
+    chunk_size : int
+        Number of links read at once.
+
+    Returns
+    -------
+    list of filepath
+        The binary links files.
+    """
+    os.makedirs(output_directory, exist_ok=True)
+    outputs = []
+    for fname in links_files:
+        chunks = [
+            _encode(store, links, training_column)
+            for links in pd.read_table(fname, header=None, sep=r'\s+',
+                                       chunksize=chunk_size)
+        ]
+        res = np.concatenate(chunks) if chunks else np.zeros(
+            0, dtype=LINK_DTYPE)
+        name = os.path.splitext(os.path.basename(fname))[0]
+        output = os.path.join(output_directory, f'{name}.npy')
+        # written atomically, so that partial files are never read
+        with open(output + '.tmp', 'wb') as fh:
+            np.save(fh, res)
+        os.replace(output + '.tmp', output)
+        outputs.append(output)
+    with open(os.path.join(output_directory, PROTEINS_FILE), 'w') as fh:
+        fh.write('\n'.join(store.ids))
+    return outputs
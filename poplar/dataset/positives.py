@@ -0,0 +1,164 @@
+import os
+import numpy as np
+import pandas as pd
+from poplar.dataset.links import is_binary, read_links
+from poplar.dataset.sequences import file_fingerprint, read_fingerprint
+
+
+def pack_pairs(a, b):
+    """ Packs pairs of sequence store rows into uint64 keys.
+
+    The pairs are unordered, so (a, b) and (b, a) get the same key.
+    """
+    a = np.asarray(a, dtype=np.uint64)
+    b = np.asarray(b, dtype=np.uint64)
+    lo, hi = np.minimum(a, b), np.maximum(a, b)
+    return (lo << np.uint64(32)) | hi
+
+
+class PositiveIndex(object):
+    """ Set of known interacting pairs.
+
+    The pairs are stored as a sorted array of packed uint64 keys, which
+    are looked up with `np.searchsorted`, so an index over all of the
+    links files takes 8 bytes per link and whole batches of pairs can
+    be checked in one call.
+
+    When the index is saved to disk, it is opened with `np.memmap`,
+    so that multiple dataloader workers can share a single page cached
+    copy of the keys.
+    """
+    def __init__(self, keys, path=None):
+        """
+        Parameters
+        ----------
+        keys : np.array of np.uint64
+            Sorted, unique keys of the pairs, see `pack_pairs`.
+        path : filepath
+            File that the index was loaded from (optional).
+        """
+        self.keys = keys
+        self.path = path
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        """ Builds an index from an array of sequence store rows. """
+        pairs = np.asarray(pairs).reshape(-1, 2)
+        return cls(np.unique(pack_pairs(pairs[:, 0], pairs[:, 1])))
+
+    @staticmethod
+    def fingerprint(store, filenames):
+        """ Fingerprint of the links files and the sequence store that
+        an index is built from, see
+        `poplar.dataset.sequences.file_fingerprint`. """
+        return file_fingerprint(filenames, store.fingerprint)
+
+    @classmethod
+    def from_links(cls, store, filenames, chunk_size=1000000, path=None):
+        """ Builds an index from links files.
+
+        Parameters
+        ----------
+        store : poplar.dataset.sequences.SequenceStore
+            Sequence lookup table.
+        filenames : list of filepath
+            Tables of tab delimited interactions, or binary links
+            files, see `poplar.dataset.links.convert_links`.
+        chunk_size : int
+            Number of links read at once.
+        path : filepath
+            Output file. If this is specified, the index is saved
+            there and memory mapped, along with the fingerprint of
+            the links files and the sequence store.
+
+        Returns
+        -------
+        PositiveIndex
+        """
+        keys = []
+        for fname in filenames:
+            if is_binary(fname):
+                links = read_links(fname, store)
+                keys.append(np.unique(pack_pairs(links['protein1'],
+                                                 links['protein2'])))
+                continue
+            for links in pd.read_table(fname, header=None, sep=r'\s+',
+                                       usecols=[0, 1], chunksize=chunk_size):
+                keys.append(np.unique(pack_pairs(
+                    store.index(links[0].values),
+                    store.index(links[1].values))))
+        keys = np.unique(np.concatenate(keys)) if keys else np.zeros(
+            0, dtype=np.uint64)
+        index = cls(keys)
+        if path is None:
+            return index
+        index.save(path)
+        with open(path + '.source', 'w') as fh:
+            fh.write(cls.fingerprint(store, filenames))
+        return cls.load(path)
+
+    @classmethod
+    def load(cls, path, fingerprint=None):
+        """ Opens an index saved in `path` as a memory map.
+
+        Parameters
+        ----------
+        path : filepath
+            File of the index.
+        fingerprint : str
+            Fingerprint of the links files and the sequence store
+            that the index is expected to be built from, see
+            `PositiveIndex.fingerprint` (optional).
+
+        Raises
+        ------
+        ValueError
+            If the index was built from other links files or another
+            sequence store.
+        """
+        if (fingerprint is not None
+                and read_fingerprint(path + '.source') != fingerprint):
+            raise ValueError(f'The index in {path} was built from other '
+                             'links files or another fasta file. '
+                             'Remove it to rebuild it.')
+        return cls(np.load(path, mmap_mode='r'), path=path)
+
+    def save(self, path):
+        """ Writes the index to `path`. """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'wb') as fh:
+            np.save(fh, np.asarray(self.keys))
+
+    def contains(self, a, b):
+        """ Checks which pairs of rows are known to interact.
+
+        Parameters
+        ----------
+        a, b : np.array of int
+            Sequence store rows of the pairs.
+
+        Returns
+        -------
+        np.array of bool
+        """
+        keys = pack_pairs(a, b)
+        if len(self.keys) == 0:
+            return np.zeros(keys.shape, dtype=bool)
+        i = np.searchsorted(self.keys, keys)
+        i = np.minimum(i, len(self.keys) - 1)
+        return self.keys[i] == keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getstate__(self):
+        # memory mapped indexes are reopened rather than copied
+        # when they are sent to dataloader workers
+        if self.path is not None:
+            return {'path': self.path}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if 'keys' not in state:
+            state = PositiveIndex.load(state['path']).__dict__
+        self.__dict__.update(state)
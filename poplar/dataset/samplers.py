@@ -0,0 +1,91 @@
+import numpy as np
+from torch.utils.data import Sampler
+from poplar.util import check_random_state
+
+
+class LengthBatchSampler(Sampler):
+    """ Batches items of similar lengths under a token budget.
+
+    Every epoch, the items are shuffled and split into pools of
+    `pool_size` items. Each pool is sorted by length and cut into
+    batches whose padded size, i.e. the number of items times the
+    longest item, stays under `max_tokens`. The order of the batches
+    is then shuffled, so the batches change from epoch to epoch while
+    each of them only holds items of similar lengths.
+    """
+    def __init__(self, lengths, max_tokens, max_batch_size=None,
+                 pool_size=10000, shuffle=True, seed=0):
+        """
+        Parameters
+        ----------
+        lengths : np.array of int
+            Length of each item. For protein pairs, this is the length
+            of the longest protein.
+        max_tokens : int
+            Maximum number of padded tokens per batch. Items that are
+            longer than this get a batch of their own.
+        max_batch_size : int
+            Maximum number of items per batch (optional).
+        pool_size : int
+            Number of items that are sorted by length together.
+            Larger pools give less padding, but less random batches.
+        shuffle : bool
+            Shuffle the items. Otherwise, the items are batched
+            in order.
+        seed : int
+            Random seed. The items are shuffled differently for
+            every epoch.
+        """
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.pool_size = pool_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self._cache = None
+
+    def set_epoch(self, epoch):
+        """ Sets the epoch, which determines the order of the items. """
+        self.epoch = epoch
+
+    def _split(self, idx):
+        """ Greedily cuts items sorted by length into batches. """
+        batches, start, width = [], 0, 0
+        for end, n in enumerate(self.lengths[idx]):
+            width = max(width, n)
+            size = end - start + 1
+            full = (self.max_batch_size is not None
+                    and size > self.max_batch_size)
+            if size > 1 and (size * width > self.max_tokens or full):
+                batches.append(idx[start:end])
+                start, width = end, n
+        if start < len(idx):
+            batches.append(idx[start:])
+        return batches
+
+    def batches(self):
+        """ Batches of item indices for the current epoch. """
+        if self._cache is not None and self._cache[0] == self.epoch:
+            return self._cache[1]
+        state = check_random_state(self.seed + self.epoch)
+        n = len(self.lengths)
+        order = state.permutation(n) if self.shuffle else np.arange(n)
+        batches = []
+        for i in range(0, n, self.pool_size):
+            pool = order[i:i + self.pool_size]
+            pool = pool[np.argsort(self.lengths[pool], kind='stable')]
+            batches += self._split(pool)
+        if self.shuffle:
+            batches = [batches[i] for i in state.permutation(len(batches))]
+        batches = [b.tolist() for b in batches]
+        self._cache = (self.epoch, batches)
+        return batches
+
+    def __iter__(self):
+        batches = self.batches()
+        self.epoch += 1
+        return iter(batches)
+
+    def __len__(self):
+        return len(self.batches())
@@ -0,0 +1,237 @@
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+from poplar.util import dictionary, to_tokens
+
+
+# token -> byte lookup table
+_reverse = np.zeros(256, dtype=np.uint8)
+for _k, _v in dictionary.items():
+    _reverse[_v] = ord(_k)
+
+
+# fingerprint of the files that an on-disk store was built from
+SOURCE_FILE = 'source.txt'
+
+
+def file_fingerprint(filenames, *params):
+    """ Fingerprint of input files and the parameters they were
+    read with, from the names, sizes and modification times of the
+    files, without reading them. """
+    h = hashlib.sha1()
+    for fname in filenames:
+        stat = os.stat(fname)
+        h.update(f'{os.path.basename(fname)}\t{stat.st_size}\t'
+                 f'{stat.st_mtime_ns}\n'.encode())
+    for p in params:
+        h.update(f'{p}\n'.encode())
+    return h.hexdigest()
+
+
+def read_fingerprint(fname):
+    """ Reads a fingerprint written next to an on-disk store, or None. """
+    if not os.path.exists(fname):
+        return None
+    with open(fname) as fh:
+        return fh.read().strip()
+
+
+def decode(tokens):
+    """ Converts uint8 tokens back to a sequence string. """
+    return _reverse[np.asarray(tokens)].tobytes().decode('ascii')
+
+
+class SequenceStore(object):
+    """ Integer encoded protein sequences.
+
+    All of the sequences are concatenated into a single flat uint8
+    buffer of `poplar.util.dictionary` codes, which is indexed by
+    an array of offsets and a hashed lookup table of sequence ids.
+
+    When the store is saved to disk, the token buffer is opened with
+    `np.memmap`, so that multiple dataloader workers can share a
+    single page cached copy of the sequences.
+    """
+    def __init__(self, tokens, offsets, ids, path=None, fingerprint=None):
+        """
+        Parameters
+        ----------
+        tokens : np.array of np.uint8
+            Concatenated sequence tokens.
+        offsets : np.array of np.int64
+            Start position of each sequence in `tokens`. The last entry
+            is the total number of tokens.
+        ids : list of str
+            Sequence ids.
+        path : filepath
+            Directory that the store was loaded from (optional).
+        fingerprint : str
+            Fingerprint of the fasta file that the store was built
+            from, see `file_fingerprint` (optional).
+        """
+        self.tokens = tokens
+        self.offsets = offsets
+        self.ids = pd.Index(ids)
+        self.path = path
+        self.fingerprint = fingerprint
+        # like a dict, duplicated ids refer to their last occurrence
+        unique = ~self.ids.duplicated(keep='last')
+        self._index = self.ids[unique]
+        self._rows = np.arange(len(self.ids))[unique]
+
+    @classmethod
+    def from_fasta(cls, fasta_file, path=None, threshold=1024):
+        """ Builds a sequence store from a fasta file.
+
+        Parameters
+        ----------
+        fasta_file : filepath
+            Fasta file of sequences of interest.
+        path : filepath
+            Output directory. If this is specified, the tokens are
+            streamed to disk and the store is memory mapped.
+            Otherwise, the store is held in memory.
+        threshold : int
+            Maximum sequence length.
+
+        Returns
+        -------
+        SequenceStore
+        """
+        from Bio import SeqIO
+        fingerprint = file_fingerprint([fasta_file], threshold)
+        ids, offsets = [], [0]
+        if path is None:
+            chunks = []
+            for record in SeqIO.parse(fasta_file, format='fasta'):
+                tokens = to_tokens(record.seq[:threshold])
+                chunks.append(tokens)
+                ids.append(record.id)
+                offsets.append(offsets[-1] + len(tokens))
+            tokens = np.concatenate(chunks) if chunks else np.zeros(
+                0, dtype=np.uint8)
+            return cls(tokens, np.array(offsets, dtype=np.int64), ids,
+                       fingerprint=fingerprint)
+
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'tokens.bin'), 'wb') as fh:
+            for record in SeqIO.parse(fasta_file, format='fasta'):
+                tokens = to_tokens(record.seq[:threshold])
+                fh.write(tokens.tobytes())
+                ids.append(record.id)
+                offsets.append(offsets[-1] + len(tokens))
+        np.save(os.path.join(path, 'offsets.npy'),
+                np.array(offsets, dtype=np.int64))
+        with open(os.path.join(path, SOURCE_FILE), 'w') as fh:
+            fh.write(fingerprint)
+        with open(os.path.join(path, 'ids.txt'), 'w') as fh:
+            fh.write('\n'.join(ids))
+        return cls.load(path)
+
+    @classmethod
+    def load(cls, path):
+        """ Opens a sequence store saved in `path` as a memory map. """
+        offsets = np.load(os.path.join(path, 'offsets.npy'))
+        if offsets[-1] > 0:
+            tokens = np.memmap(os.path.join(path, 'tokens.bin'),
+                               dtype=np.uint8, mode='r')
+        else:
+            tokens = np.zeros(0, dtype=np.uint8)
+        with open(os.path.join(path, 'ids.txt')) as fh:
+            ids = fh.read().split('\n')
+        if len(offsets) == 1:
+            ids = []
+        fingerprint = read_fingerprint(os.path.join(path, SOURCE_FILE))
+        return cls(tokens, offsets, ids, path=path, fingerprint=fingerprint)
+
+    def save(self, path):
+        """ Writes the sequence store to the directory `path`. """
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'tokens.bin'), 'wb') as fh:
+            fh.write(np.asarray(self.tokens).tobytes())
+        np.save(os.path.join(path, 'offsets.npy'), self.offsets)
+        with open(os.path.join(path, 'ids.txt'), 'w') as fh:
+            fh.write('\n'.join(self.ids))
+        if self.fingerprint is not None:
+            with open(os.path.join(path, SOURCE_FILE), 'w') as fh:
+                fh.write(self.fingerprint)
+
+    @property
+    def lengths(self):
+        """ Length of each sequence. """
+        return np.diff(self.offsets)
+
+    def index(self, ids):
+        """ Looks up the rows of a list of sequence ids.
+
+        Raises
+        ------
+        KeyError
+            If any of the ids are not in the store.
+        """
+        idx = self._index.get_indexer(ids)
+        if (idx < 0).any():
+            missing = np.asarray(ids)[idx < 0]
+            raise KeyError(f'{len(missing)} ids not found, '
+                           f'e.g. {missing[0]}')
+        return self._rows[idx]
+
+    def decode(self, i):
+        """ Retrieves the sequence string of row `i`. """
+        return decode(self[i])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        """ Retrieves the tokens of row `i` without copying. """
+        return self.tokens[self.offsets[i]:self.offsets[i + 1]]
+
+    def __getstate__(self):
+        # memory mapped stores are reopened rather than copied
+        # when they are sent to dataloader workers
+        if self.path is not None:
+            return {'path': self.path}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if 'tokens' not in state:
+            state = SequenceStore.load(state['path']).__dict__
+        self.__dict__.update(state)
+
+
+def read_sequences(fasta_file, threshold=1024, path=None):
+    """ Reads in and truncates sequences.
+
+    Parameters
+    ----------
+    fasta_file : filepath
+        Fasta file of sequences of interest.
+    threshold : int
+        Maximum sequence length.
+    path : filepath
+        Directory of an on-disk sequence store (optional). If the
+        store already exists, it is memory mapped instead of
+        reading the fasta file. Otherwise, it is built there.
+
+    Returns
+    -------
+    store : poplar.dataset.sequences.SequenceStore
+        Integer encoded sequence lookup table.
+
+    Raises
+    ------
+    ValueError
+        If the existing store was built from a different fasta file,
+        or with a different threshold.
+    """
+    if path is not None and os.path.exists(os.path.join(path, 'ids.txt')):
+        store = SequenceStore.load(path)
+        if store.fingerprint != file_fingerprint([fasta_file], threshold):
+            raise ValueError(f'The sequence store in {path} was built from '
+                             f'a different fasta file than {fasta_file}. '
+                             'Remove it to rebuild it.')
+        return store
+    return SequenceStore.from_fasta(fasta_file, path=path,
+                                    threshold=threshold)
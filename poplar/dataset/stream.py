@@ -0,0 +1,224 @@
+import queue
+import threading
+import itertools
+from poplar.util import check_random_state
+
+
+def shard_info():
+    """ Position of this process among all of the data loading processes.
+
+    The data is split across the dataloader workers of every
+    distributed rank.
+
+    Returns
+    -------
+    shard : int
+        Index of this process.
+    num_shards : int
+        Total number of processes.
+    """
+    import torch
+    import torch.distributed as dist
+    rank, world_size = 0, 1
+    if dist.is_available() and dist.is_initialized():
+        rank, world_size = dist.get_rank(), dist.get_world_size()
+    worker_id, num_workers = 0, 1
+    worker_info = torch.utils.data.get_worker_info()
+    if worker_info is not None:
+        worker_id, num_workers = worker_info.id, worker_info.num_workers
+    return rank * num_workers + worker_id, world_size * num_workers
+
+
+def shard(iterable, shard=None, num_shards=None):
+    """ Keeps every `num_shards`-th item of a stream.
+
+    Parameters
+    ----------
+    iterable : iterable
+        Items to split up.
+    shard : int
+        Index of the shard to keep. By default, this is the shard of
+        the current dataloader worker and distributed rank.
+    num_shards : int
+        Total number of shards.
+
+    Returns
+    -------
+    iterable
+        Items `shard`, `shard + num_shards`, ...
+    """
+    if shard is None:
+        shard, num_shards = shard_info()
+    return itertools.islice(iterable, shard, None, num_shards)
+
+
+def shuffle_buffer(iterable, buffer_size, random_state=None):
+    """ Approximately shuffles a stream with a bounded amount of memory.
+
+    The items are held in a buffer of `buffer_size` items, and each new
+    item replaces a random item of the buffer, which is emitted.
+
+    Parameters
+    ----------
+    iterable : iterable
+        Items to shuffle.
+    buffer_size : int
+        Number of items held in memory.
+    random_state : int or np.random.RandomState
+        Random seed.
+
+    Returns
+    -------
+    iterable
+        The shuffled items.
+    """
+    if buffer_size <= 1:
+        yield from iterable
+        return
+    state = check_random_state(random_state)
+    buffer = []
+    for item in iterable:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        i = state.randint(buffer_size)
+        buffer[i], item = item, buffer[i]
+        yield item
+    for i in state.permutation(len(buffer)):
+        yield buffer[i]
+
+
+class Gate(object):
+    """ Holds back the background thread of `prefetch`.
+
+    Forking a process while another thread holds a lock, i.e. in
+    pandas, numpy or malloc, can deadlock the child. The gate is
+    closed before each item is handed out, so the next items aren't
+    prepared while the consumer forks, i.e. starts the workers of a
+    dataloader, until it opens the gate again.
+    """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.is_open = True
+        self.busy = False
+
+    def open(self):
+        """ Lets the thread prepare the next items. """
+        with self.cond:
+            self.is_open = True
+            self.cond.notify_all()
+
+    def close(self):
+        """ Holds the thread back, once it is done with the item
+        that it is preparing. """
+        with self.cond:
+            self.is_open = False
+            self.cond.wait_for(lambda: not self.busy)
+
+
+def prefetch(iterable, depth=1, max_bytes=None, nbytes=None, gate=None):
+    """ Prepares the next items of a stream in a background thread.
+
+    This overlaps slow I/O, like parsing links files, with the work
+    done on the current item.
+
+    Parameters
+    ----------
+    iterable : iterable
+        Items to prepare.
+    depth : int
+        Maximum number of items prepared ahead of the current one.
+        If this is zero, the items are prepared in the foreground.
+    max_bytes : int
+        Maximum size of the items prepared ahead (optional). The size
+        of an item is only known once it is prepared, so an item that
+        doesn't fit is held back until the items ahead of it are
+        consumed. An item is always let through if nothing else is
+        held, even if it is larger than this.
+    nbytes : callable
+        Estimates the size of an item in bytes. This is required to
+        use `max_bytes`.
+    gate : Gate
+        Gate that is closed before each item is handed out (optional).
+        The next items are only prepared once it is opened again.
+        With a `depth` of one, the thread is always idle by then,
+        otherwise the item that it is preparing is finished first.
+
+    Returns
+    -------
+    iterable
+        The items, in order.
+    """
+    if depth <= 0:
+        yield from iterable
+        return
+
+    items = queue.Queue()
+    gated = gate is not None
+    if not gated:
+        gate = Gate()
+    cond = gate.cond
+    held = {'count': 0, 'bytes': 0}
+    stop = threading.Event()
+    done = object()
+
+    def has_room(size):
+        if held['count'] == 0:
+            return True
+        return max_bytes is None or held['bytes'] + size <= max_bytes
+
+    def produce():
+        try:
+            iterator = iter(iterable)
+            while True:
+                # wait for a free slot before preparing the next item
+                with cond:
+                    cond.wait_for(
+                        lambda: stop.is_set() or (held['count'] < depth
+                                                  and gate.is_open))
+                    if stop.is_set():
+                        return
+                    gate.busy = True
+                try:
+                    item = next(iterator)
+                    size = nbytes(item) if nbytes is not None else 0
+                except StopIteration:
+                    break
+                finally:
+                    with cond:
+                        gate.busy = False
+                        cond.notify_all()
+                with cond:
+                    cond.wait_for(lambda: stop.is_set() or has_room(size))
+                    if stop.is_set():
+                        return
+                    held['count'] += 1
+                    held['bytes'] += size
+                items.put((item, size, None))
+        except Exception as e:
+            items.put((done, 0, e))
+            return
+        items.put((done, 0, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, size, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            # closed before the slot is freed, so that the thread
+            # doesn't start on the next item
+            if gated:
+                gate.close()
+            with cond:
+                held['count'] -= 1
+                held['bytes'] -= size
+                cond.notify_all()
+            yield item
+    finally:
+        with cond:
+            stop.set()
+            cond.notify_all()
@@ -1,9 +1,18 @@
+import os
+import pickle
+import shutil
+import tempfile
 import unittest
+import torch
 import numpy as np
+import numpy.testing as npt
 from poplar.util import get_data_path
 import pandas as pd
 from Bio import SeqIO
-from poplar.dataset import ContactMapDataset
+from torch.utils.data import DataLoader
+from poplar.dataset.contacts import (
+    ContactMapDataset, ContactMapStream, ContactMapStore,
+    PackedContactMapDataset, sparse_contacts)
 
 
 class TestContactMapDataset(unittest.TestCase):
@@ -13,9 +22,9 @@ class TestContactMapDataset(unittest.TestCase):
 
     def test_constructor(self):
         ds = ContactMapDataset(self.directory)
-        res_files = ['data/102L-A.npz', 'data/108L-A.npz',
-                     'data/104L-A.npz', 'data/103L-A.npz',
-                     'data/101M-A.npz', 'data/107L-A.npz',
+        res_files = ['data/101M-A.npz', 'data/102L-A.npz',
+                     'data/103L-A.npz', 'data/104L-A.npz',
+                     'data/107L-A.npz', 'data/108L-A.npz',
                      'data/109L-A.npz']
         self.assertListEqual(ds.files, res_files)
 
@@ -29,9 +38,116 @@ class TestContactMapDataset(unittest.TestCase):
                    'PLAQSHATKHKIPIKYLEFISEAIIHVLHSRHPGNFGADAQGAM'
                    'NKALELFRKDIAAKYKELGYQG')
         ds = ContactMapDataset(self.directory)
-        res_seq, res_cm = ds[4]
+        res_seq, res_cm = ds[0]
         self.assertEqual(exp_seq, res_seq)
         self.assertEqual((154, 154), res_cm.shape)
 
+    def test_iter(self):
+        ds = ContactMapDataset(self.directory)
+        res = [seq for seq, _ in ds]
+        self.assertListEqual(res, [ds[i][0] for i in range(7)])
+
+
+class TestContactMapStream(unittest.TestCase):
+
+    def test_iter(self):
+        ds = ContactMapStream('data', buffer_size=3, seed=0)
+        exp = sorted(str(s) for s, _ in ContactMapDataset('data'))
+        first = [str(s) for s, _ in ds]
+        self.assertListEqual(sorted(first), exp)
+        ds.set_epoch(1)
+        self.assertNotEqual([str(s) for s, _ in ds], first)
+
+    def test_workers(self):
+        ds = ContactMapStream('data', buffer_size=3, seed=0)
+        dl = DataLoader(ds, batch_size=None, num_workers=2)
+        res = sorted(str(s) for s, _ in dl)
+        exp = sorted(str(s) for s, _ in ContactMapDataset('data'))
+        self.assertListEqual(res, exp)
+
+
+class TestContactMapStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.ds = ContactMapDataset('data')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_sparse_contacts(self):
+        a = np.array([[1., 0.5, 0.],
+                      [0.5, 0., 0.25],
+                      [0., 0.25, 1.]])
+        res = sparse_contacts(a)
+        npt.assert_array_equal(res['i'], [0, 0, 1, 2])
+        npt.assert_array_equal(res['j'], [0, 1, 2, 2])
+        npt.assert_allclose(res['value'], [1., 0.5, 0.25, 1.])
+
+    def check(self, store):
+        self.assertEqual(len(store), 7)
+        self.assertEqual(store.ids[0], '101M-A')
+        for i in range(len(self.ds)):
+            seq, exp = self.ds[i]
+            self.assertEqual(store.sequences.decode(i), str(seq))
+            npt.assert_allclose(store.dense(i), exp, rtol=1e-6)
+
+    def test_from_directory(self):
+        self.check(ContactMapStore.from_directory('data'))
+
+    def test_memmap(self):
+        path = os.path.join(self.tmp, 'contacts')
+        store = ContactMapStore.from_directory('data', path=path)
+        self.assertIsInstance(store.contacts, np.memmap)
+        self.check(store)
+        self.check(ContactMapStore.load(path))
+        self.check(pickle.loads(pickle.dumps(store)))
+
+    def test_save(self):
+        path = os.path.join(self.tmp, 'contacts')
+        ContactMapStore.from_directory('data').save(path)
+        self.check(ContactMapStore.load(path))
+
+
+class TestPackedContactMapDataset(unittest.TestCase):
+
+    def setUp(self):
+        self.store = ContactMapStore.from_directory('data')
+
+    def test_collate(self):
+        ds = PackedContactMapDataset(self.store)
+        tokens, res, mask = ds.collate([ds[0], ds[2]])
+        n0, n2 = len(tokens[0]), len(tokens[1])
+        self.assertEqual(res.shape, (2, max(n0, n2), max(n0, n2)))
+        npt.assert_allclose(res[0, :n0, :n0].numpy(), self.store.dense(0))
+        npt.assert_allclose(res[1, :n2, :n2].numpy(), self.store.dense(2))
+        self.assertEqual(mask.sum(1).tolist(), [n0, n2])
+        # padding has no contacts
+        self.assertEqual(res[0, n0:].abs().sum().item(), 0)
+        self.assertEqual(res[1, n2:].abs().sum().item(), 0)
+
+    def test_crop(self):
+        ds = PackedContactMapDataset(self.store, crop_size=50, seed=0)
+        tokens, res, mask = ds.collate([ds[i] for i in range(3)])
+        self.assertEqual(res.shape, (3, 50, 50))
+        self.assertTrue(mask.all())
+        for k in range(3):
+            # the window is a block on the diagonal of the full map
+            full = self.store.dense(k)
+            seq = self.store.sequences[k]
+            starts = [s for s in range(len(seq) - 49)
+                      if (seq[s:s + 50] == tokens[k]).all()
+                      and np.allclose(full[s:s + 50, s:s + 50],
+                                      res[k].numpy())]
+            self.assertGreater(len(starts), 0)
+
+    def test_dataloader(self):
+        ds = PackedContactMapDataset(self.store)
+        dl = torch.utils.data.DataLoader(ds, batch_size=3,
+                                         collate_fn=ds.collate)
+        res = [len(tokens) for tokens, _, _ in dl]
+        self.assertListEqual(res, [3, 3, 1])
+
+
 if __name__ == "__main__":
     unittest.main()
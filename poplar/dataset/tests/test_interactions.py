@@ -1,13 +1,23 @@
+import os
+import glob
+import shutil
+import tempfile
 import unittest
 import numpy as np
+import numpy.testing as npt
 from poplar.util import get_data_path
 import pandas as pd
 from Bio import SeqIO
+from torch.utils.data import DataLoader
+from poplar.dataset.sequences import SequenceStore
 from poplar.dataset.interactions import (
     InteractionDataset, ValidationDataset,
-    parse, preprocess,
+    InteractionDataDirectory, InteractionStream,
+    parse, preprocess, read_sequences, nbytes,
     clean, dictionary,
-    NegativeSampler)
+    NegativeSampler, alias_table)
+from poplar.dataset.positives import pack_pairs
+from poplar.dataset.links import count_lines
 
 
 class TestPreprocess(unittest.TestCase):
@@ -17,13 +27,13 @@ class TestPreprocess(unittest.TestCase):
         self.fasta_file = get_data_path('prots.fa')
 
     def test_preprocess(self):
-        seqs = list(SeqIO.parse(self.fasta_file, format='fasta'))
+        store = SequenceStore.from_fasta(self.fasta_file)
         links = pd.read_table(self.links_file, header=None)
-        truncseqs = list(map(clean, seqs))
-        seqids = list(map(lambda x: x.id, truncseqs))
-        seqdict = dict(zip(seqids, truncseqs))
-        pairs = preprocess(seqdict, links)
+        pairs = preprocess(store, links)
         self.assertListEqual(list(pairs.shape), [100, 2])
+        self.assertEqual(pairs.dtype, np.int32)
+        self.assertEqual(store.ids[pairs[0, 0]], links.loc[0, 0])
+        self.assertEqual(store.ids[pairs[0, 1]], links.loc[0, 1])
 
 
 class TestInteractionDataset(unittest.TestCase):
@@ -32,13 +42,9 @@ class TestInteractionDataset(unittest.TestCase):
         self.links_file = get_data_path('links.txt')
         self.fasta_file = get_data_path('prots.fa')
 
-        self.seqs = list(SeqIO.parse(self.fasta_file, format='fasta'))
+        self.store = SequenceStore.from_fasta(self.fasta_file)
         links = pd.read_table(self.links_file, header=None)
-
-        truncseqs = list(map(clean, self.seqs))
-        seqids = list(map(lambda x: x.id, truncseqs))
-        seqdict = dict(zip(seqids, truncseqs))
-        self.pairs = preprocess(seqdict, links)
+        self.pairs = preprocess(self.store, links)
 
     def test_sort(self):
         pass
@@ -48,17 +54,16 @@ class TestInteractionDataset(unittest.TestCase):
         # to make sure that peptides are sampled
         # uniformly from the database
         np.random.seed(0)
-        sampler = NegativeSampler(self.seqs)
-        intsd = InteractionDataset(self.pairs, sampler)
+        sampler = NegativeSampler(self.store)
+        intsd = InteractionDataset(self.pairs, self.store, sampler)
         res = intsd.random_peptide()
-        seqset = list(map(clean, self.seqs))
-        seqset = set(map(lambda x: x.seq, seqset))
-        self.assertIn(res, seqset)
+        seqs = list(SeqIO.parse(self.fasta_file, format='fasta'))
+        seqset = set(map(lambda x: str(clean(x).seq), seqs))
+        self.assertIn(self.store.decode(res), seqset)
 
     def test_getitem(self):
-        np.random.seed(1)
-        sampler = NegativeSampler(self.seqs)
-        intsd = InteractionDataset(self.pairs, sampler)
+        sampler = NegativeSampler(self.store)
+        intsd = InteractionDataset(self.pairs, self.store, sampler, seed=1)
         gene, pos, neg = intsd[0]
 
         exp_gene = list(
@@ -87,19 +92,108 @@ class TestInteractionDataset(unittest.TestCase):
             'VFVGLALACPIE'
         )
 
-        self.assertListEqual(list(gene), exp_gene)
-        self.assertListEqual(list(pos), exp_pos)
-        self.assertListEqual(list(neg), exp_neg)
+        self.assertListEqual(list(self.store.decode(gene)), exp_gene)
+        self.assertListEqual(list(self.store.decode(pos)), exp_pos)
+        self.assertListEqual(list(self.store.decode(neg)), exp_neg)
 
     def test_iter(self):
         # Test the iter function to make sure
         # negative samples are being drawn
         np.random.seed(0)
-        sampler = NegativeSampler(self.seqs)
-        intsd = InteractionDataset(self.pairs, sampler)
+        sampler = NegativeSampler(self.store)
+        intsd = InteractionDataset(self.pairs, self.store, sampler)
         res = [r for r in intsd]
         self.assertEqual(len(res), self.pairs.shape[0] * intsd.num_neg)
 
+    def test_collate(self):
+        np.random.seed(0)
+        sampler = NegativeSampler(self.store)
+        intsd = InteractionDataset(self.pairs, self.store, sampler)
+        gene, pos, neg = intsd.collate([intsd[0], intsd[1]])
+        self.assertEqual(len(gene), 2)
+        npt.assert_array_equal(gene[1], self.store[self.pairs[1, 0]])
+        npt.assert_array_equal(pos[1], self.store[self.pairs[1, 1]])
+
+    def test_getitems(self):
+        sampler = NegativeSampler(self.store)
+        intsd = InteractionDataset(self.pairs, self.store, sampler)
+        res = intsd.__getitems__([3, 1, 4])
+        self.assertEqual(len(res), 3)
+        self.assertEqual(res[1][0], self.pairs[1, 0])
+        self.assertEqual(res[2][1], self.pairs[4, 1])
+        # the draws are reproducible
+        intsd.reseed(0)
+        self.assertListEqual(intsd.__getitems__([3, 1, 4]), res)
+
+
+class TestNegativeSampler(unittest.TestCase):
+
+    def setUp(self):
+        self.store = SequenceStore.from_fasta(get_data_path('prots.fa'))
+        self.n = len(self.store)
+        state = np.random.RandomState(0)
+        self.pairs = state.randint(0, self.n, size=(200, 2))
+
+    def test_alias_table(self):
+        weights = np.array([1., 2., 0., 5.])
+        prob, alias = alias_table(weights)
+        # reconstruct the distribution from the table
+        exp = np.zeros(4)
+        for i in range(4):
+            exp[i] += prob[i] / 4
+            exp[alias[i]] += (1 - prob[i]) / 4
+        npt.assert_allclose(exp, weights / weights.sum())
+
+    def test_uniform(self):
+        sampler = NegativeSampler(self.store, seed=0)
+        res = sampler.draw(size=10000)
+        self.assertEqual(res.shape, (10000,))
+        self.assertTrue((res >= 0).all() and (res < self.n).all())
+        res2 = NegativeSampler(self.store, seed=0).draw(size=10000)
+        npt.assert_array_equal(res, res2)
+        self.assertIsInstance(sampler.draw(), int)
+
+    def test_degree(self):
+        degrees = np.zeros(self.n)
+        degrees[:3] = [1, 16, 81]
+        sampler = NegativeSampler(self.store, distribution='degree',
+                                  degrees=degrees, seed=0)
+        res = sampler.draw(size=100000)
+        freq = np.bincount(res, minlength=self.n) / len(res)
+        exp = degrees ** 0.75 / (degrees ** 0.75).sum()
+        npt.assert_allclose(freq, exp, atol=0.01)
+
+    def test_taxon(self):
+        taxa = np.arange(self.n) % 3
+        taxa[0] = -1
+        sampler = NegativeSampler(self.store, distribution='taxon',
+                                  taxa=taxa, seed=0)
+        gene = np.arange(1, self.n)
+        res = sampler.draw(gene)
+        npt.assert_array_equal(taxa[res], taxa[gene])
+        res = sampler.draw(1, size=100)
+        self.assertTrue((taxa[res] == taxa[1]).all())
+        # unknown taxa are drawn uniformly
+        res = sampler.draw(0, size=100)
+        self.assertGreater(len(np.unique(taxa[res])), 1)
+
+    def test_reject_positives(self):
+        sampler = NegativeSampler.from_pairs(
+            self.store, self.pairs, reject_positives=True, seed=0)
+        gene = np.repeat(self.pairs[:, 0], 20)
+        res = sampler.draw(gene)
+        keys = pack_pairs(self.pairs[:, 0], self.pairs[:, 1])
+        self.assertFalse(np.isin(pack_pairs(gene, res), keys).any())
+        # positives are unordered pairs
+        self.assertFalse(np.isin(pack_pairs(res, gene), keys).any())
+
+    def test_from_pairs(self):
+        sampler = NegativeSampler.from_pairs(
+            self.store, self.pairs, distribution='degree', seed=0)
+        res = sampler.draw(size=1000)
+        degrees = np.bincount(self.pairs.ravel(), minlength=self.n)
+        self.assertTrue((degrees[res] > 0).all())
+
 
 class TestValidationDataset(unittest.TestCase):
 
@@ -107,19 +201,14 @@ class TestValidationDataset(unittest.TestCase):
         self.links_file = get_data_path('links.txt')
         self.fasta_file = get_data_path('prots.fa')
 
-        self.seqs = list(SeqIO.parse(self.fasta_file, format='fasta'))
+        self.store = SequenceStore.from_fasta(self.fasta_file)
         self.links = pd.read_table(self.links_file, header=None)
-
-        truncseqs = list(map(clean, self.seqs))
-        seqids = list(map(lambda x: x.id, truncseqs))
-        seqdict = dict(zip(seqids, truncseqs))
-
-        self.pairs = preprocess(seqdict, self.links)
+        self.pairs = preprocess(self.store, self.links)
 
     def test_getitem(self):
         np.random.seed(0)
-        sampler = NegativeSampler(self.seqs)
-        intsd = ValidationDataset(self.pairs, self.links, sampler)
+        sampler = NegativeSampler(self.store)
+        intsd = ValidationDataset(self.pairs, self.links, self.store, sampler)
 
         gene, pos, rnd, protid, taxa = intsd[0]
 
@@ -147,23 +236,32 @@ class TestValidationDataset(unittest.TestCase):
             'AEAEQARVSVRNIRRDALAQLKDLQKEKEISEDEERRAGDDVQKLTDKFIGEIEKALEA'
             'KEADLMAV'
         )
-        self.assertListEqual(list(gene), exp_gene)
-        self.assertListEqual(list(pos), exp_pos)
-        self.assertListEqual(list(rnd), exp_rnd)
+        self.assertListEqual(list(self.store.decode(gene)), exp_gene)
+        self.assertListEqual(list(self.store.decode(pos)), exp_pos)
+        self.assertListEqual(list(self.store.decode(rnd)), exp_rnd)
         self.assertEqual(protid, '287.DR97_4286')
         self.assertEqual(taxa, 287)
 
 
+    def test_iter_reproducible(self):
+        sampler = NegativeSampler(self.store)
+        intsd = ValidationDataset(self.pairs, self.links, self.store, sampler)
+        # every pass draws the same negatives
+        self.assertListEqual(list(intsd), list(intsd))
+
     def test_iter(self):
         # Test the iter function to make sure
         # negative samples are being drawn
         np.random.seed(0)
-        sampler = NegativeSampler(self.seqs)
-        intsd = ValidationDataset(self.pairs, self.links, sampler)
+        sampler = NegativeSampler(self.store)
+        intsd = ValidationDataset(self.pairs, self.links, self.store, sampler)
         res = [r for r in intsd]
         self.assertEqual(len(res), self.pairs.shape[0] * intsd.num_neg)
-        gene, pos, rnd, idx, taxa = list(zip(*res))
+        gene, pos, rnd, idx, taxa, link = list(zip(*res))
         ids = list(zip(idx, taxa))
+        # every link has its own index, shared by its negative draws
+        self.assertEqual(len(set(link)), self.pairs.shape[0])
+        self.assertEqual(len(set(zip(link, gene, pos))), len(set(link)))
         # make sure that if sorted, the list will be in the same order
         sorted_idx = sorted(ids, key=lambda x: (x[0], x[1]))
         self.assertListEqual(sorted_idx, ids)
@@ -232,5 +330,184 @@ class TestParse(unittest.TestCase):
         self.assertEqual(len(res[2]), 2)
 
 
+class TestInteractionDataDirectory(unittest.TestCase):
+
+    def setUp(self):
+        self.fasta_file = get_data_path('prots.fa')
+        self.links_dir = tempfile.mkdtemp()
+        with open(get_data_path('links.txt')) as fh:
+            lines = fh.readlines()
+        for i, fname in enumerate(['xaa', 'xab']):
+            with open(os.path.join(self.links_dir, fname), 'w') as fh:
+                fh.writelines(lines[i * 50: (i + 1) * 50])
+
+    def tearDown(self):
+        shutil.rmtree(self.links_dir)
+
+    def test_count_lines(self):
+        self.assertEqual(count_lines(get_data_path('links.txt')), 100)
+
+    def test_total(self):
+        directory = InteractionDataDirectory(
+            self.fasta_file, self.links_dir, training_column=4)
+        # only the training links are counted
+        self.assertEqual(directory.total(), 83)
+        # counting rows doesn't require reading the fasta file
+        self.assertIsNone(directory._sequences)
+
+    def test_iter(self):
+        directory = InteractionDataDirectory(
+            self.fasta_file, self.links_dir, training_column=4)
+        res = list(directory)
+        self.assertEqual(len(res), 2)
+        seqs = directory.sequences
+        # the same sequence table is reused for every links file
+        self.assertIs(directory.sequences, seqs)
+        self.assertEqual(len(seqs), len(read_sequences(self.fasta_file)))
+
+    def test_prefetch(self):
+        from poplar.dataset.stream import prefetch
+        directory = InteractionDataDirectory(
+            self.fasta_file, self.links_dir, training_column=4)
+        res = list(prefetch(directory, depth=2, max_bytes=1,
+                            nbytes=nbytes))
+        self.assertEqual(len(res), 2)
+        train, test, valid = res[0]
+        exp = train.dataset.pairs.nbytes
+        for d in [test, valid]:
+            exp += d.pairs.nbytes + d.links.memory_usage(deep=True).sum()
+        self.assertEqual(nbytes(res[0]), exp)
+
+    def test_sequence_path(self):
+        path = os.path.join(self.links_dir, 'store')
+        directory = InteractionDataDirectory(
+            self.fasta_file, self.links_dir, training_column=4,
+            sequence_path=path)
+        store = directory.sequences
+        self.assertIsInstance(store.tokens, np.memmap)
+        # the second time around, the store is opened from disk
+        res = read_sequences(self.fasta_file, path=path)
+        self.assertIsInstance(res.tokens, np.memmap)
+        npt.assert_array_equal(res.offsets, store.offsets)
+        # stores of other fasta files aren't reused
+        other = os.path.join(self.links_dir, 'other.fa')
+        shutil.copy(self.fasta_file, other)
+        with open(other, 'a') as fh:
+            fh.write('>extra\nMKV\n')
+        with self.assertRaises(ValueError):
+            read_sequences(other, path=path)
+        with self.assertRaises(ValueError):
+            read_sequences(self.fasta_file, path=path, threshold=50)
+
+    def train_rows(self, store):
+        links = pd.read_table(get_data_path('links.txt'), header=None)
+        train = links.loc[links[4] == 'Train']
+        return sorted(zip(store.index(train[0].values),
+                          store.index(train[1].values)))
+
+    def test_stream(self):
+        store = read_sequences(self.fasta_file)
+        files = sorted(glob.glob(f'{self.links_dir}/*'))
+        stream = InteractionStream(files, store, NegativeSampler(store),
+                                   chunk_size=8, buffer_size=16)
+        first = [(g, p) for g, p, _ in stream]
+        self.assertListEqual(sorted(first), self.train_rows(store))
+        stream.set_epoch(1)
+        second = [(g, p) for g, p, _ in stream]
+        self.assertListEqual(sorted(second), sorted(first))
+        self.assertNotEqual(second, first)
+
+    def test_stream_workers(self):
+        store = read_sequences(self.fasta_file)
+        files = sorted(glob.glob(f'{self.links_dir}/*'))
+        stream = InteractionStream(files, store, NegativeSampler(store),
+                                   chunk_size=8, buffer_size=16)
+        dataloader = DataLoader(stream, batch_size=None, num_workers=2)
+        res = sorted((int(g), int(p)) for g, p, _ in dataloader)
+        self.assertListEqual(res, self.train_rows(store))
+
+    def test_directory_stream(self):
+        directory = InteractionDataDirectory(
+            self.fasta_file, self.links_dir, training_column=4,
+            num_neg=2, batch_size=7, num_workers=0)
+        n = 0
+        for gene, pos, neg in directory.stream(chunk_size=8):
+            self.assertLessEqual(len(gene), 7)
+            self.assertEqual(gene[0].dtype, np.uint8)
+            n += len(gene)
+        self.assertEqual(n, 2 * len(self.train_rows(directory.sequences)))
+
+    def test_max_tokens(self):
+        directory = InteractionDataDirectory(
+            self.fasta_file, self.links_dir, training_column=4,
+            max_tokens=2048)
+        for train, _, _ in directory:
+            n = 0
+            for gene, pos, neg in train:
+                width = max(max(map(len, gene)), max(map(len, pos)))
+                self.assertLessEqual(len(gene) * width, 2048)
+                n += len(gene)
+            self.assertEqual(n, len(train.dataset))
+
+    def test_multiprocessing_context(self):
+        directory = InteractionDataDirectory(
+            self.fasta_file, self.links_dir, training_column=4,
+            num_workers=2, multiprocessing_context='spawn')
+        for train, _, _ in directory:
+            self.assertEqual(
+                train.multiprocessing_context.get_start_method(), 'spawn')
+            n = sum(len(gene) for gene, _, _ in train)
+            self.assertEqual(n, len(train.dataset))
+        stream = directory.stream()
+        self.assertEqual(
+            stream.multiprocessing_context.get_start_method(), 'spawn')
+
+    def test_epochs(self):
+        directory = InteractionDataDirectory(
+            self.fasta_file, self.links_dir, training_column=4,
+            max_tokens=2048)
+        first = [list(train.batch_sampler) for train, _, _ in directory]
+        second = [list(train.batch_sampler) for train, _, _ in directory]
+        self.assertNotEqual(first, second)
+
+    def test_set_epoch(self):
+        directory = InteractionDataDirectory(
+            self.fasta_file, self.links_dir, training_column=4)
+        self.assertListEqual([os.path.basename(f)
+                              for f in directory.filenames], ['xaa', 'xab'])
+        exp = [train.dataset.seed for train, _, _ in directory]
+        exp += [train.dataset.seed for train, _, _ in directory]
+        # resuming the second epoch from its second links file
+        directory.set_epoch(1, start=1)
+        res = [train.dataset.seed for train, _, _ in directory]
+        self.assertListEqual(res, exp[3:])
+        self.assertEqual(directory.epoch, 2)
+        self.assertEqual(directory.start, 0)
+
+    def test_positives(self):
+        path = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(path, 'positives.npy')
+            directory = InteractionDataDirectory(
+                self.fasta_file, self.links_dir, training_column=4,
+                reject_positives=True, positive_path=fname)
+            links = pd.read_table(get_data_path('links.txt'), header=None)
+            pairs = preprocess(directory.sequences, links)
+            # the index covers the links of every file
+            index = directory.positives
+            self.assertTrue(index.contains(pairs[:, 0], pairs[:, 1]).all())
+            self.assertIsInstance(index.keys, np.memmap)
+            for train, _, _ in directory:
+                sampler = train.dataset.sampler
+                self.assertIs(sampler.positives, index)
+                # protein 1 is linked to most of the sequences, so a few
+                # negatives are still positives after `max_tries` draws
+                gene = np.repeat(pairs[:, 0], 10)
+                neg = sampler.draw(gene)
+                self.assertLess(index.contains(gene, neg).mean(), 0.1)
+        finally:
+            shutil.rmtree(path)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,132 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+from poplar.util import get_data_path
+from poplar.dataset.sequences import SequenceStore
+from poplar.dataset.positives import PositiveIndex
+from poplar.dataset.interactions import (
+    parse, preprocess, InteractionDataDirectory, InteractionStream,
+    NegativeSampler)
+from poplar.dataset.links import (
+    convert_links, read_links, encode_split, count_lines, count_links,
+    count_field, check_proteins, LINK_DTYPE, SPLITS, UNKNOWN_SPLIT)
+
+
+class TestLinks(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.fasta_file = get_data_path('prots.fa')
+        self.links_file = get_data_path('links.txt')
+        self.store = SequenceStore.from_fasta(self.fasta_file)
+        self.links = pd.read_table(self.links_file, header=None)
+        self.output = os.path.join(self.path, 'binary')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_count_lines(self):
+        self.assertEqual(count_lines(self.links_file), 100)
+
+    def test_count_links(self):
+        res = convert_links([self.links_file], self.store, self.output)
+        for fname in [self.links_file, res[0]]:
+            self.assertEqual(count_links(fname), 100)
+            self.assertEqual(count_links(fname, 'Train'), 83)
+            self.assertEqual(count_links(fname, 'Test'), 12)
+            self.assertEqual(count_links(fname, 'Validate'), 5)
+
+    def test_count_field(self):
+        fname = os.path.join(self.path, 'links.txt')
+        with open(fname, 'w') as fh:
+            fh.write('a\tTrain\tb\nTrain b Trains\nTraining Test\nc Train')
+        self.assertEqual(count_field(fname, 'Train'), 3)
+        # lines split across chunks are still counted
+        self.assertEqual(count_field(fname, 'Train', chunk_size=3), 3)
+        self.assertEqual(count_field(fname, 'Test', chunk_size=3), 1)
+
+    def test_encode_split(self):
+        res = encode_split(['Train', 'Test', 'Validate', 'Other'])
+        npt.assert_array_equal(res, [0, 1, 2, UNKNOWN_SPLIT])
+        self.assertEqual(res.dtype, np.uint8)
+
+    def test_convert_links(self):
+        res = convert_links([self.links_file], self.store, self.output,
+                            chunk_size=30)
+        self.assertListEqual(res, [os.path.join(self.output, 'links.npy')])
+        links = read_links(res[0], self.store)
+        self.assertIsInstance(links, np.memmap)
+        self.assertEqual(links.dtype, LINK_DTYPE)
+        pairs = preprocess(self.store, self.links)
+        npt.assert_array_equal(links['protein1'], pairs[:, 0])
+        npt.assert_array_equal(links['protein2'], pairs[:, 1])
+        npt.assert_array_equal(links['taxonomy'], self.links[3])
+        npt.assert_array_equal(links['split'] == SPLITS['Train'],
+                               self.links[4] == 'Train')
+        # the text files are read into the same columns
+        npt.assert_array_equal(read_links(self.links_file, self.store),
+                               links)
+
+    def test_check_proteins(self):
+        convert_links([self.links_file], self.store, self.output)
+        check_proteins(self.output, self.store)
+        other = SequenceStore(self.store.tokens, self.store.offsets,
+                              list(self.store.ids[::-1]))
+        with self.assertRaises(ValueError):
+            check_proteins(self.output, other)
+
+    def test_parse(self):
+        res = convert_links([self.links_file], self.store, self.output)
+        exp = parse(self.fasta_file, self.links_file, sequences=self.store)
+        res = parse(self.fasta_file, res[0], sequences=self.store)
+        npt.assert_array_equal(res[0].dataset.pairs,
+                               exp[0].dataset.pairs)
+        for r, e in zip(res[1:], exp[1:]):
+            npt.assert_array_equal(r.pairs, e.pairs)
+            pd.testing.assert_frame_equal(
+                r.links[[0, 3]], e.links[[0, 3]], check_dtype=False)
+
+    def test_directory(self):
+        convert_links([self.links_file], self.store, self.output)
+        directory = InteractionDataDirectory(self.fasta_file, self.output)
+        self.assertListEqual(directory.filenames,
+                             [os.path.join(self.output, 'links.npy')])
+        train, test, valid = next(iter(directory))
+        self.assertEqual(len(train.dataset), 83)
+        index = PositiveIndex.from_links(directory.sequences,
+                                         directory.filenames)
+        pairs = preprocess(self.store, self.links)
+        self.assertTrue(index.contains(pairs[:, 0], pairs[:, 1]).all())
+
+    def test_total(self):
+        text = os.path.join(self.path, 'text')
+        os.makedirs(text)
+        with open(self.links_file) as fh:
+            lines = fh.readlines()
+        for i, fname in enumerate(['xaa', 'xab']):
+            with open(os.path.join(text, fname), 'w') as fh:
+                fh.writelines(lines[i * 50: (i + 1) * 50])
+        exp = InteractionDataDirectory(self.fasta_file, text).total()
+        convert_links(sorted(os.path.join(text, f) for f in os.listdir(text)),
+                      self.store, self.output)
+        res = InteractionDataDirectory(self.fasta_file, self.output).total()
+        self.assertEqual(exp, 83)
+        self.assertEqual(res, exp)
+
+    def test_stream(self):
+        res = convert_links([self.links_file], self.store, self.output)
+        stream = InteractionStream(res, self.store,
+                                   NegativeSampler(self.store),
+                                   chunk_size=7)
+        rows = sorted((g, p) for g, p, _ in stream)
+        pairs = preprocess(self.store, self.links)
+        exp = sorted(map(tuple, pairs[(self.links[4] == 'Train').values]))
+        self.assertListEqual(rows, exp)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+from poplar.util import get_data_path
+from poplar.dataset.sequences import SequenceStore
+from poplar.dataset.interactions import preprocess
+from poplar.dataset.positives import PositiveIndex, pack_pairs
+
+
+class TestPositiveIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.pairs = np.array([[0, 1], [5, 2], [3, 3], [1, 0]])
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_pack_pairs(self):
+        npt.assert_array_equal(pack_pairs([1, 2], [2, 1]),
+                               pack_pairs([2, 1], [1, 2]))
+        self.assertNotEqual(pack_pairs(1, 2), pack_pairs(1, 3))
+        self.assertEqual(pack_pairs(0, 2 ** 32 - 1), 2 ** 32 - 1)
+
+    def test_contains(self):
+        index = PositiveIndex.from_pairs(self.pairs)
+        self.assertEqual(len(index), 3)
+        res = index.contains(np.array([0, 1, 2, 3, 4, 6]),
+                             np.array([1, 0, 5, 3, 4, 5]))
+        npt.assert_array_equal(res, [True, True, True, True, False, False])
+
+    def test_empty(self):
+        index = PositiveIndex.from_pairs(np.zeros((0, 2), dtype=np.int64))
+        npt.assert_array_equal(index.contains([0, 1], [1, 0]),
+                               [False, False])
+
+    def test_save_load(self):
+        fname = os.path.join(self.path, 'positives.npy')
+        PositiveIndex.from_pairs(self.pairs).save(fname)
+        index = PositiveIndex.load(fname)
+        self.assertIsInstance(index.keys, np.memmap)
+        self.assertTrue(index.contains(2, 5))
+        # memory mapped indexes are pickled by their path
+        res = pickle.loads(pickle.dumps(index))
+        self.assertEqual(res.path, fname)
+        npt.assert_array_equal(res.keys, index.keys)
+
+    def test_from_links(self):
+        store = SequenceStore.from_fasta(get_data_path('prots.fa'))
+        links_file = get_data_path('links.txt')
+        fname = os.path.join(self.path, 'positives.npy')
+        index = PositiveIndex.from_links(store, [links_file], chunk_size=30,
+                                         path=fname)
+        self.assertTrue(os.path.exists(fname))
+        pairs = preprocess(store, pd.read_table(links_file, header=None))
+        self.assertTrue(index.contains(pairs[:, 0], pairs[:, 1]).all())
+        self.assertTrue(index.contains(pairs[:, 1], pairs[:, 0]).all())
+        self.assertEqual(len(index), len(np.unique(
+            pack_pairs(pairs[:, 0], pairs[:, 1]))))
+
+    def test_fingerprint(self):
+        store = SequenceStore.from_fasta(get_data_path('prots.fa'))
+        links_file = get_data_path('links.txt')
+        fname = os.path.join(self.path, 'positives.npy')
+        PositiveIndex.from_links(store, [links_file], path=fname)
+        exp = PositiveIndex.fingerprint(store, [links_file])
+        self.assertTrue(PositiveIndex.load(fname, exp).contains(
+            *preprocess(store, pd.read_table(links_file, header=None))[0]))
+        # indexes of other links files or stores aren't reused
+        other = SequenceStore.from_fasta(get_data_path('prots.fa'),
+                                         threshold=50)
+        for fingerprint in [
+                PositiveIndex.fingerprint(store, []),
+                PositiveIndex.fingerprint(other, [links_file])]:
+            with self.assertRaises(ValueError):
+                PositiveIndex.load(fname, fingerprint)
+
+
+if __name__ == '__main__':
+    unittest.main()
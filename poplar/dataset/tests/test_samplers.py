@@ -0,0 +1,55 @@
+import unittest
+import numpy as np
+from poplar.dataset.samplers import LengthBatchSampler
+
+
+class TestLengthBatchSampler(unittest.TestCase):
+
+    def setUp(self):
+        state = np.random.RandomState(0)
+        self.lengths = state.randint(10, 1024, size=1000)
+
+    def padded(self, batches):
+        return sum(len(b) * self.lengths[b].max() for b in batches)
+
+    def test_batches(self):
+        sampler = LengthBatchSampler(self.lengths, max_tokens=4096,
+                                     pool_size=200)
+        batches = list(sampler)
+        # every item is in exactly one batch
+        self.assertListEqual(sorted(np.concatenate(batches)),
+                             list(range(1000)))
+        for b in batches:
+            self.assertLessEqual(len(b) * self.lengths[b].max(), 4096)
+        # much less padding than random batches of the same size
+        state = np.random.RandomState(1)
+        size = int(np.ceil(1000 / len(batches)))
+        rnd = np.array_split(state.permutation(1000), len(batches))
+        self.assertLess(self.padded(batches), 0.75 * self.padded(rnd))
+        self.assertLessEqual(max(map(len, rnd)), size)
+
+    def test_epochs(self):
+        sampler = LengthBatchSampler(self.lengths, max_tokens=4096)
+        self.assertEqual(len(sampler), len(sampler.batches()))
+        first, second = list(sampler), list(sampler)
+        self.assertNotEqual(first, second)
+        # the batches are reproducible
+        sampler = LengthBatchSampler(self.lengths, max_tokens=4096)
+        self.assertEqual(list(sampler), first)
+        sampler.set_epoch(1)
+        self.assertEqual(list(sampler), second)
+
+    def test_max_batch_size(self):
+        sampler = LengthBatchSampler(self.lengths, max_tokens=10 ** 6,
+                                     max_batch_size=7)
+        batches = list(sampler)
+        self.assertEqual(max(map(len, batches)), 7)
+
+    def test_long_items(self):
+        sampler = LengthBatchSampler([5, 2000, 5, 5], max_tokens=100,
+                                     shuffle=False)
+        self.assertListEqual(list(sampler), [[0, 2, 3], [1]])
+
+
+if __name__ == '__main__':
+    unittest.main()
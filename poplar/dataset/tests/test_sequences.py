@@ -0,0 +1,78 @@
+import pickle
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import numpy.testing as npt
+from Bio import SeqIO
+from poplar.util import get_data_path, dictionary
+from poplar.dataset.sequences import SequenceStore, to_tokens, decode
+
+
+class TestTokens(unittest.TestCase):
+
+    def test_to_tokens(self):
+        res = to_tokens('ACDa')
+        exp = np.array([dictionary['A'], dictionary['C'],
+                        dictionary['D'], dictionary['A']], dtype=np.uint8)
+        npt.assert_array_equal(res, exp)
+
+    def test_unknown(self):
+        res = to_tokens('A*')
+        npt.assert_array_equal(res, [dictionary['A'], dictionary['X']])
+
+    def test_decode(self):
+        self.assertEqual(decode(to_tokens('MKV.')), 'MKV.')
+
+
+class TestSequenceStore(unittest.TestCase):
+
+    def setUp(self):
+        self.fasta_file = get_data_path('prots.fa')
+        self.records = list(SeqIO.parse(self.fasta_file, format='fasta'))
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_from_fasta(self):
+        store = SequenceStore.from_fasta(self.fasta_file, threshold=50)
+        self.assertEqual(len(store), len(self.records))
+        self.assertTrue((store.lengths <= 50).all())
+        for i, rec in enumerate(self.records):
+            self.assertEqual(store.decode(i), str(rec.seq[:50]))
+
+    def test_index(self):
+        store = SequenceStore.from_fasta(self.fasta_file)
+        ids = [self.records[3].id, self.records[0].id]
+        npt.assert_array_equal(store.index(ids), [3, 0])
+        with self.assertRaises(KeyError):
+            store.index(['not-a-protein'])
+
+    def test_memmap(self):
+        exp = SequenceStore.from_fasta(self.fasta_file)
+        res = SequenceStore.from_fasta(self.fasta_file, path=self.path)
+        self.assertIsInstance(res.tokens, np.memmap)
+        npt.assert_array_equal(res.offsets, exp.offsets)
+        npt.assert_array_equal(res.tokens, exp.tokens)
+        self.assertListEqual(list(res.ids), list(exp.ids))
+
+    def test_save_load(self):
+        exp = SequenceStore.from_fasta(self.fasta_file)
+        exp.save(self.path)
+        res = SequenceStore.load(self.path)
+        npt.assert_array_equal(res[5], exp[5])
+        self.assertEqual(res.fingerprint, exp.fingerprint)
+
+    def test_pickle(self):
+        store = SequenceStore.from_fasta(self.fasta_file, path=self.path)
+        state = pickle.dumps(store)
+        # only the path is sent to the workers
+        self.assertLess(len(state), 1000)
+        res = pickle.loads(state)
+        self.assertIsInstance(res.tokens, np.memmap)
+        npt.assert_array_equal(res[2], store[2])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,123 @@
+import time
+import unittest
+from poplar.dataset.stream import (
+    shard, shard_info, shuffle_buffer, prefetch, Gate)
+
+
+class TestStream(unittest.TestCase):
+
+    def test_shard_info(self):
+        self.assertEqual(shard_info(), (0, 1))
+
+    def test_shard(self):
+        res = [list(shard(range(10), i, 3)) for i in range(3)]
+        self.assertListEqual(res, [[0, 3, 6, 9], [1, 4, 7], [2, 5, 8]])
+        self.assertListEqual(list(shard(range(5))), list(range(5)))
+
+    def test_shuffle_buffer(self):
+        res = list(shuffle_buffer(range(100), 10, 0))
+        self.assertListEqual(sorted(res), list(range(100)))
+        self.assertNotEqual(res, list(range(100)))
+        self.assertListEqual(list(shuffle_buffer(range(100), 10, 0)), res)
+        # the items can't move earlier than the size of the buffer
+        for i, x in enumerate(res):
+            self.assertLessEqual(x, i + 10)
+
+    def test_no_buffer(self):
+        self.assertListEqual(list(shuffle_buffer(range(5), 0)),
+                             list(range(5)))
+
+
+class TestPrefetch(unittest.TestCase):
+
+    def stream(self, n, produced, sizes=None):
+        for i in range(n):
+            produced.append(i)
+            yield i if sizes is None else (i, sizes[i])
+
+    def wait(self, produced, n):
+        for _ in range(100):
+            if len(produced) >= n:
+                break
+            time.sleep(0.01)
+        # give the thread a chance to overrun
+        time.sleep(0.05)
+
+    def test_order(self):
+        produced = []
+        res = list(prefetch(self.stream(20, produced), depth=3))
+        self.assertListEqual(res, list(range(20)))
+
+    def test_depth(self):
+        produced = []
+        it = prefetch(self.stream(20, produced), depth=3)
+        self.assertEqual(next(it), 0)
+        # the next items are prepared while the first is in use
+        self.wait(produced, 4)
+        self.assertEqual(len(produced), 4)
+        self.assertEqual(next(it), 1)
+        self.wait(produced, 5)
+        self.assertEqual(len(produced), 5)
+        it.close()
+
+    def test_max_bytes(self):
+        produced = []
+        sizes = [10, 10, 10, 100, 10]
+        it = prefetch(self.stream(5, produced, sizes), depth=10,
+                      max_bytes=25, nbytes=lambda x: x[1])
+        self.assertEqual(next(it), (0, 10))
+        self.wait(produced, 3)
+        # a third item doesn't fit under the cap
+        self.assertEqual(len(produced), 4)
+        res = [x for x, _ in it]
+        # items larger than the cap still get through
+        self.assertListEqual(res, [1, 2, 3, 4])
+
+    def test_gate(self):
+        produced = []
+        gate = Gate()
+        it = prefetch(self.stream(5, produced), depth=1, gate=gate)
+        self.assertEqual(next(it), 0)
+        # nothing is prepared until the gate is opened
+        self.wait(produced, 2)
+        self.assertEqual(len(produced), 1)
+        gate.open()
+        self.wait(produced, 2)
+        self.assertEqual(len(produced), 2)
+        res = []
+        for x in it:
+            res.append(x)
+            gate.open()
+        self.assertListEqual(res, [1, 2, 3, 4])
+
+    def test_gate_depth(self):
+        produced = []
+        gate = Gate()
+        res = []
+        for x in prefetch(self.stream(6, produced), depth=3, gate=gate):
+            # the thread is idle while the gate is closed
+            n = len(produced)
+            time.sleep(0.05)
+            self.assertEqual(len(produced), n)
+            res.append(x)
+            gate.open()
+        self.assertListEqual(res, list(range(6)))
+
+    def test_no_prefetch(self):
+        produced = []
+        it = prefetch(self.stream(5, produced), depth=0)
+        next(it)
+        self.assertEqual(len(produced), 1)
+
+    def test_error(self):
+        def fail():
+            yield 1
+            raise ValueError('bad links file')
+        it = prefetch(fail(), depth=2)
+        self.assertEqual(next(it), 1)
+        with self.assertRaises(ValueError):
+            next(it)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,192 @@
+import os
+import itertools
+import multiprocessing
+import numpy as np
+import torch
+from Bio import SeqIO
+from poplar.util import to_tokens
+from poplar.model.ppibinder import batch_features
+from poplar.model.cache import EmbeddingStore, sequence_key, model_fingerprint
+
+
+def _chunks(records, chunk_size):
+    """ Splits a stream of records into lists of `chunk_size`. """
+    records = iter(records)
+    while True:
+        chunk = list(itertools.islice(records, chunk_size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+def embed_shard(peptide_model, fasta_file, output_directory,
+                shard=0, num_shards=1, chunk_size=10000, batch_size=32,
+                threshold=1024, dtype=np.float16, device='cpu'):
+    """ Computes the <s> token embeddings of one shard of a fasta file.
+
+    The fasta file is streamed in chunks of `chunk_size` sequences, and
+    chunk `i` is processed by shard `i % num_shards`. Chunks are named
+    by the range of sequences that they hold, and chunks that have
+    already been written are skipped, so interrupted runs can be
+    resumed, even with a different `chunk_size`.
+
+    Parameters
+    ----------
+    peptide_model : torch.nn.Module
+        Language model with an `extract_features` method.
+    fasta_file : filepath
+        Fasta file of sequences of interest.
+    output_directory : filepath
+        Directory of the `poplar.model.cache.EmbeddingStore`.
+    shard : int
+        Index of the shard to process.
+    num_shards : int
+        Total number of shards.
+    chunk_size : int
+        Number of sequences per chunk.
+    batch_size : int
+        Number of sequences passed through the language model at once.
+        Sequences are sorted by length before they are batched.
+    threshold : int
+        Maximum sequence length.
+    dtype : np.dtype
+        Data type of the stored embeddings.
+    device : str
+        Device that the language model is on.
+
+    Returns
+    -------
+    int
+        Number of sequences that were embedded.
+    """
+    peptide_model.eval()
+    store = EmbeddingStore(output_directory, model_fingerprint(peptide_model))
+    records = SeqIO.parse(fasta_file, format='fasta')
+    n = 0
+    for c, chunk in enumerate(_chunks(records, chunk_size)):
+        start = c * chunk_size
+        name = f'{start:09d}_{start + len(chunk):09d}'
+        if c % num_shards != shard or store.has_chunk(name):
+            continue
+        ids = [r.id for r in chunk]
+        seqs = [to_tokens(r.seq[:threshold]) for r in chunk]
+        keys = list(map(sequence_key, seqs))
+        with torch.no_grad():
+            emb = batch_features(peptide_model, seqs,
+                                 max_batch_size=batch_size, device=device)
+        store.write_chunk(name, ids, keys, emb.cpu().numpy().astype(dtype))
+        n += len(ids)
+        print(f'shard {shard}, chunk {c}, {n} sequences embedded')
+    return n
+
+
+def subshards(num_shards, shard=None, processes=1):
+    """ Splits shards of a fasta file across processes.
+
+    Shard `s` of `num_shards` holds the same chunks as shards
+    `s + num_shards * p` of `num_shards * processes` for each `p`, so
+    every process gets a part of the shards that were asked for, and
+    other jobs run with the same `num_shards` still cover the rest.
+
+    Parameters
+    ----------
+    num_shards : int
+        Total number of shards.
+    shard : int
+        Index of the shard to process. If this is not specified,
+        all of the shards are processed.
+    processes : int
+        Number of processes to split each shard across.
+
+    Returns
+    -------
+    shards : list of int
+        Indices of the shards to pass to `embed_shard`.
+    num_shards : int
+        Total number of shards to pass to `embed_shard`.
+    """
+    parts = max(1, processes)
+    selected = range(num_shards) if shard is None else [shard]
+    shards = [s + num_shards * p for s in selected for p in range(parts)]
+    return shards, num_shards * parts
+
+
+def _load_pretrained(checkpoint_path, data_dir, device):
+    # fairseq is only needed to embed, not to read the embeddings
+    from fairseq.models.roberta import RobertaModel
+    pretrained_model = RobertaModel.from_pretrained(
+        checkpoint_path, 'checkpoint_best.pt', data_dir)
+    pretrained_model.to(device)
+    return pretrained_model
+
+
+def _embed_worker(kwargs):
+    torch.set_num_threads(kwargs.pop('num_threads'))
+    pretrained_model = _load_pretrained(
+        kwargs.pop('checkpoint_path'), kwargs.pop('data_dir'),
+        kwargs['device'])
+    return embed_shard(pretrained_model, **kwargs)
+
+
+def embed(fasta_file, checkpoint_path, data_dir, output_directory,
+          chunk_size=10000, batch_size=32, num_shards=1, shard=None,
+          processes=1, threshold=1024, dtype=np.float16, device='cpu'):
+    """ Precomputes protein embeddings with a pretrained model.
+
+    Parameters
+    ----------
+    fasta_file : filepath
+        Fasta file of sequences of interest.
+    checkpoint_path : path
+        Path for roberta model.
+    data_dir : path
+        Path to data used for pretraining.
+    output_directory : filepath
+        Directory of the `poplar.model.cache.EmbeddingStore`.
+    chunk_size : int
+        Number of sequences per chunk.
+    batch_size : int
+        Number of sequences passed through the language model at once.
+    num_shards : int
+        Total number of shards.
+    shard : int
+        Index of the shard to process. If this is not specified,
+        all of the shards are processed.
+    processes : int
+        Number of processes to run the shards in. The shards are
+        split across the processes, see `subshards`.
+    threshold : int
+        Maximum sequence length.
+    dtype : np.dtype
+        Data type of the stored embeddings.
+    device : str
+        Name of device to run on.
+
+    Returns
+    -------
+    int
+        Number of sequences that were embedded.
+    """
+    shards, num_shards = subshards(num_shards, shard, processes)
+    if processes <= 1:
+        pretrained_model = _load_pretrained(checkpoint_path, data_dir, device)
+        return sum(
+            embed_shard(pretrained_model, fasta_file, output_directory,
+                        shard=s, num_shards=num_shards,
+                        chunk_size=chunk_size, batch_size=batch_size,
+                        threshold=threshold, dtype=dtype, device=device)
+            for s in shards
+        )
+
+    num_threads = max(1, (os.cpu_count() or 1) // processes)
+    jobs = [
+        dict(checkpoint_path=checkpoint_path, data_dir=data_dir,
+             fasta_file=fasta_file, output_directory=output_directory,
+             shard=s, num_shards=num_shards, chunk_size=chunk_size,
+             batch_size=batch_size, threshold=threshold, dtype=dtype,
+             device=device, num_threads=num_threads)
+        for s in shards
+    ]
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(processes) as pool:
+        return sum(pool.map(_embed_worker, jobs))
@@ -1,51 +1,261 @@
+import itertools
 import numpy as np
 import pandas as pd
-import torch
-from poplar.util import encode, tokenize
+
+
+def _batches(iterable, batch_size):
+    """ Splits an iterable into lists of `batch_size` items. """
+    iterable = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterable, batch_size))
+        if len(batch) == 0:
+            return
+        yield batch
+
+
+def _predict_pairs(binding_model, dataloader, pairs):
+    """ Scores each unique pair of proteins once.
+
+    Parameters
+    ----------
+    binding_model : popular.model
+       Binding prediction model.
+    dataloader : poplar.dataset.interactions.ValidationDataset
+       Dataset that the sequence store rows refer to.
+    pairs : np.array
+       Sequence store rows of (protein 1, candidate) pairs.
+
+    Returns
+    -------
+    np.array : score of each pair
+    """
+    import torch
+    uniq_pairs, pair_inv = np.unique(pairs, axis=0, return_inverse=True)
+    # each unique protein is only encoded once
+    uniq, inv = np.unique(uniq_pairs, return_inverse=True)
+    emb = binding_model.encode(dataloader.sequences(uniq))
+    inv = torch.from_numpy(inv.reshape(uniq_pairs.shape)).to(emb.device)
+    score = binding_model.predict(emb[inv[:, 0]], emb[inv[:, 1]])
+    score = score.view(-1).cpu().numpy()
+    return score[pair_inv.reshape(-1)]
+
+
+def score_pairs(binding_model, dataloader, batch_size=1000):
+    """ Scores the positive and negative pairs of a validation dataset.
+
+    Each positive link and each negative draw is scored exactly once,
+    and triples are scored in batches of `batch_size`.
+
+    Parameters
+    ----------
+    binding_model : popular.model
+       Binding prediction model.
+    dataloader : poplar.dataset.interactions.ValidationDataset
+       Dataset iterator for test/validation ppi dataset.
+    batch_size : int
+       Number of triples to score at once.
+
+    Returns
+    -------
+    generator of pd.DataFrame
+       Scores of each batch, with columns `taxon`, `protein`
+       (id of protein 1), `link` (row of the positive link in the
+       links table),
+       `label` (1 for the positive link, 0 for negative draws)
+       and `score`.
+    """
+    import torch
+    last = None
+    with torch.no_grad():
+        for batch in _batches(dataloader, batch_size):
+            gene, pos, rnd, tax, protid, link = map(np.array, zip(*batch))
+            # the negative draws of a link are consecutive, and
+            # may be split across batches
+            new = np.ones(len(batch), dtype=bool)
+            new[1:] = link[1:] != link[:-1]
+            new[0] = link[0] != last
+            last = link[-1]
+
+            pairs = np.concatenate([
+                np.stack([gene[new], pos[new]], axis=1),
+                np.stack([gene, rnd], axis=1)])
+            score = _predict_pairs(binding_model, dataloader, pairs)
+            yield pd.DataFrame({
+                'taxon': np.concatenate([tax[new], tax]),
+                'protein': np.concatenate([protid[new], protid]),
+                'link': np.concatenate([link[new], link]),
+                'label': np.concatenate([
+                    np.ones(new.sum(), dtype=np.uint8),
+                    np.zeros(len(batch), dtype=np.uint8)]),
+                'score': score.astype(np.float32)
+            })
+
+
+class ScoreTable(object):
+    """ Columnar table of scores, from which all metrics are computed.
+
+    The table can be built incrementally, as batches stream out of
+    `score_pairs`, and the metrics can be computed at any point.
+    """
+    def __init__(self, chunks=None):
+        self.chunks = list(chunks) if chunks is not None else []
+        self._frame = None
+
+    @classmethod
+    def from_model(cls, binding_model, dataloader, batch_size=1000):
+        """ Scores a validation dataset in a single pass. """
+        return cls(score_pairs(binding_model, dataloader, batch_size))
+
+    def update(self, chunk):
+        """ Adds a batch of scores. """
+        self.chunks.append(chunk)
+        self._frame = None
+
+    @property
+    def frame(self):
+        if self._frame is None:
+            if len(self.chunks) == 0:
+                self._frame = pd.DataFrame(
+                    columns=['taxon', 'protein', 'link', 'label', 'score'])
+            else:
+                self._frame = pd.concat(self.chunks, ignore_index=True)
+        return self._frame
+
+    def links(self):
+        """ Per link statistics.
+
+        Returns
+        -------
+        pd.DataFrame
+            Table indexed by link, with the `taxon`, `protein`, the
+            `rank` of the positive among its negatives and the
+            fraction of negatives that it scores higher than (`pairwise`).
+        """
+        df = self.frame
+        pos = df.loc[df['label'] == 1].set_index('link')
+        neg = df.loc[df['label'] == 0]
+        pos_score = pos['score'].reindex(neg['link']).values
+        neg = neg.assign(beats=neg['score'].values > pos_score,
+                         loses=neg['score'].values < pos_score)
+        grouped = neg.groupby('link')
+        res = pos[['taxon', 'protein']].copy()
+        res['rank'] = 1 + grouped['beats'].sum().reindex(
+            res.index, fill_value=0)
+        res['pairwise'] = grouped['loses'].mean().reindex(res.index)
+        res['draws'] = grouped.size().reindex(res.index, fill_value=0)
+        return res
+
+    def proteins(self):
+        """ Per protein ROC AUC.
+
+        The AUC of each protein 1 is computed from the ranks of the
+        scores of its positive links and negative draws.
+
+        Returns
+        -------
+        pd.DataFrame
+            Table indexed by (`taxon`, `protein`) with the `roc_auc`.
+        """
+        df = self.frame
+        groups = ['taxon', 'protein']
+        df = df.assign(r=df.groupby(groups)['score'].rank())
+        df = df.assign(pos_r=df['r'] * df['label'])
+        stats = df.groupby(groups).agg(
+            n_pos=('label', 'sum'), n=('label', 'size'),
+            pos_r=('pos_r', 'sum'))
+        n_pos = stats['n_pos'].astype(np.float64)
+        n_neg = stats['n'] - n_pos
+        u = stats['pos_r'] - n_pos * (n_pos + 1) / 2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            auc = u / (n_pos * n_neg)
+        return pd.DataFrame({'roc_auc': auc.replace(np.inf, np.nan)})
+
+    def mrr(self):
+        return (1 / self.links()['rank']).mean()
+
+    def roc_auc(self):
+        return self.proteins()['roc_auc'].mean()
+
+    def pairwise_auc(self):
+        links = self.links()
+        # weight each link by its number of negative draws
+        return ((links['pairwise'] * links['draws']).sum() /
+                max(links['draws'].sum(), 1))
+
+    def taxon_mrr(self):
+        links = self.links()
+        res = (1 / links['rank']).groupby(links['taxon']).mean()
+        return res.to_frame('mrr')
+
+    def taxon_roc_auc(self):
+        res = self.proteins()['roc_auc'].groupby(level='taxon').mean()
+        return res.to_frame('roc_auc')
+
+    def taxon_pairwise_auc(self):
+        links = self.links()
+        wins = (links['pairwise'] * links['draws']).groupby(
+            links['taxon']).sum()
+        draws = links['draws'].groupby(links['taxon']).sum()
+        return (wins / draws).to_frame('pairwise_auc')
+
+    def taxon_metrics(self):
+        """ All of the taxon specific metrics in one table. """
+        return pd.concat([self.taxon_mrr(), self.taxon_roc_auc(),
+                          self.taxon_pairwise_auc()], axis=1)
 
 
 # Global evaluation metrics
 # these are used mainly for testing evaluation
-def mrr(model, dataloader):
+def mrr(model, dataloader, batch_size=1000):
     """ Mean reciprocial ranking.
 
+    The rank of each positive link is computed among the negative
+    draws for that link.
+
     Parameters
     ----------
     model : popular.model
        Model to be evaluated
-    dataloader : torch.DataLoader
-       Pytorch dataloader.
+    dataloader : poplar.dataset.interactions.ValidationDataset
+       Dataset iterator for test/validation ppi dataset.
+    batch_size : int
+       Number of triples to score at once.
 
     Returns
     -------
     float : mean reciprocial ranking
     """
-    pass
+    return ScoreTable.from_model(model, dataloader, batch_size).mrr()
+
 
-def roc_auc(model, dataloader, k=10):
+def roc_auc(model, dataloader, k=10, batch_size=1000):
     """ ROC AUC
 
+    The AUC is computed for each protein 1, from the scores of its
+    positive links and negative draws, and averaged across proteins.
+
     Parameters
     ----------
     model : popular.model
        Model to be evaluated
-    dataloader : torch.DataLoader
-       Pytorch dataloader for validation data
+    dataloader : poplar.dataset.interactions.ValidationDataset
+       Dataset iterator for test/validation ppi dataset, which
+       is sorted by (1) taxonomy then by (2) protein1.
+    k : int
+       Not used. The number of negative draws is set by the dataset.
+    batch_size : int
+       Number of triples to score at once.
 
     Returns
     -------
     float : average AUC
-
-    TODO
-    ----
-    Make sure that the test/validation dataset are
-    sorted by (1) taxonomy then by (2) protein1.
     """
-    pass
+    return ScoreTable.from_model(model, dataloader, batch_size).roc_auc()
+
 
 def pairwise_auc(binding_model,
                  dataloader, name, it, writer,
-                 device='cpu'):
+                 device='cpu', batch_size=1000):
     """ Pairwise AUC comparison
 
     Parameters
@@ -64,80 +274,82 @@ def pairwise_auc(binding_model,
        Tensorboard writer.
     device : str
        Device name to transfer model data to.
+    batch_size : int
+       Number of triples to score at once. Each unique protein
+       in a batch is only encoded once.
 
     Returns
     -------
     float : average AUC
     """
-    with torch.no_grad():
-        rank_counts = 0
-        for j, (gene, pos, rnd, tax, protid) in enumerate(dataloader):
-            gv = binding_model.encode([gene])
-            pv = binding_model.encode([pos])
-            nv = binding_model.encode([rnd])
-            pred_pos = binding_model.predict(gv, pv)
-            pred_neg = binding_model.predict(gv, nv)
-            score = torch.sum(pred_pos > pred_neg).item()
-            rank_counts += score
-
-        tpr = rank_counts / j
-        print(f'rank_counts {rank_counts}, tpr {tpr}, iteration {it}')
-        writer.add_scalar(f'{name}/pairwise/TPR', tpr, it)
-
+    table = ScoreTable.from_model(binding_model, dataloader, batch_size)
+    links = table.links()
+    rank_counts = int(round((links['pairwise'] * links['draws']).sum()))
+    tpr = table.pairwise_auc()
+    print(f'rank_counts {rank_counts}, tpr {tpr}, iteration {it}')
+    writer.add_scalar(f'{name}/pairwise/TPR', tpr, it)
     return tpr
 
 
 # Taxon specific evaluation metrics
 # these are used mainly for validation evaluation
-def taxon_mrr(model, dataloader):
+def taxon_mrr(model, dataloader, batch_size=1000):
     """ Taxon specific Mean reciprocial ranking.
 
     Parameters
     ----------
     model : popular.model
        Model to be evaluated
-    dataloader : torch.DataLoader
-       Pytorch dataloader.
+    dataloader : poplar.dataset.interactions.ValidationDataset
+       Dataset iterator for test/validation ppi dataset.
+    batch_size : int
+       Number of triples to score at once.
 
     Returns
     -------
-    float : mean reciprocial ranking per taxon
+    pd.DataFrame : mean reciprocial ranking per taxon
     """
-    pass
+    return ScoreTable.from_model(model, dataloader, batch_size).taxon_mrr()
 
-def taxon_roc_auc(model, dataloader, k=10):
+
+def taxon_roc_auc(model, dataloader, k=10, batch_size=1000):
     """ Taxon specific ROC AUC
 
     Parameters
     ----------
     model : popular.model
        Model to be evaluated
-    dataloader : torch.DataLoader
-       Pytorch dataloader.
+    dataloader : poplar.dataset.interactions.ValidationDataset
+       Dataset iterator for test/validation ppi dataset, which
+       is sorted by (1) taxonomy then by (2) protein1.
+    k : int
+       Not used. The number of negative draws is set by the dataset.
+    batch_size : int
+       Number of triples to score at once.
 
     Returns
     -------
-    np.array : average AUC per taxon
-
-    TODO
-    ----
-    Make sure that the test/validation dataset are
-    sorted by (1) taxonomy then by (2) protein1.
+    pd.DataFrame : average AUC per taxon
     """
-    pass
+    table = ScoreTable.from_model(model, dataloader, batch_size)
+    return table.taxon_roc_auc()
+
 
-def taxon_pairwise_auc(model, dataloader):
+def taxon_pairwise_auc(model, dataloader, batch_size=1000):
     """ Taxon specific pairwise AUC comparison
 
     Parameters
     ----------
     model : popular.model
        Model to be evaluated
-    dataloader : torch.DataLoader
-       Pytorch dataloader.
+    dataloader : poplar.dataset.interactions.ValidationDataset
+       Dataset iterator for test/validation ppi dataset.
+    batch_size : int
+       Number of triples to score at once.
 
     Returns
     -------
-    np.array : average AUC per taxon
+    pd.DataFrame : average AUC per taxon
     """
-    pass
+    table = ScoreTable.from_model(model, dataloader, batch_size)
+    return table.taxon_pairwise_auc()
@@ -0,0 +1,222 @@
+import os
+import glob
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import torch
+from poplar.util import to_tokens
+
+
+def sequence_key(x):
+    """ Hash of a sequence, or its uint8 tokens. """
+    tokens = np.ascontiguousarray(to_tokens(x), dtype=np.uint8)
+    return hashlib.sha1(tokens.tobytes()).hexdigest()
+
+
+def model_fingerprint(model):
+    """ Hash of the weights of a pretrained model.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        Language model.
+
+    Returns
+    -------
+    str
+        Hex digest that identifies the model checkpoint.
+    """
+    h = hashlib.sha1()
+    for name, value in model.state_dict().items():
+        h.update(name.encode('utf-8'))
+        h.update(str(tuple(value.shape)).encode('utf-8'))
+        h.update(value.detach().cpu().numpy().tobytes())
+    return h.hexdigest()
+
+
+def _nbytes(value):
+    return value.numel() * value.element_size()
+
+
+class EmbeddingStore(object):
+    """ On-disk store of precomputed peptide embeddings.
+
+    The store is a directory of chunks. Each chunk consists of a
+    `.npy` matrix of embeddings, which is memory mapped, and a `.txt`
+    index with the sequence id and sequence hash of each row.
+    Chunks are written atomically, so that partially written chunks
+    are never read.
+    """
+    def __init__(self, path, fingerprint=None):
+        """
+        Parameters
+        ----------
+        path : filepath
+            Directory of the store.
+        fingerprint : str
+            Fingerprint of the model used to compute the embeddings.
+
+        Raises
+        ------
+        ValueError
+            If the store was computed with a different model.
+        """
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        fname = os.path.join(path, 'fingerprint.txt')
+        if os.path.exists(fname):
+            with open(fname) as fh:
+                stored = fh.read().strip()
+            if fingerprint is not None and fingerprint != stored:
+                raise ValueError(
+                    f'Embeddings in {path} were computed with a different '
+                    f'model ({stored} != {fingerprint}).')
+            fingerprint = stored
+        elif fingerprint is not None:
+            with open(fname, 'w') as fh:
+                fh.write(fingerprint)
+        self.fingerprint = fingerprint
+        self.chunks = OrderedDict()
+        self.rows = {}
+        self.refresh()
+
+    def chunk_names(self):
+        """ Names of the chunks that have been completely written. """
+        files = glob.glob(os.path.join(self.path, '*.npy'))
+        return sorted(os.path.basename(f)[:-4] for f in files)
+
+    def has_chunk(self, name):
+        return os.path.exists(os.path.join(self.path, name + '.npy'))
+
+    def refresh(self):
+        """ Opens chunks that were written since the store was opened. """
+        for name in self.chunk_names():
+            if name in self.chunks:
+                continue
+            emb = np.load(os.path.join(self.path, name + '.npy'),
+                          mmap_mode='r')
+            with open(os.path.join(self.path, name + '.txt')) as fh:
+                index = [line.rstrip('\n').split('\t') for line in fh]
+            self.chunks[name] = emb
+            for i, (_, key) in enumerate(index):
+                self.rows[key] = (name, i)
+
+    def write_chunk(self, name, ids, keys, embeddings):
+        """ Atomically writes a chunk of embeddings.
+
+        Parameters
+        ----------
+        name : str
+            Name of the chunk.
+        ids : list of str
+            Sequence ids.
+        keys : list of str
+            Sequence hashes, see `sequence_key`.
+        embeddings : np.array
+            Matrix of embeddings, one row per sequence.
+        """
+        prefix = os.path.join(self.path, name)
+        with open(prefix + '.txt.tmp', 'w') as fh:
+            for i, k in zip(ids, keys):
+                fh.write(f'{i}\t{k}\n')
+        os.replace(prefix + '.txt.tmp', prefix + '.txt')
+        # the .npy file marks the chunk as complete
+        with open(prefix + '.npy.tmp', 'wb') as fh:
+            np.save(fh, embeddings)
+        os.replace(prefix + '.npy.tmp', prefix + '.npy')
+
+    def ids(self):
+        """ Sequence ids and hashes of all of the stored embeddings. """
+        res = []
+        for name in self.chunks:
+            with open(os.path.join(self.path, name + '.txt')) as fh:
+                res += [line.rstrip('\n').split('\t') for line in fh]
+        return res
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, key):
+        """ Retrieves the embedding of a sequence hash, or None. """
+        if key not in self.rows:
+            return None
+        name, i = self.rows[key]
+        return self.chunks[name][i]
+
+
+class EmbeddingCache(object):
+    """ Cache of peptide embeddings from a frozen language model.
+
+    Embeddings are looked up by sequence hash, first in an in-memory
+    least recently used cache, then in an optional on-disk
+    `EmbeddingStore` of precomputed embeddings.
+    """
+    def __init__(self, fingerprint, capacity=100000, store=None,
+                 max_bytes=None):
+        """
+        Parameters
+        ----------
+        fingerprint : str
+            Fingerprint of the language model, see `model_fingerprint`.
+        capacity : int
+            Maximum number of embeddings held in memory. If this is
+            None, the number of embeddings isn't limited.
+        store : EmbeddingStore
+            Precomputed embeddings (optional).
+        max_bytes : int
+            Maximum size of the embeddings held in memory (optional).
+            This bounds caches of variable sized values, like per
+            residue features.
+
+        Raises
+        ------
+        ValueError
+            If the store was computed with a different model.
+        """
+        if store is not None and store.fingerprint != fingerprint:
+            raise ValueError(
+                'The embedding store was computed with a different model.')
+        self.fingerprint = fingerprint
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.store = store
+        self.lru = OrderedDict()
+        self.nbytes = 0
+        self.hits, self.misses = 0, 0
+
+    def __len__(self):
+        return len(self.lru)
+
+    def get(self, key):
+        """ Retrieves the embedding of a sequence hash, or None. """
+        if key in self.lru:
+            self.lru.move_to_end(key)
+            self.hits += 1
+            return self.lru[key]
+        if self.store is not None:
+            value = self.store.get(key)
+            if value is not None:
+                self.hits += 1
+                value = torch.from_numpy(np.array(value, dtype=np.float32))
+                self.put(key, value)
+                return value
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        """ Adds the embedding of a sequence hash. """
+        if key in self.lru:
+            self.nbytes -= _nbytes(self.lru[key])
+        value = value.detach().cpu()
+        self.lru[key] = value
+        self.lru.move_to_end(key)
+        self.nbytes += _nbytes(value)
+        while len(self.lru) > 0 and (
+                (self.capacity is not None and len(self.lru) > self.capacity)
+                or (self.max_bytes is not None
+                    and self.nbytes > self.max_bytes)):
+            _, old = self.lru.popitem(last=False)
+            self.nbytes -= _nbytes(old)
@@ -1,12 +1,126 @@
+import math
 import torch
 import torch.nn as nn
 import torch.utils as utils
 import torch.nn.functional as F
-from torch.autograd import Variable
+from poplar.util import encode_batch
+from poplar.model.cache import sequence_key
+from poplar.model.ppibinder import padding_index, model_features
+
+
+def contact_mask(mask):
+    """ Residue pairs that are scored.
+
+    Parameters
+    ----------
+    mask : torch.Tensor of torch.bool
+        Residues of each protein that aren't padding, of shape
+        (batch, length).
+
+    Returns
+    -------
+    torch.Tensor of torch.bool
+        Pairs (i, j) with j < i in which neither residue is padding,
+        of shape (batch, length, length).
+    """
+    n = mask.shape[1]
+    tril = torch.ones(n, n, dtype=torch.bool, device=mask.device).tril(-1)
+    return mask.unsqueeze(2) & mask.unsqueeze(1) & tril
+
+
+def residue_features(peptide_model, x, cache=None, padding_idx=None,
+                     max_batch_size=None, device=None,
+                     cache_dtype=torch.float16):
+    """ Extracts the per residue features of a batch of proteins.
+
+    Proteins are passed through the language model whole, in batches
+    sorted by length, see `poplar.model.ppibinder.model_features`. If there is a cache, the features of each
+    protein are only computed once, so the language model must be
+    frozen. Each cached protein takes (length + 1) * dim values of
+    `cache_dtype`, e.g. 2.6 MB for 1024 residues of a 1280
+    dimensional model in half precision.
+
+    Parameters
+    ----------
+    peptide_model : torch.nn.Module
+        Language model with an `extract_features` method.
+    x : list of str or list of np.array
+        Sequences, or their uint8 tokens.
+    cache : poplar.model.cache.EmbeddingCache
+        Per residue features of proteins that were already seen
+        (optional).
+    padding_idx : int
+        Padding token. Defaults to the padding token of the model.
+    max_batch_size : int
+        Maximum number of proteins passed through the language
+        model at once. By default, all of them are.
+    device : str
+        Device that the language model is on.
+    cache_dtype : torch.dtype
+        Precision of the cached features. The features are returned
+        in single precision regardless.
+
+    Returns
+    -------
+    features : torch.Tensor
+        Features of the <s> token and of each residue, padded to the
+        longest protein, of shape (batch, length + 1, dim).
+    mask : torch.Tensor of torch.bool
+        Residues that aren't padding, of shape (batch, length).
+    """
+    if padding_idx is None:
+        padding_idx = padding_index(peptide_model)
+    keys = list(map(sequence_key, x))
+    values = [None] * len(x)
+    if cache is not None:
+        values = list(map(cache.get, keys))
+    missing = {}
+    for i, v in enumerate(values):
+        if v is None:
+            missing.setdefault(keys[i], i)
+
+    computed = {}
+    if len(missing) > 0:
+        seqs = [x[i] for i in missing.values()]
+        tokens, lengths, _ = encode_batch(seqs, padding_idx=padding_idx)
+        if device is not None:
+            tokens = tokens.to(device)
+        order = torch.argsort(lengths)
+        batch_size = max_batch_size or len(seqs)
+        training = peptide_model.training
+        peptide_model.eval()
+        with torch.no_grad():
+            for idx in torch.split(order, batch_size):
+                width = lengths[idx].max().item()
+                f = model_features(
+                    peptide_model, tokens[idx.to(tokens.device), :width])
+                for k, i in enumerate(idx.tolist()):
+                    computed[i] = f[k, :lengths[i] + 1]
+        peptide_model.train(training)
+        computed = dict(zip(missing.keys(),
+                            [computed[i] for i in range(len(seqs))]))
+        if cache is not None:
+            for k, v in computed.items():
+                cache.put(k, v.to(cache_dtype))
+    values = [computed[k] if v is None else v
+              for k, v in zip(keys, values)]
+
+    lengths = torch.tensor([len(v) - 1 for v in values])
+    width = lengths.max().item() if len(values) > 0 else 0
+    dim = values[0].shape[-1] if len(values) > 0 else 0
+    features = torch.zeros(len(values), width + 1, dim, device=device)
+    for i, v in enumerate(values):
+        features[i, :len(v)] = v.to(features.device)
+    mask = torch.arange(width) < lengths.unsqueeze(1)
+    return features, mask.to(features.device)
 
 
 class ContactMapLinear(nn.Module):
-    """ Simple contact map prediction. """
+    """ Simple contact map prediction.
+
+    The contact score of residues i and j is the low rank bilinear
+    form x_i P Q x_j, which is computed for all pairs at once.
+    """
     def __init__(self, input_dim, inner_dim):
         """
 
@@ -17,30 +131,45 @@ class ContactMapLinear(nn.Module):
         inner_dim : int
             Number of embedding dimensions.
         """
+        super(ContactMapLinear, self).__init__()
         self.input_dim = input_dim
         self.inner_dim = inner_dim
-        self.P = Variable(torch.ones(input_dim, inner_dim))
-        self.Q = Variable(torch.ones(inner_dim, input_dim))
+        initstd = 1 / math.sqrt(input_dim)
+        self.P = nn.Parameter(torch.randn(input_dim, inner_dim) * initstd)
+        self.Q = nn.Parameter(torch.randn(inner_dim, input_dim) * initstd)
 
-    def forward(self, features, **kwargs):
+    def forward(self, features, mask=None, **kwargs):
         """ Predicts contact map.
 
-        Note: make sure that the feature dimensions match.
+        Parameters
+        ----------
+        features : torch.Tensor
+            Per residue features of shape (batch, length + 1, input_dim),
+            starting with the <s> token.
+        mask : torch.Tensor of torch.bool
+            Residues of each protein that aren't padding, of shape
+            (batch, length). By default, there is no padding.
+
+        Returns
+        -------
+        torch.Tensor
+            Contact scores of shape (batch, length, length). Only the
+            pairs in `contact_mask` are scored, the others are zero.
         """
         x = features[:, 1:, :]
-        res = torch.zeros(self.input_dim, self.input_dim)
-        for i in range(self.input_dim):
-            for j in range(i):
-                u = x[:, i, :]
-                v = torch.t(x[:, j, :])
-                res[i, j] = u @ self.P @ self.Q @ v
-        return res
+        if mask is None:
+            mask = torch.ones(x.shape[:2], dtype=torch.bool,
+                              device=x.device)
+        u = x @ self.P
+        v = x @ self.Q.t()
+        res = u @ v.transpose(1, 2)
+        return res.masked_fill(~contact_mask(mask), 0)
 
 
 class ContactMapConstastiveConv(nn.Module):
     """ Convolutional NN with negative sampling. """
     def __init__(self):
-        pass
+        super(ContactMapConstastiveConv, self).__init__()
 
     def forward(self, features, **kwargs):
         pass
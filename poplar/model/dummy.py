@@ -3,9 +3,10 @@ import torch.nn as nn
 import torch.utils as utils
 import torch.nn.functional as F
 import math
+from poplar.model.encoders import PeptideEncoder
 
 
-class DummyModel(nn.Module):
+class DummyModel(PeptideEncoder):
     """ Dummy one-hot encoding model.
 
     See the tutorial below for more details.
@@ -14,25 +15,29 @@ class DummyModel(nn.Module):
     The main purpose of this model is to show how to build a simple
     transformer model.  But also for testing.
     """
-    def __init__(self, input_size, hidden_size, max_length=1024):
-        super(DummyModel, self).__init__()
+    def __init__(self, input_size, hidden_size, max_length=1024,
+                 padding_idx=0):
+        super(DummyModel, self).__init__(hidden_size, max_length,
+                                         padding_idx)
         self.encoder = nn.Embedding(input_size, hidden_size)
         self.decoder = nn.Linear(input_size, hidden_size)
-        self.max_length = max_length
 
-    def extract_features(self, x):
+    def extract_features(self, x, cls_only=False):
+        """ Per residue features, preceded by the average residue.
+
+        See `poplar.model.encoders.PeptideEncoder.extract_features`.
+        """
+        if x.dim() == 1:
+            x = x.view(1, -1)
+        x = x[:, :self.max_length]
         y = self.encoder(x)
-        if len(y.shape) == 2:
-            y = y.view(1, y.shape[0], y.shape[-1])
-        z = y.mean(1)
+        # average over the residues, ignoring padding
+        mask = x.ne(self.padding_idx).unsqueeze(-1).type_as(y)
+        z = (y * mask).sum(1) / mask.sum(1).clamp(min=1)
         z = z.view(y.shape[0], 1, y.shape[-1])
-        u = torch.cat((z, y), 1)
-        # pad with zeros
-        if self.max_length > u.shape[1]:
-            q = self.max_length - u.shape[1]
-            zos = torch.zeros(u.shape[0], q, u.shape[2])
-            u = torch.cat((u, zos), 1)
-        return u
+        if cls_only:
+            return z
+        return torch.cat((z, y), 1)
 
     def forward(self, x):
         y = self.encoder(x)
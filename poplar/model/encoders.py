@@ -0,0 +1,128 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from poplar.util import dictionary, PAD
+
+
+class PeptideEncoder(nn.Module):
+    """ Interface of the language models that encode peptides.
+
+    Encoders take batches of tokens padded with `padding_idx`, and
+    return the features of an <s> token followed by the features of
+    each residue. Only the first `max_length` residues are encoded.
+
+    fairseq's `RobertaModel` returns one feature per input token
+    instead, and doesn't take `cls_only`, so its <s> token is
+    prepended to the tokens, see
+    `poplar.model.ppibinder.model_features`.
+    """
+    def __init__(self, hidden_size, max_length=1024, padding_idx=PAD):
+        """
+        Parameters
+        ----------
+        hidden_size : int
+            Number of dimensions of the features.
+        max_length : int
+            Maximum number of residues.
+        padding_idx : int
+            Padding token.
+        """
+        super(PeptideEncoder, self).__init__()
+        self.hidden_size = hidden_size
+        self.max_length = max_length
+        self.padding_idx = padding_idx
+
+    def attention_mask(self, x):
+        """ Positions of the features that aren't padding.
+
+        Parameters
+        ----------
+        x : torch.Tensor
+            Tokens of shape (batch, length).
+
+        Returns
+        -------
+        torch.Tensor of torch.bool
+            Mask of shape (batch, length + 1), which is True for
+            the <s> token and the residues.
+        """
+        if x.dim() == 1:
+            x = x.view(1, -1)
+        x = x[:, :self.max_length]
+        cls = torch.ones(x.shape[0], 1, dtype=torch.bool, device=x.device)
+        return torch.cat((cls, x.ne(self.padding_idx)), 1)
+
+    def extract_features(self, x, cls_only=False):
+        """ Encodes a batch of peptides.
+
+        Parameters
+        ----------
+        x : torch.Tensor
+            Tokens of shape (batch, length), padded to the longest
+            sequence in the batch.
+        cls_only : bool
+            Only return the <s> token, which skips the per residue
+            features where possible.
+
+        Returns
+        -------
+        torch.Tensor
+            Features of shape (batch, length + 1, hidden_size), or
+            (batch, 1, hidden_size) if `cls_only`. Padded positions
+            are given by `attention_mask`.
+        """
+        raise NotImplementedError
+
+
+class ConvEncoder(PeptideEncoder):
+    """ Convolutional k-mer encoder.
+
+    Residues are embedded and passed through 1D convolutions over
+    windows of `kernel_size` residues, and the <s> token is the
+    average over the residues. This is cheap enough to train
+    alongside `poplar.model.ppibinder.PPIBinder` on a CPU.
+    """
+    def __init__(self, input_size=len(dictionary) + 1, hidden_size=128,
+                 kernel_size=5, num_layers=2, max_length=1024,
+                 padding_idx=PAD):
+        """
+        Parameters
+        ----------
+        input_size : int
+            Number of tokens.
+        hidden_size : int
+            Number of dimensions of the features.
+        kernel_size : int
+            Number of residues in each convolution window (odd).
+        num_layers : int
+            Number of convolutions.
+        max_length : int
+            Maximum number of residues.
+        padding_idx : int
+            Padding token.
+        """
+        super(ConvEncoder, self).__init__(hidden_size, max_length,
+                                          padding_idx)
+        if kernel_size % 2 == 0:
+            raise ValueError(f'kernel_size must be odd, not {kernel_size}')
+        self.embedding = nn.Embedding(input_size, hidden_size,
+                                      padding_idx=padding_idx)
+        self.convs = nn.ModuleList([
+            nn.Conv1d(hidden_size, hidden_size, kernel_size,
+                      padding=kernel_size // 2)
+            for _ in range(num_layers)])
+
+    def extract_features(self, x, cls_only=False):
+        if x.dim() == 1:
+            x = x.view(1, -1)
+        x = x[:, :self.max_length]
+        mask = x.ne(self.padding_idx).unsqueeze(1)
+        h = self.embedding(x).transpose(1, 2)
+        for conv in self.convs:
+            # padding is zeroed, so that it doesn't leak into residues
+            h = F.relu(conv(h)) * mask
+        n = mask.sum(2, keepdim=True).clamp(min=1)
+        z = (h.sum(2, keepdim=True) / n).transpose(1, 2)
+        if cls_only:
+            return z
+        return torch.cat((z, h.transpose(1, 2)), 1)
@@ -1,13 +1,187 @@
+import inspect
 import torch
 import torch.nn as nn
 import torch.utils as utils
 import torch.nn.functional as F
-from poplar.util import encode as encode_f
+from poplar.util import encode_batch, PAD
+from poplar.model.cache import sequence_key
 import math
 
 
+def padding_index(peptide_model):
+    """ Padding token of the language model.
+
+    fairseq models define this in their dictionary, which is
+    used to mask out padded positions.
+    """
+    task = getattr(peptide_model, 'task', None)
+    if task is not None:
+        return task.source_dictionary.pad()
+    return getattr(peptide_model, 'padding_idx', PAD)
+
+
+def bos_index(peptide_model):
+    """ Start token that is prepended to the tokens, or None.
+
+    fairseq models return one feature per input token, so their
+    <s> token is added to get its features first. Poplar's encoders
+    add the features of the <s> token themselves.
+    """
+    task = getattr(peptide_model, 'task', None)
+    if task is not None:
+        return task.source_dictionary.bos()
+    return None
+
+
+def model_features(peptide_model, tokens, **kwargs):
+    """ Extracts the features of an <s> token followed by the
+    features of each residue of a batch of tokens.
+
+    Parameters
+    ----------
+    peptide_model : torch.nn.Module
+        Language model with an `extract_features` method.
+    tokens : torch.Tensor
+        Tokens of shape (batch, length), without an <s> token.
+    **kwargs : dict
+        Arguments of `extract_features`.
+
+    Returns
+    -------
+    torch.Tensor
+        Features of shape (batch, length + 1, dim).
+    """
+    bos = bos_index(peptide_model)
+    if bos is not None:
+        start = torch.full((tokens.shape[0], 1), bos, dtype=tokens.dtype,
+                           device=tokens.device)
+        tokens = torch.cat((start, tokens), 1)
+    return peptide_model.extract_features(tokens, **kwargs)
+
+
+def peptide_ids(x):
+    """ 63 bit hashes of a batch of peptides.
+
+    These identify duplicated peptides within a batch.
+
+    Parameters
+    ----------
+    x : list of str or list of np.array
+        Sequences, or their uint8 tokens.
+
+    Returns
+    -------
+    torch.Tensor of torch.int64
+    """
+    return torch.tensor([int(sequence_key(s)[:15], 16) for s in x],
+                        dtype=torch.int64)
+
+
+def cls_features(peptide_model, tokens):
+    """ Extracts the <s> token features of a batch of tokens.
+
+    Language models whose `extract_features` takes a `cls_only`
+    argument only compute the <s> token, rather than the features
+    of every residue.
+    """
+    params = inspect.signature(peptide_model.extract_features).parameters
+    if 'cls_only' in params:
+        f = model_features(peptide_model, tokens, cls_only=True)
+    else:
+        f = model_features(peptide_model, tokens)
+    return f[:, 0, :]
+
+
+def token_batches(order, lengths, max_batch_size=None, max_tokens=None):
+    """ Splits peptides into batches of at most `max_batch_size`
+    peptides and `max_tokens` padded tokens.
+
+    Parameters
+    ----------
+    order : torch.Tensor
+        Indices of the peptides, in the order that they are batched.
+    lengths : torch.Tensor
+        Length of each peptide.
+    max_batch_size : int
+        Maximum number of peptides per batch (optional).
+    max_tokens : int
+        Maximum number of padded tokens per batch (optional). Peptides
+        that are longer than this get a batch of their own.
+
+    Returns
+    -------
+    list of torch.Tensor
+        Indices of the peptides of each batch.
+    """
+    batch_size = max_batch_size or max(len(order), 1)
+    if max_tokens is None:
+        return list(torch.split(order, batch_size))
+    batches, start, width = [], 0, 0
+    for end, n in enumerate(lengths[order].tolist()):
+        width = max(width, n)
+        size = end - start + 1
+        if size > 1 and (size * width > max_tokens or size > batch_size):
+            batches.append(order[start:end])
+            start, width = end, n
+    if start < len(order):
+        batches.append(order[start:])
+    return batches
+
+
+def batch_features(peptide_model, x, padding_idx=None, max_batch_size=None,
+                   bucket=True, device=None, max_tokens=None):
+    """ Extracts the <s> token features of a batch of peptides.
+
+    Parameters
+    ----------
+    peptide_model : torch.nn.Module
+        Language model with an `extract_features` method.
+    x : list of str or list of np.array
+        Sequences, or their uint8 tokens.
+    padding_idx : int
+        Padding token. Defaults to the padding token of the model.
+    max_batch_size : int
+        Maximum number of peptides passed through the language
+        model at once. By default, all of them are.
+    bucket : bool
+        Sort peptides by length before splitting them into batches,
+        to limit the amount of padding.
+    device : str
+        Device that the language model is on.
+    max_tokens : int
+        Maximum number of padded tokens passed through the language
+        model at once (optional).
+
+    Returns
+    -------
+    torch.Tensor
+        The <s> token representation of each peptide, in the
+        original order.
+    """
+    if padding_idx is None:
+        padding_idx = padding_index(peptide_model)
+    tokens, lengths, _ = encode_batch(x, padding_idx=padding_idx)
+    if device is not None:
+        tokens = tokens.to(device)
+    if bucket:
+        order = torch.argsort(lengths)
+    else:
+        order = torch.arange(len(lengths))
+    y = []
+    for idx in token_batches(order, lengths, max_batch_size, max_tokens):
+        width = lengths[idx].max().item()
+        batch = tokens[idx.to(tokens.device), :width]
+        y.append(cls_features(peptide_model, batch))
+    z = torch.cat(y, 0)
+    # restore the original order
+    z = z[torch.argsort(order).to(z.device)]
+    return z
+
+
 class PPIBinder(nn.Module):
-    def __init__(self, input_size, emb_dimension, peptide_model):
+    def __init__(self, input_size, emb_dimension, peptide_model,
+                 max_batch_size=None, bucket=True, cache=None,
+                 loss='sampled', max_tokens=None):
         """ Initialize model parameters.
 
         Parameters
@@ -18,6 +192,26 @@ class PPIBinder(nn.Module):
             Embedding dimention, typically from 50 to 500.
         peptide_model : torch.nn.Module
             Language model for learning a representation of peptides.
+        max_batch_size : int
+            Maximum number of peptides passed through the language
+            model at once. By default, all of them are.
+        bucket : bool
+            Sort peptides by length before splitting them into batches,
+            to limit the amount of padding.
+        cache : poplar.model.cache.EmbeddingCache
+            Cache of peptide embeddings. This is only used if the
+            weights of the language model are frozen.
+        loss : str
+            'sampled' scores each protein against its own negative
+            sample. 'shared' scores each protein against all of the
+            negative samples and the other positives in the batch,
+            so every protein gets about twice the batch size in
+            negatives from a single matrix multiply.
+        max_tokens : int
+            Maximum number of padded tokens passed through the
+            language model at once (optional). This bounds the
+            negative samples, which are drawn at random lengths, even
+            when the training pairs are batched by length.
 
         Notes
         -----
@@ -33,6 +227,14 @@ class PPIBinder(nn.Module):
         self.u_embeddings = nn.Linear(input_size, emb_dimension)
         self.v_embeddings = nn.Linear(input_size, emb_dimension)
         self.peptide_model = peptide_model
+        self.padding_idx = padding_index(peptide_model)
+        self.max_batch_size = max_batch_size
+        self.max_tokens = max_tokens
+        self.bucket = bucket
+        self.cache = cache
+        if loss not in ('sampled', 'shared'):
+            raise ValueError(f'Unknown loss {loss}')
+        self.loss = loss
         self.init_emb()
 
     def init_emb(self):
@@ -41,12 +243,98 @@ class PPIBinder(nn.Module):
         self.v_embeddings.weight.data.normal_(0, initstd)
 
     def encode(self, x):
-        f = lambda x: self.peptide_model.extract_features(encode_f(x))[:, 0, :]
-        y = list(map(f, x))
-        z = torch.cat(y, 0)
-        return z
+        """ Encodes a batch of peptides.
 
-    def forward(self, pos_u, pos_v, neg_v):
+        If there is an embedding cache and the language model is frozen,
+        only peptides that aren't cached are passed through the
+        language model.
+
+        Parameters
+        ----------
+        x : list of str or list of np.array
+            Sequences, or their uint8 tokens.
+
+        Returns
+        -------
+        torch.Tensor
+            The <s> token representation of each peptide.
+        """
+        frozen = not any(p.requires_grad
+                         for p in self.peptide_model.parameters())
+        if self.cache is None or not frozen:
+            return self.extract_features(x)
+
+        keys = list(map(sequence_key, x))
+        values = list(map(self.cache.get, keys))
+        missing = {}
+        for i, v in enumerate(values):
+            if v is None:
+                missing.setdefault(keys[i], i)
+        if len(missing) > 0:
+            # cached embeddings are computed without dropout
+            training = self.peptide_model.training
+            self.peptide_model.eval()
+            with torch.no_grad():
+                z = self.extract_features([x[i] for i in missing.values()])
+            self.peptide_model.train(training)
+            computed = dict(zip(missing.keys(), z.cpu()))
+            for k, v in computed.items():
+                self.cache.put(k, v)
+            values = [computed[k] if v is None else v
+                      for k, v in zip(keys, values)]
+        weight = self.u_embeddings.weight
+        return torch.stack(values).to(device=weight.device, dtype=weight.dtype)
+
+    def extract_features(self, x):
+        """ Encodes a batch of peptides with the language model.
+
+        Parameters
+        ----------
+        x : list of str or list of np.array
+            Sequences, or their uint8 tokens.
+
+        Returns
+        -------
+        torch.Tensor
+            The <s> token representation of each peptide.
+
+        Notes
+        -----
+        The peptides are padded and passed through the language model
+        in batches, so the language model must ignore its padding token.
+        """
+        return batch_features(
+            self.peptide_model, x, padding_idx=self.padding_idx,
+            max_batch_size=self.max_batch_size, bucket=self.bucket,
+            device=self.u_embeddings.weight.device,
+            max_tokens=self.max_tokens)
+
+    def forward(self, pos_u, pos_v, neg_v=None, u_ids=None, v_ids=None):
+        """ Negative sampling loss.
+
+        Parameters
+        ----------
+        pos_u : torch.Tensor
+            Representations of the proteins of interest.
+        pos_v : torch.Tensor
+            Representations of their interacting proteins.
+        neg_v : torch.Tensor
+            Representations of the negative samples. These can be
+            left out with the 'shared' loss, in which case only the
+            other positives in the batch are used as negatives.
+        u_ids, v_ids : torch.Tensor
+            Ids of the proteins in `pos_u` and `pos_v`, see
+            `peptide_ids`. With the 'shared' loss, these are used to
+            keep the positives of a protein from being counted as its
+            negatives when proteins appear multiple times in a batch.
+
+        Returns
+        -------
+        torch.Tensor
+            Sum of the negative log likelihoods.
+        """
+        if self.loss == 'shared':
+            return self.shared_loss(pos_u, pos_v, neg_v, u_ids, v_ids)
 
         # only take <s> token for pos_u, pos_v, and neg_v
         # this will obtain prot embedding
@@ -70,6 +358,35 @@ class PPIBinder(nn.Module):
             losses += neg_score
         return -1 * losses
 
+    def shared_loss(self, pos_u, pos_v, neg_v=None, u_ids=None, v_ids=None):
+        """ Negative sampling loss with negatives shared across the batch.
+
+        See `forward` for the parameters.
+        """
+        emb_u = self.u_embeddings(pos_u)
+        cand = self.v_embeddings(pos_v)
+        b = cand.shape[0]
+        if neg_v is not None:
+            cand = torch.cat([cand, self.v_embeddings(neg_v)])
+        # score every protein against every candidate
+        score = emb_u @ cand.t()
+        pos_score = torch.diagonal(score[:, :b])
+
+        # the other positives of the batch are negatives, unless they
+        # are the same protein or interact with the same protein
+        mask = torch.ones_like(score, dtype=torch.bool)
+        same = torch.eye(b, dtype=torch.bool, device=score.device)
+        if u_ids is not None:
+            u_ids = u_ids.to(score.device)
+            same |= u_ids.unsqueeze(1) == u_ids.unsqueeze(0)
+        if v_ids is not None:
+            v_ids = v_ids.to(score.device)
+            same |= v_ids.unsqueeze(1) == v_ids.unsqueeze(0)
+        mask[:, :b] = ~same
+        losses = F.logsigmoid(pos_score).sum()
+        losses += F.logsigmoid(-score).masked_fill(~mask, 0).sum()
+        return -1 * losses
+
     def predict(self, x1, x2):
         emb_u = self.u_embeddings(x1)
         emb_v = self.v_embeddings(x2)
@@ -0,0 +1,105 @@
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import numpy.testing as npt
+import torch
+from poplar.util import dictionary, to_tokens
+from poplar.model.dummy import DummyModel
+from poplar.model.cache import (
+    EmbeddingCache, EmbeddingStore, sequence_key, model_fingerprint)
+
+
+class TestFingerprints(unittest.TestCase):
+
+    def test_sequence_key(self):
+        self.assertEqual(sequence_key('MKV'), sequence_key(to_tokens('MKV')))
+        self.assertNotEqual(sequence_key('MKV'), sequence_key('MKA'))
+
+    def test_model_fingerprint(self):
+        torch.manual_seed(0)
+        model1 = DummyModel(len(dictionary), 5)
+        model2 = DummyModel(len(dictionary), 5)
+        self.assertEqual(model_fingerprint(model1), model_fingerprint(model1))
+        self.assertNotEqual(model_fingerprint(model1),
+                            model_fingerprint(model2))
+
+
+class TestEmbeddingStore(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_write_chunk(self):
+        store = EmbeddingStore(self.path, 'abc')
+        emb = np.arange(6, dtype=np.float16).reshape(2, 3)
+        store.write_chunk('00000', ['p1', 'p2'], ['k1', 'k2'], emb)
+        self.assertTrue(store.has_chunk('00000'))
+        self.assertFalse(store.has_chunk('00001'))
+        store.refresh()
+        self.assertEqual(len(store), 2)
+        npt.assert_array_equal(store.get('k2'), emb[1])
+        self.assertIsNone(store.get('k3'))
+
+        # reopen from disk
+        res = EmbeddingStore(self.path)
+        self.assertEqual(res.fingerprint, 'abc')
+        self.assertListEqual(res.ids(), [['p1', 'k1'], ['p2', 'k2']])
+        self.assertIsInstance(res.chunks['00000'], np.memmap)
+
+    def test_fingerprint_mismatch(self):
+        EmbeddingStore(self.path, 'abc')
+        with self.assertRaises(ValueError):
+            EmbeddingStore(self.path, 'xyz')
+
+
+class TestEmbeddingCache(unittest.TestCase):
+
+    def test_lru(self):
+        cache = EmbeddingCache('abc', capacity=2)
+        cache.put('k1', torch.ones(3))
+        cache.put('k2', torch.zeros(3))
+        # k1 is now the most recently used
+        self.assertIsNotNone(cache.get('k1'))
+        cache.put('k3', torch.ones(3))
+        self.assertIsNone(cache.get('k2'))
+        self.assertIsNotNone(cache.get('k1'))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.hits, 2)
+        self.assertEqual(cache.misses, 1)
+
+    def test_max_bytes(self):
+        cache = EmbeddingCache('abc', capacity=None, max_bytes=24)
+        cache.put('k1', torch.ones(3))
+        cache.put('k2', torch.ones(3))
+        self.assertEqual(cache.nbytes, 24)
+        cache.put('k3', torch.ones(2))
+        self.assertIsNone(cache.get('k1'))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.nbytes, 20)
+        # replacing an entry doesn't count it twice
+        cache.put('k3', torch.ones(2))
+        self.assertEqual(cache.nbytes, 20)
+
+    def test_store(self):
+        path = tempfile.mkdtemp()
+        try:
+            store = EmbeddingStore(path, 'abc')
+            emb = np.ones((1, 3), dtype=np.float16)
+            store.write_chunk('00000', ['p1'], ['k1'], emb)
+            store.refresh()
+            cache = EmbeddingCache('abc', store=store)
+            res = cache.get('k1')
+            self.assertEqual(res.dtype, torch.float32)
+            npt.assert_array_equal(res.numpy(), [1, 1, 1])
+            with self.assertRaises(ValueError):
+                EmbeddingCache('xyz', store=store)
+        finally:
+            shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
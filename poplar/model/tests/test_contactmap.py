@@ -0,0 +1,142 @@
+import types
+import torch
+import unittest
+import numpy.testing as npt
+from poplar.model.contactmap import (
+    ContactMapLinear, contact_mask, residue_features)
+from poplar.model.ppibinder import batch_features
+from poplar.model.cache import EmbeddingCache
+from poplar.model.dummy import DummyModel
+from poplar.util import dictionary, encode
+
+
+class TestContactMapLinear(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.model = ContactMapLinear(6, 2)
+
+    def naive(self, x):
+        """ Scores each pair of residues, one at a time. """
+        x = x[:, 1:, :]
+        b, n, _ = x.shape
+        res = torch.zeros(b, n, n)
+        W = self.model.P @ self.model.Q
+        for k in range(b):
+            for i in range(n):
+                for j in range(i):
+                    res[k, i, j] = x[k, i] @ W @ x[k, j]
+        return res
+
+    def test_parameters(self):
+        names = sorted(n for n, _ in self.model.named_parameters())
+        self.assertListEqual(names, ['P', 'Q'])
+        self.assertEqual(self.model.P.shape, (6, 2))
+        self.assertEqual(self.model.Q.shape, (2, 6))
+
+    def test_forward(self):
+        x = torch.randn(3, 8, 6)
+        res = self.model(x)
+        self.assertEqual(res.shape, (3, 7, 7))
+        npt.assert_allclose(res.detach().numpy(),
+                            self.naive(x).detach().numpy(),
+                            rtol=1e-4, atol=1e-6)
+
+    def test_mask(self):
+        x = torch.randn(2, 6, 6)
+        mask = torch.tensor([[True] * 5, [True] * 3 + [False] * 2])
+        res = self.model(x, mask)
+        # the shorter protein is scored as if it wasn't padded
+        exp = self.naive(x[1:, :4])
+        npt.assert_allclose(res[1, :3, :3].detach().numpy(),
+                            exp[0].detach().numpy(), rtol=1e-4, atol=1e-6)
+        self.assertTrue((res[1, 3:] == 0).all())
+        self.assertTrue((res[1, :, 3:] == 0).all())
+
+    def test_contact_mask(self):
+        mask = torch.tensor([[True, True, True, False]])
+        res = contact_mask(mask)[0]
+        exp = torch.tensor([[0, 0, 0, 0],
+                            [1, 0, 0, 0],
+                            [1, 1, 0, 0],
+                            [0, 0, 0, 0]], dtype=torch.bool)
+        self.assertTrue(torch.equal(res, exp))
+
+    def test_backward(self):
+        x = torch.randn(2, 5, 6)
+        self.model(x).sum().backward()
+        self.assertIsNotNone(self.model.P.grad)
+        self.assertIsNotNone(self.model.Q.grad)
+
+
+class TokenModel(torch.nn.Module):
+    """ Stands in for fairseq's RobertaModel, which returns one feature
+    per input token and doesn't add an <s> token. """
+    def __init__(self, num_tokens, dim, bos=30, pad=0):
+        super(TokenModel, self).__init__()
+        self.embedding = torch.nn.Embedding(num_tokens, dim)
+        dictionary = types.SimpleNamespace(bos=lambda: bos, pad=lambda: pad)
+        self.task = types.SimpleNamespace(source_dictionary=dictionary)
+
+    def extract_features(self, tokens):
+        return self.embedding(tokens)
+
+
+class TestResidueFeatures(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.model = DummyModel(len(dictionary) + 1, 4)
+        self.seqs = ['MKVLA', 'GG', 'MKVLAWQ']
+
+    def test_features(self):
+        res, mask = residue_features(self.model, self.seqs,
+                                     max_batch_size=2)
+        self.assertEqual(res.shape, (3, 8, 4))
+        self.assertEqual(mask.sum(1).tolist(), [5, 2, 7])
+        for i, s in enumerate(self.seqs):
+            exp = self.model.extract_features(encode(s))[0, :len(s) + 1]
+            npt.assert_allclose(res[i, :len(s) + 1].detach().numpy(),
+                                exp.detach().numpy(), rtol=1e-5)
+            self.assertTrue((res[i, len(s) + 1:] == 0).all())
+
+    def test_token_features(self):
+        model = TokenModel(32, 4)
+        res, mask = residue_features(model, self.seqs, max_batch_size=2)
+        self.assertEqual(res.shape, (3, 8, 4))
+        self.assertEqual(mask.sum(1).tolist(), [5, 2, 7])
+        bos = model.embedding.weight[30].detach().numpy()
+        for i, s in enumerate(self.seqs):
+            # the <s> token is prepended, so no residue is dropped
+            exp = model.embedding(encode(s)).detach().numpy()
+            npt.assert_allclose(res[i, 0].detach().numpy(), bos)
+            npt.assert_allclose(res[i, 1:len(s) + 1].detach().numpy(), exp)
+        pred = ContactMapLinear(4, 2)(res, mask)
+        self.assertEqual(pred.shape, (3, 7, 7))
+        res = batch_features(model, self.seqs, max_batch_size=2)
+        for i in range(3):
+            npt.assert_allclose(res[i].detach().numpy(), bos)
+
+    def test_cache(self):
+        cache = EmbeddingCache('dummy')
+        exp, _ = residue_features(self.model, self.seqs, cache=cache)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.misses, 3)
+        res, _ = residue_features(self.model, self.seqs[::-1], cache=cache)
+        self.assertEqual(cache.hits, 3)
+        self.assertEqual(res.dtype, torch.float32)
+        npt.assert_allclose(res[2, :6].numpy(), exp[0, :6].numpy(),
+                            rtol=1e-2, atol=1e-3)
+
+    def test_cache_bytes(self):
+        # 'MKVLAWQ' takes 8 * 4 values of 2 bytes
+        cache = EmbeddingCache('dummy', capacity=None, max_bytes=64)
+        residue_features(self.model, self.seqs, cache=cache)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.nbytes, 64)
+        self.assertEqual(next(iter(cache.lru.values())).dtype,
+                         torch.float16)
+
+
+if __name__ == '__main__':
+    unittest.main()
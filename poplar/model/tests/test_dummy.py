@@ -0,0 +1,39 @@
+import torch
+import unittest
+import numpy.testing as npt
+from poplar.model.dummy import DummyModel
+from poplar.model.ppibinder import cls_features
+from poplar.util import dictionary, encode_batch
+
+
+class TestDummyModel(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.model = DummyModel(len(dictionary) + 1, 4)
+        self.tokens, self.lengths, _ = encode_batch(['MKVLA', 'GG'])
+
+    def test_extract_features(self):
+        res = self.model.extract_features(self.tokens)
+        # only padded to the longest sequence in the batch
+        self.assertEqual(res.shape, (2, 6, 4))
+        exp = self.model.extract_features(self.tokens[1:, :2])
+        npt.assert_allclose(res[1, :3].detach().numpy(),
+                            exp[0].detach().numpy(), rtol=1e-6)
+
+    def test_attention_mask(self):
+        res = self.model.attention_mask(self.tokens)
+        self.assertEqual(res.sum(1).tolist(), [6, 3])
+        self.assertTrue(res[:, 0].all())
+
+    def test_cls_only(self):
+        res = self.model.extract_features(self.tokens, cls_only=True)
+        self.assertEqual(res.shape, (2, 1, 4))
+        exp = self.model.extract_features(self.tokens)[:, :1]
+        npt.assert_allclose(res.detach().numpy(), exp.detach().numpy())
+        npt.assert_allclose(cls_features(self.model, self.tokens)
+                            .detach().numpy(), exp[:, 0].detach().numpy())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import torch
+import unittest
+import numpy.testing as npt
+from poplar.model.encoders import ConvEncoder, PeptideEncoder
+from poplar.model.ppibinder import PPIBinder, batch_features
+from poplar.util import encode_batch
+
+
+class TestConvEncoder(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.model = ConvEncoder(hidden_size=8, kernel_size=3)
+        self.tokens, _, _ = encode_batch(['MKVLAWQ', 'GGR'])
+
+    def test_interface(self):
+        self.assertIsInstance(self.model, PeptideEncoder)
+        self.assertEqual(self.model.hidden_size, 8)
+        with self.assertRaises(ValueError):
+            ConvEncoder(kernel_size=4)
+
+    def test_extract_features(self):
+        res = self.model.extract_features(self.tokens)
+        self.assertEqual(res.shape, (2, 8, 8))
+        mask = self.model.attention_mask(self.tokens)
+        self.assertEqual(mask.sum(1).tolist(), [8, 4])
+        # padding doesn't change the features of the shorter peptide
+        exp = self.model.extract_features(self.tokens[1:, :3])
+        npt.assert_allclose(res[1, :4].detach().numpy(),
+                            exp[0].detach().numpy(), rtol=1e-5, atol=1e-6)
+        self.assertTrue((res[1, 4:] == 0).all())
+
+    def test_cls_only(self):
+        res = self.model.extract_features(self.tokens, cls_only=True)
+        exp = self.model.extract_features(self.tokens)[:, :1]
+        npt.assert_allclose(res.detach().numpy(), exp.detach().numpy())
+
+    def test_max_length(self):
+        model = ConvEncoder(hidden_size=8, kernel_size=3, max_length=4)
+        res = model.extract_features(self.tokens)
+        self.assertEqual(res.shape, (2, 5, 8))
+        self.assertEqual(model.attention_mask(self.tokens).shape, (2, 5))
+
+    def test_ppibinder(self):
+        binder = PPIBinder(8, 4, self.model)
+        seqs = ['MKVLAWQ', 'GGR', 'PPAK']
+        x = binder.encode(seqs)
+        exp = batch_features(self.model, seqs)
+        npt.assert_allclose(x.detach().numpy(), exp.detach().numpy(),
+                            rtol=1e-5)
+        # the encoder is trained alongside the interaction model
+        loss = binder(x[:1], x[1:2], x[2:])
+        loss.backward()
+        self.assertIsNotNone(self.model.embedding.weight.grad)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,8 +2,9 @@ import torch
 import unittest
 import numpy as np
 import numpy.testing as npt
-from poplar.model.ppibinder import PPIBinder
+from poplar.model.ppibinder import PPIBinder, peptide_ids, token_batches
 from poplar.model.dummy import DummyModel
+from poplar.model.cache import EmbeddingCache
 from poplar.util import dictionary, encode
 
 
@@ -123,6 +124,122 @@ class TestPPIBinder(unittest.TestCase):
         exp = np.array(108 * num_neg * batch, dtype=np.float32)
         self.assertAlmostEqual(res, exp, places=4)
 
+    def test_encode(self):
+        torch.manual_seed(0)
+        peptide_model = DummyModel(self.input_size, self.dim)
+        model = PPIBinder(self.dim, self.emb, peptide_model)
+        seqs = ['IKVNERAKGVEG', 'RAYDM', 'MKVLAAGIVGLLLA', 'DY']
+        exp = torch.cat([
+            peptide_model.extract_features(encode(x))[:, 0, :]
+            for x in seqs
+        ])
+        for max_batch_size in [None, 1, 3]:
+            for bucket in [True, False]:
+                for max_tokens in [None, 1, 20]:
+                    model.max_batch_size = max_batch_size
+                    model.bucket = bucket
+                    model.max_tokens = max_tokens
+                    res = model.encode(seqs)
+                    npt.assert_allclose(res.detach().numpy(),
+                                        exp.detach().numpy(), rtol=1e-6)
+
+    def test_token_batches(self):
+        lengths = torch.tensor([2, 5, 12, 14, 3])
+        order = torch.argsort(lengths)
+        res = token_batches(order, lengths, max_tokens=20)
+        self.assertListEqual([b.tolist() for b in res],
+                             [[0, 4, 1], [2], [3]])
+        for b in res:
+            self.assertLessEqual(len(b) * lengths[b].max().item(),
+                                 max(20, lengths[b].max().item()))
+        res = token_batches(order, lengths, max_batch_size=2,
+                            max_tokens=100)
+        self.assertListEqual([b.tolist() for b in res],
+                             [[0, 4], [1, 2], [3]])
+        res = token_batches(order, lengths, max_batch_size=2)
+        self.assertListEqual([b.tolist() for b in res],
+                             [[0, 4], [1, 2], [3]])
+
+    def test_encode_cache(self):
+        torch.manual_seed(0)
+        peptide_model = DummyModel(self.input_size, self.dim)
+        for param in peptide_model.parameters():
+            param.requires_grad = False
+        cache = EmbeddingCache('dummy', capacity=10)
+        model = PPIBinder(self.dim, self.emb, peptide_model, cache=cache)
+        seqs = ['IKVNERAKGVEG', 'RAYDM', 'IKVNERAKGVEG']
+        exp = model.extract_features(seqs)
+        res = model.encode(seqs)
+        npt.assert_allclose(res.numpy(), exp.numpy(), rtol=1e-6)
+        # duplicated peptides are only encoded once
+        self.assertEqual(len(cache), 2)
+        res = model.encode(seqs[::-1])
+        npt.assert_allclose(res.numpy(), exp.numpy()[::-1], rtol=1e-6)
+        self.assertEqual(cache.hits, 3)
+
+
+class TestSharedLoss(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.dim, self.emb = 5, 3
+        peptide_model = DummyModel(len(dictionary), self.dim)
+        self.model = PPIBinder(self.dim, self.emb, peptide_model,
+                               loss='shared')
+
+    def naive_loss(self, u, v, n, same):
+        """ Scores each protein against each candidate, one at a time. """
+        eu = self.model.u_embeddings(u)
+        cand = torch.cat([self.model.v_embeddings(v),
+                          self.model.v_embeddings(n)])
+        loss = 0
+        for i in range(len(u)):
+            loss -= torch.nn.functional.logsigmoid(eu[i] @ cand[i])
+            for j in range(len(cand)):
+                if j < len(u) and same[i][j]:
+                    continue
+                loss -= torch.nn.functional.logsigmoid(-(eu[i] @ cand[j]))
+        return loss
+
+    def test_shared_loss(self):
+        u, v, n = torch.randn(4, self.dim), torch.randn(4, self.dim), \
+            torch.randn(2, self.dim)
+        res = self.model(u, v, n)
+        exp = self.naive_loss(u, v, n, np.eye(4, dtype=bool))
+        self.assertAlmostEqual(res.item(), exp.item(), places=4)
+
+    def test_shared_loss_no_negatives(self):
+        u, v = torch.randn(4, self.dim), torch.randn(4, self.dim)
+        res = self.model(u, v)
+        exp = self.naive_loss(u, v, torch.zeros(0, self.dim),
+                              np.eye(4, dtype=bool))
+        self.assertAlmostEqual(res.item(), exp.item(), places=4)
+
+    def test_shared_loss_duplicates(self):
+        genes = ['MKV', 'MKV', 'RAYDM', 'DY']
+        pos = ['IKVN', 'RAYDM', 'DY', 'IKVN']
+        u, v = torch.randn(4, self.dim), torch.randn(4, self.dim)
+        n = torch.randn(3, self.dim)
+        u_ids, v_ids = peptide_ids(genes), peptide_ids(pos)
+        self.assertEqual(u_ids[0], u_ids[1])
+        res = self.model(u, v, n, u_ids, v_ids)
+        same = np.array([[a == b or c == d for b, d in zip(genes, pos)]
+                         for a, c in zip(genes, pos)])
+        exp = self.naive_loss(u, v, n, same)
+        self.assertAlmostEqual(res.item(), exp.item(), places=4)
+
+    def test_sampled_loss_unchanged(self):
+        u, v, n = torch.randn(4, self.dim), torch.randn(4, self.dim), \
+            torch.randn(4, self.dim)
+        self.model.loss = 'sampled'
+        eu = self.model.u_embeddings(u)
+        ev, en = self.model.v_embeddings(v), self.model.v_embeddings(n)
+        F = torch.nn.functional
+        exp = -(F.logsigmoid((eu * ev).sum(1)).sum() +
+                F.logsigmoid(-(eu * en).sum(1)).sum())
+        self.assertAlmostEqual(self.model(u, v, n).item(), exp.item(),
+                               places=4)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,296 @@
+import os
+import heapq
+import shutil
+import tempfile
+import itertools
+import multiprocessing
+import numpy as np
+from poplar.util import check_random_state
+
+
+def _read_lines(files):
+    """ Streams the lines of multiple files. """
+    for fname in files:
+        with open(fname) as fh:
+            for line in fh:
+                if not line.strip():
+                    continue
+                if not line.endswith('\n'):
+                    line += '\n'
+                yield line
+
+
+def _blocks(lines, buffer_size):
+    """ Splits a stream of lines into lists of `buffer_size` lines. """
+    lines = iter(lines)
+    while True:
+        block = list(itertools.islice(lines, buffer_size))
+        if len(block) == 0:
+            return
+        yield block
+
+
+def link_key(line):
+    """ Sort key of a links file line: (taxonomy, protein 1). """
+    fields = line.split()
+    return int(fields[3]), fields[0]
+
+
+def _shuffle_bucket(args):
+    fname, seed = args
+    with open(fname) as fh:
+        lines = fh.readlines()
+    state = check_random_state(seed)
+    order = state.permutation(len(lines))
+    with open(fname, 'w') as fh:
+        fh.writelines(lines[i] for i in order)
+    return fname
+
+
+def _sort_run(args):
+    block, fname = args
+    block.sort(key=link_key)
+    with open(fname, 'w') as fh:
+        fh.writelines(block)
+    return fname
+
+
+def _scatter(lines, directory, num_buckets, state, buffer_size,
+             max_open_files):
+    """ Scatters lines at random across `num_buckets` files.
+
+    If there are more than `max_open_files` buckets, the lines are
+    scattered across `max_open_files` files first, and each of those
+    is scattered again, so that each line still ends up in a bucket
+    drawn uniformly at random.
+
+    Returns
+    -------
+    list of filepath
+        The buckets.
+    """
+    width = min(num_buckets, max_open_files)
+    buckets = [os.path.join(directory, f'bucket_{i:05d}')
+               for i in range(width)]
+    handles = [open(b, 'w') for b in buckets]
+    try:
+        for block in _blocks(lines, buffer_size):
+            for line, i in zip(block, state.randint(width, size=len(block))):
+                handles[i].write(line)
+    finally:
+        for fh in handles:
+            fh.close()
+    if width == num_buckets:
+        return buckets
+    res = []
+    for b in buckets:
+        subdir = b + '_'
+        os.mkdir(subdir)
+        res += _scatter(_read_lines([b]), subdir,
+                        int(np.ceil(num_buckets / width)), state,
+                        buffer_size, max_open_files)
+        os.remove(b)
+    return res
+
+
+def _merge(runs, output_file):
+    """ Merges sorted runs into a single sorted file. """
+    handles = [open(r) for r in runs]
+    try:
+        with open(output_file, 'w') as fh:
+            fh.writelines(heapq.merge(*handles, key=link_key))
+    finally:
+        for h in handles:
+            h.close()
+    return output_file
+
+
+def _map_bounded(f, jobs, processes):
+    """ Applies `f` to jobs, with at most `processes` jobs in flight.
+
+    Unlike `pool.imap`, this doesn't read ahead in `jobs`, so only a
+    bounded number of blocks are held in memory at once.
+    """
+    if processes <= 1:
+        return list(map(f, jobs))
+    res, pending = [], []
+    with multiprocessing.get_context('spawn').Pool(processes) as pool:
+        for job in jobs:
+            if len(pending) >= processes:
+                res.append(pending.pop(0).get())
+            pending.append(pool.apply_async(f, (job,)))
+        res += [p.get() for p in pending]
+    return res
+
+
+def external_shuffle(files, output_directory, split_size=100000,
+                     buffer_size=1000000, processes=1, seed=0,
+                     prefix='train_', max_open_files=256):
+    """ Shuffles links files that may not fit into memory.
+
+    The lines are first scattered at random across temporary buckets
+    of roughly `buffer_size` lines. Each bucket is then shuffled in
+    memory, and the buckets are concatenated and split into files of
+    `split_size` lines.
+
+    Parameters
+    ----------
+    files : list of filepath
+        Links files to combine.
+    output_directory : filepath
+        Directory to write the shuffled links files to.
+    split_size : int
+        Number of lines per output file.
+    buffer_size : int
+        Maximum number of lines held in memory per process.
+    processes : int
+        Number of processes used to shuffle the buckets.
+    seed : int
+        Random seed.
+    prefix : str
+        Prefix of the output file names.
+    max_open_files : int
+        Maximum number of buckets written at once. If there are more
+        buckets, the lines are scattered in multiple passes.
+
+    Returns
+    -------
+    list of filepath
+        The output files.
+
+    Raises
+    ------
+    ValueError
+        If `max_open_files` is less than 2.
+    """
+    from poplar.dataset.links import count_lines
+    if max_open_files < 2:
+        raise ValueError('max_open_files must be at least 2, '
+                         f'not {max_open_files}')
+    os.makedirs(output_directory, exist_ok=True)
+    total = sum(map(count_lines, files))
+    num_buckets = max(1, int(np.ceil(total / buffer_size)))
+    state = check_random_state(seed)
+    tmpdir = tempfile.mkdtemp(dir=output_directory)
+    try:
+        buckets = _scatter(_read_lines(files), tmpdir, num_buckets, state,
+                           buffer_size, max_open_files)
+
+        jobs = [(b, state.randint(2 ** 31)) for b in buckets]
+        _map_bounded(_shuffle_bucket, jobs, processes)
+
+        outputs = []
+        for i, block in enumerate(_blocks(_read_lines(buckets), split_size)):
+            fname = os.path.join(output_directory, f'{prefix}{i:05d}.txt')
+            with open(fname, 'w') as fh:
+                fh.writelines(block)
+            outputs.append(fname)
+    finally:
+        shutil.rmtree(tmpdir)
+    return outputs
+
+
+def external_sort(files, output_file, buffer_size=1000000, processes=1,
+                  max_open_files=256):
+    """ Sorts links files by (taxonomy, protein 1) in bounded memory.
+
+    Blocks of `buffer_size` lines are sorted in parallel and written
+    to temporary runs, which are then merged. If there are more than
+    `max_open_files` runs, they are merged in multiple passes.
+
+    Parameters
+    ----------
+    files : list of filepath
+        Links files to combine.
+    output_file : filepath
+        Sorted links file.
+    buffer_size : int
+        Maximum number of lines held in memory per process.
+    processes : int
+        Number of processes used to sort the blocks.
+    max_open_files : int
+        Maximum number of runs merged at once.
+
+    Returns
+    -------
+    filepath
+        The output file.
+
+    Raises
+    ------
+    ValueError
+        If `max_open_files` is less than 2.
+    """
+    if max_open_files < 2:
+        raise ValueError('max_open_files must be at least 2, '
+                         f'not {max_open_files}')
+    outdir = os.path.dirname(os.path.abspath(output_file))
+    os.makedirs(outdir, exist_ok=True)
+    tmpdir = tempfile.mkdtemp(dir=outdir)
+    try:
+        jobs = (
+            (block, os.path.join(tmpdir, f'run_{i:05d}'))
+            for i, block in enumerate(
+                _blocks(_read_lines(files), buffer_size))
+        )
+        runs = _map_bounded(_sort_run, jobs, processes)
+        # consecutive runs are merged, which keeps the sort stable
+        level = 0
+        while len(runs) > max_open_files:
+            runs = [
+                _merge(runs[i:i + max_open_files],
+                       os.path.join(tmpdir, f'merge_{level}_{i:05d}'))
+                for i in range(0, len(runs), max_open_files)]
+            level += 1
+        _merge(runs, output_file)
+    finally:
+        shutil.rmtree(tmpdir)
+    return output_file
+
+
+def preprocess(training_links, testing_links, validation_links,
+               output_directory, split_size=100000, buffer_size=1000000,
+               processes=1, seed=0, max_open_files=256):
+    """ Prepares links files for training.
+
+    Parameters
+    ----------
+    training_links : list of filepath
+        Training links files. These are combined, shuffled and
+        split into `output_directory/train`, which can be read
+        with `poplar.dataset.interactions.InteractionDataDirectory`.
+    testing_links : list of filepath
+        Testing links files. These are combined and sorted by
+        taxonomy and protein 1 into `output_directory/test.txt`.
+    validation_links : list of filepath
+        Validation links files. These are combined and sorted by
+        taxonomy and protein 1 into `output_directory/validation.txt`.
+    output_directory : filepath
+        Output directory.
+    split_size : int
+        Number of lines per training file.
+    buffer_size : int
+        Maximum number of lines held in memory per process.
+    processes : int
+        Number of processes.
+    seed : int
+        Random seed.
+    max_open_files : int
+        Maximum number of temporary files open at once.
+    """
+    if training_links:
+        external_shuffle(training_links,
+                         os.path.join(output_directory, 'train'),
+                         split_size=split_size, buffer_size=buffer_size,
+                         processes=processes, seed=seed,
+                         max_open_files=max_open_files)
+    if testing_links:
+        external_sort(testing_links,
+                      os.path.join(output_directory, 'test.txt'),
+                      buffer_size=buffer_size, processes=processes,
+                      max_open_files=max_open_files)
+    if validation_links:
+        external_sort(validation_links,
+                      os.path.join(output_directory, 'validation.txt'),
+                      buffer_size=buffer_size, processes=processes,
+                      max_open_files=max_open_files)
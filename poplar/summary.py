@@ -1,7 +1,11 @@
+import os
+import queue
+import random
+import threading
+import numpy as np
 import torch
 import time
 import datetime
-from torch.utils.tensorboard import SummaryWriter
 
 
 def summarize_gradients(finetuned_model, summary_interval,
@@ -35,7 +39,249 @@ def summarize_gradients(finetuned_model, summary_interval,
     return now
 
 
-def checkpoint(model, path, checkpoint_interval, last_checkpoint_time, writer):
+def trainable_state_dict(model):
+    """ State of the parts of a model that are trained.
+
+    Submodules whose parameters are all frozen, like a pretrained
+    language model, are left out, as are any other frozen parameters.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        Model, which may be wrapped in `torch.nn.DataParallel`.
+
+    Returns
+    -------
+    dict
+        The state dict without the frozen weights.
+    """
+    model = getattr(model, 'module', model)
+    frozen = []
+    for name, module in model.named_modules():
+        params = list(module.parameters())
+        if name and params and not any(p.requires_grad for p in params):
+            frozen.append(name + '.')
+    frozen = tuple(frozen)
+    skip = {name for name, p in model.named_parameters()
+            if not p.requires_grad}
+    return {k: v for k, v in model.state_dict().items()
+            if k not in skip and not k.startswith(frozen)}
+
+
+def to_cpu(obj):
+    """ Copies the tensors of a nested state to CPU memory. """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def rng_state():
+    """ State of the python, numpy and torch random number generators. """
+    return {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'cuda': (torch.cuda.get_rng_state_all()
+                 if torch.cuda.is_available() else [])
+    }
+
+
+def set_rng_state(state):
+    """ Restores the random number generators, see `rng_state`. """
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if len(state['cuda']) > 0 and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def training_state(model, optimizer, scheduler=None, position=None):
+    """ Everything needed to resume training.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        Model being trained. Only its trainable weights are saved,
+        see `trainable_state_dict`.
+    optimizer : torch.optim.Optimizer
+        Optimizer.
+    scheduler : torch.optim.lr_scheduler.LambdaLR
+        Learning rate scheduler (optional).
+    position : dict
+        Position in the training data, e.g. the epoch, links file
+        and batch to resume from.
+
+    Returns
+    -------
+    dict
+        State that can be saved with `CheckpointWriter.save` and
+        restored with `load_training_state`.
+    """
+    return {
+        'model': trainable_state_dict(model),
+        'optimizer': optimizer.state_dict(),
+        'scheduler': (scheduler.state_dict()
+                      if scheduler is not None else None),
+        'rng': rng_state(),
+        'position': dict(position or {})
+    }
+
+
+def load_training_state(path, model, optimizer=None, scheduler=None):
+    """ Restores a checkpoint written from `training_state`.
+
+    Parameters
+    ----------
+    path : str
+        Checkpoint file.
+    model : torch.nn.Module
+        Model being trained, which already holds any frozen weights.
+    optimizer : torch.optim.Optimizer
+        Optimizer (optional).
+    scheduler : torch.optim.lr_scheduler.LambdaLR
+        Learning rate scheduler (optional).
+
+    Returns
+    -------
+    dict
+        The checkpoint, whose `position` gives where to resume from
+        and whose `rng` can be restored with `set_rng_state`.
+
+    Raises
+    ------
+    ValueError
+        If the checkpoint is missing trainable weights of the model,
+        or has weights that the model doesn't.
+    """
+    # the checkpoint holds random number generator states,
+    # which aren't plain tensors
+    state = torch.load(path, map_location='cpu', weights_only=False)
+    model = getattr(model, 'module', model)
+    res = model.load_state_dict(state['model'], strict=False)
+    missing = set(res.missing_keys) & set(trainable_state_dict(model))
+    if missing or res.unexpected_keys:
+        raise ValueError(
+            f'{path} does not match the model (missing {sorted(missing)}, '
+            f'unexpected {sorted(res.unexpected_keys)})')
+    if optimizer is not None:
+        optimizer.load_state_dict(state['optimizer'])
+    if scheduler is not None and state['scheduler'] is not None:
+        scheduler.load_state_dict(state['scheduler'])
+    return state
+
+
+class CheckpointWriter(object):
+    """ Writes checkpoints in a background thread.
+
+    `save` copies the state to CPU memory and returns, and a worker
+    thread writes it to disk. Each file is written to a temporary
+    file and renamed, so a checkpoint file is never partially
+    written, and only the last `keep` checkpoints are kept.
+    """
+    def __init__(self, path, keep=3, head_only=True):
+        """
+        Parameters
+        ----------
+        path : str
+            Prefix of the checkpoint files, which are suffixed by
+            the time at which they were saved.
+        keep : int
+            Number of checkpoints to keep. If this is None, all of
+            them are kept.
+        head_only : bool
+            Leave the frozen weights out of model checkpoints,
+            see `trainable_state_dict`.
+        """
+        self.path = path
+        self.keep = keep
+        self.head_only = head_only
+        self.files = []
+        self.error = None
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as e:
+                self.error = e
+            finally:
+                self._queue.task_done()
+
+    def _write(self, fname, state):
+        dirname = os.path.dirname(os.path.abspath(fname))
+        os.makedirs(dirname, exist_ok=True)
+        torch.save(state, fname + '.tmp')
+        os.replace(fname + '.tmp', fname)
+        if fname in self.files:
+            self.files.remove(fname)
+        self.files.append(fname)
+        while self.keep is not None and len(self.files) > self.keep:
+            old = self.files.pop(0)
+            if os.path.exists(old):
+                os.remove(old)
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def save(self, state, suffix=None):
+        """ Snapshots a checkpoint and queues it to be written.
+
+        Parameters
+        ----------
+        state : torch.nn.Module or dict
+            Model, whose state dict is saved, or a state dict.
+        suffix : str
+            Suffix of the file name. Defaults to the current time.
+
+        Returns
+        -------
+        str
+            Name of the checkpoint file.
+
+        Raises
+        ------
+        Exception
+            If a previous checkpoint couldn't be written.
+        """
+        self._check()
+        if isinstance(state, torch.nn.Module):
+            if self.head_only:
+                state = trainable_state_dict(state)
+            else:
+                state = getattr(state, 'module', state).state_dict()
+        if suffix is None:
+            suffix = datetime.datetime.now().strftime("%y%m%d_%H%M%S")
+        fname = self.path + suffix
+        self._queue.put((fname, to_cpu(state)))
+        return fname
+
+    def wait(self):
+        """ Blocks until all of the queued checkpoints are written. """
+        self._queue.join()
+        self._check()
+
+    def close(self):
+        """ Writes the queued checkpoints and stops the worker thread. """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._check()
+
+
+def checkpoint(model, path, checkpoint_interval, last_checkpoint_time,
+               writer, checkpoint_writer=None):
     """ Save model at checkpoint.
 
     model : torch.nn.Module
@@ -48,19 +294,29 @@ def checkpoint(model, path, checkpoint_interval, last_checkpoint_time, writer):
         The time of the last summary.
     writer : SummaryWrite
         Tensorboard summary writer.
+    checkpoint_writer : CheckpointWriter
+        Background writer (optional). If this is specified, the
+        checkpoint is written without blocking and `path` is ignored.
 
-    TODO: add unittest
+    Returns
+    -------
+    float
+        The time of the last checkpoint.
     """
     now = time.time()
-    if (now - last_checkpoint_time) > checkpoint_interval:
-        suffix = datetime.datetime.now().strftime("%y%m%d_%H%M%S")
-        model_path_ = path + suffix
-        # for parallel training
-        try:
-            state_dict = model.module.state_dict()
-        except AttributeError:
-            state_dict = model.state_dict()
-        torch.save(state_dict, model_path_)
+    if (now - last_checkpoint_time) <= checkpoint_interval:
+        return last_checkpoint_time
+    if checkpoint_writer is not None:
+        checkpoint_writer.save(model)
+        return now
+    suffix = datetime.datetime.now().strftime("%y%m%d_%H%M%S")
+    model_path_ = path + suffix
+    # for parallel training
+    try:
+        state_dict = model.module.state_dict()
+    except AttributeError:
+        state_dict = model.state_dict()
+    torch.save(state_dict, model_path_)
     return now
 
 
@@ -79,6 +335,7 @@ def initialize_logging(logging_path=None):
 
     TODO: add unittest
     """
+    from torch.utils.tensorboard import SummaryWriter
     if logging_path is None:
         basename = "logdir"
         suffix = datetime.datetime.now().strftime("%y%m%d_%H%M%S")
@@ -0,0 +1,91 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import numpy.testing as npt
+import torch
+from poplar.util import dictionary
+from poplar.model.dummy import DummyModel
+from poplar.model.ppibinder import batch_features
+from poplar.model.cache import EmbeddingStore, sequence_key
+from poplar.embed import embed_shard, subshards
+
+
+class TestEmbed(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.path = tempfile.mkdtemp()
+        self.fasta_file = os.path.join(self.path, 'prots.fa')
+        self.seqs = ['MKV', 'IKVNERAKGVEG', 'RAYDM', 'DY', 'MKVLAAGIV']
+        with open(self.fasta_file, 'w') as fh:
+            for i, s in enumerate(self.seqs):
+                fh.write(f'>p{i}\n{s}\n')
+        self.output = os.path.join(self.path, 'embeddings')
+        self.model = DummyModel(len(dictionary) + 1, 4)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_embed_shard(self):
+        n = embed_shard(self.model, self.fasta_file, self.output,
+                        chunk_size=2, batch_size=2, dtype=np.float32)
+        self.assertEqual(n, 5)
+        store = EmbeddingStore(self.output)
+        self.assertListEqual(store.chunk_names(),
+                             ['000000000_000000002', '000000002_000000004',
+                              '000000004_000000005'])
+        ids = [i for i, _ in store.ids()]
+        self.assertListEqual(ids, ['p0', 'p1', 'p2', 'p3', 'p4'])
+        with torch.no_grad():
+            exp = batch_features(self.model, self.seqs).numpy()
+        for i, s in enumerate(self.seqs):
+            npt.assert_allclose(store.get(sequence_key(s)), exp[i],
+                                rtol=1e-6)
+
+    def test_resume(self):
+        embed_shard(self.model, self.fasta_file, self.output,
+                    chunk_size=2)
+        # the second run doesn't recompute anything
+        n = embed_shard(self.model, self.fasta_file, self.output,
+                        chunk_size=2)
+        self.assertEqual(n, 0)
+
+    def test_resume_chunk_size(self):
+        embed_shard(self.model, self.fasta_file, self.output,
+                    chunk_size=2)
+        # none of the chunks of 3 sequences were written
+        n = embed_shard(self.model, self.fasta_file, self.output,
+                        chunk_size=3)
+        self.assertEqual(n, 5)
+        n = embed_shard(self.model, self.fasta_file, self.output,
+                        chunk_size=3)
+        self.assertEqual(n, 0)
+
+    def test_shards(self):
+        n0 = embed_shard(self.model, self.fasta_file, self.output,
+                         shard=0, num_shards=2, chunk_size=2)
+        n1 = embed_shard(self.model, self.fasta_file, self.output,
+                         shard=1, num_shards=2, chunk_size=2)
+        self.assertEqual(n0, 3)
+        self.assertEqual(n1, 2)
+        self.assertEqual(len(EmbeddingStore(self.output)), 5)
+
+    def test_subshards(self):
+        self.assertEqual(subshards(2), ([0, 1], 2))
+        self.assertEqual(subshards(2, shard=1), ([1], 2))
+        # the processes split the shard that was asked for
+        shards, num_shards = subshards(2, shard=0, processes=4)
+        self.assertEqual(len(shards), 4)
+        chunks = sorted(c for c in range(40) for s in shards
+                        if c % num_shards == s)
+        self.assertListEqual(chunks, list(range(0, 40, 2)))
+        shards, num_shards = subshards(3, processes=2)
+        chunks = sorted(c for c in range(40) for s in shards
+                        if c % num_shards == s)
+        self.assertListEqual(chunks, list(range(40)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,33 +1,178 @@
 import unittest
+import numpy as np
+import pandas as pd
+import torch
+from poplar.util import dictionary, to_tokens
+from poplar.dataset.sequences import SequenceStore
+from poplar.dataset.interactions import (
+    ValidationDataset, NegativeSampler, preprocess)
+from poplar.model.dummy import DummyModel
+from poplar.model.ppibinder import PPIBinder
+from poplar.evaluate import (
+    pairwise_auc, mrr, roc_auc, ScoreTable,
+    taxon_mrr, taxon_roc_auc, taxon_pairwise_auc)
+
+
+class SummaryWriter(object):
+    """ Stand-in for the tensorboard writer. """
+    def __init__(self):
+        self.scalars = {}
+
+    def add_scalar(self, name, value, it):
+        self.scalars[name] = value
+
+
+def validation_data(seed=0, repeats=1):
+    """ Small validation dataset with a dummy binding model.
+
+    Every link is listed `repeats` times.
+    """
+    state = np.random.RandomState(seed)
+    seqs = [''.join(state.choice(list('ACDEFGHIKLMNPQRSTVWY'),
+                                 size=state.randint(3, 20)))
+            for _ in range(12)]
+    tokens = list(map(to_tokens, seqs))
+    offsets = np.cumsum([0] + list(map(len, tokens)))
+    store = SequenceStore(np.concatenate(tokens), offsets,
+                          [f'p{i}' for i in range(12)])
+    links = pd.DataFrame({
+        0: [f'p{i % 3}' for i in range(12)],
+        1: [f'p{(i * 5) % 12}' for i in range(12)],
+        2: 'STRING',
+        3: [1 + (i % 3) // 2 for i in range(12)],
+        4: 'Test'})
+    links = pd.concat([links] * repeats, ignore_index=True)
+    pairs = preprocess(store, links)
+    torch.manual_seed(seed)
+    peptide_model = DummyModel(len(dictionary) + 1, 6)
+    model = PPIBinder(6, 4, peptide_model)
+    dataset = ValidationDataset(pairs, links, store,
+                                NegativeSampler(store), num_neg=3)
+    return model, dataset
 
 
 class TestGlobalMetrics(unittest.TestCase):
 
     def setUp(self):
-        pass
+        self.model, self.dataset = validation_data()
 
-    def mrr(self):
-        pass
+    def naive_scores(self):
+        """ Scores one triple at a time. """
+        np.random.seed(0)
+        res = []
+        with torch.no_grad():
+            for gene, pos, rnd, tax, protid, _ in self.dataset:
+                f = lambda x: self.model.encode(self.dataset.sequences([x]))
+                gv, pv, nv = f(gene), f(pos), f(rnd)
+                res.append((tax, protid, gene, pos,
+                            self.model.predict(gv, pv).item(),
+                            self.model.predict(gv, nv).item()))
+        return pd.DataFrame(res, columns=['taxon', 'protein', 'gene', 'pos',
+                                          'pos_score', 'neg_score'])
 
-    def roc_auc(self):
-        pass
+    def test_score_table(self):
+        np.random.seed(0)
+        table = ScoreTable.from_model(self.model, self.dataset, batch_size=4)
+        df = table.frame
+        # 12 positive links, each with 3 negative draws
+        self.assertEqual((df['label'] == 1).sum(), 12)
+        self.assertEqual((df['label'] == 0).sum(), 36)
+        exp = self.naive_scores()
+        neg = df.loc[df['label'] == 0]
+        np.testing.assert_allclose(neg['score'].values,
+                                   exp['neg_score'].values, rtol=1e-5)
 
-    def pairwise_auc(self):
-        pass
+    def test_score_table_duplicates(self):
+        # identical links are consecutive, but are still scored apart
+        _, dataset = validation_data(repeats=2)
+        np.random.seed(0)
+        table = ScoreTable.from_model(self.model, dataset, batch_size=4)
+        links = table.links()
+        self.assertEqual(len(links), 24)
+        self.assertTrue((links['draws'] == 3).all())
+
+    def test_mrr(self):
+        exp = self.naive_scores()
+        beats = (exp['neg_score'] > exp['pos_score']).values.reshape(-1, 3)
+        exp_mrr = np.mean(1 / (1 + beats.sum(1)))
+        np.random.seed(0)
+        self.assertAlmostEqual(mrr(self.model, self.dataset), exp_mrr)
+
+    def test_roc_auc(self):
+        exp = self.naive_scores()
+        aucs = []
+        for _, g in exp.groupby(['taxon', 'protein']):
+            pos = g['pos_score'].values[::3]
+            neg = g['neg_score'].values
+            wins = (pos[:, None] > neg[None, :]).sum()
+            ties = (pos[:, None] == neg[None, :]).sum()
+            aucs.append((wins + ties / 2) / (len(pos) * len(neg)))
+        np.random.seed(0)
+        res = roc_auc(self.model, self.dataset, batch_size=7)
+        self.assertAlmostEqual(res, np.mean(aucs), places=5)
+
+    def test_pairwise_auc(self):
+        # compare against scoring one triple at a time
+        np.random.seed(0)
+        triples = list(self.dataset)
+        exp = 0
+        with torch.no_grad():
+            for gene, pos, rnd, tax, protid, _ in triples:
+                f = lambda x: self.model.encode(self.dataset.sequences([x]))
+                gv, pv, nv = f(gene), f(pos), f(rnd)
+                exp += (self.model.predict(gv, pv) >
+                        self.model.predict(gv, nv)).item()
+        exp = exp / len(triples)
+
+        for batch_size in [1, 5, 1000]:
+            np.random.seed(0)
+            writer = SummaryWriter()
+            res = pairwise_auc(self.model, self.dataset, 'test', 0, writer,
+                               batch_size=batch_size)
+            self.assertAlmostEqual(res, exp)
+            self.assertAlmostEqual(writer.scalars['test/pairwise/TPR'], exp)
 
 
 class TestTaxonMetrics(unittest.TestCase):
     def setUp(self):
-        pass
+        self.model, self.dataset = validation_data()
+
+    def test_taxon_mrr(self):
+        np.random.seed(0)
+        res = taxon_mrr(self.model, self.dataset)
+        self.assertListEqual(list(res.index), [1, 2])
+        self.assertTrue(((res['mrr'] > 0) & (res['mrr'] <= 1)).all())
 
-    def taxon_mrr(self):
-        pass
+    def test_taxon_roc_auc(self):
+        np.random.seed(0)
+        res = taxon_roc_auc(self.model, self.dataset)
+        self.assertListEqual(list(res.index), [1, 2])
+        self.assertTrue(((res['roc_auc'] >= 0) &
+                         (res['roc_auc'] <= 1)).all())
 
-    def taxon_roc_auc(self):
-        pass
+    def test_taxon_pairwise_auc(self):
+        np.random.seed(0)
+        res = taxon_pairwise_auc(self.model, self.dataset)
+        np.random.seed(0)
+        exp = pairwise_auc(self.model, self.dataset, 'test', 0,
+                           SummaryWriter())
+        # the taxa are weighted by their number of draws
+        np.random.seed(0)
+        table = ScoreTable.from_model(self.model, self.dataset)
+        draws = table.links().groupby('taxon')['draws'].sum()
+        self.assertAlmostEqual(
+            (res['pairwise_auc'] * draws).sum() / draws.sum(), exp)
 
-    def taxon_pairwise_auc(self):
-        pass
+    def test_incremental(self):
+        from poplar.evaluate import score_pairs
+        np.random.seed(0)
+        exp = ScoreTable.from_model(self.model, self.dataset).taxon_metrics()
+        np.random.seed(0)
+        table = ScoreTable()
+        for chunk in score_pairs(self.model, self.dataset, batch_size=5):
+            table.update(chunk)
+            table.taxon_metrics()
+        pd.testing.assert_frame_equal(table.taxon_metrics(), exp)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,80 @@
+import os
+import sys
+import subprocess
+import unittest
+
+
+# frameworks that data only jobs shouldn't pay for
+HEAVY = ['torch', 'fairseq', 'transformers', 'tensorboard', 'tqdm', 'Bio']
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+
+def import_times(args):
+    """ Cumulative import time of each top level module, in seconds.
+
+    Raises
+    ------
+    ImportError
+        If the command fails, i.e. a module can't be imported.
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [ROOT] + [p for p in [env.get('PYTHONPATH')] if p])
+    res = subprocess.run([sys.executable, '-X', 'importtime'] + args,
+                         env=env, cwd=ROOT, stdout=subprocess.DEVNULL,
+                         stderr=subprocess.PIPE, universal_newlines=True)
+    if res.returncode != 0:
+        errors = [line for line in res.stderr.splitlines()
+                  if not line.startswith('import time:')]
+        raise ImportError(f'{args} failed:\n' + '\n'.join(errors))
+    times = {}
+    for line in res.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|')
+        if not cumulative.strip().isdigit():
+            continue
+        name = name.strip()
+        if '.' not in name:
+            times[name] = int(cumulative) / 1e6
+    return times
+
+
+class TestImportTime(unittest.TestCase):
+
+    def check(self, args, max_seconds=1., allowed=()):
+        try:
+            times = import_times(args)
+        except ImportError as e:
+            self.fail(str(e))
+        loaded = [m for m in HEAVY if m in times and m not in allowed]
+        self.assertListEqual(loaded, [], f'{args} imports {loaded}')
+        self.assertLess(sum(times.values()), max_seconds)
+
+    def test_failed_import(self):
+        with self.assertRaises(ImportError):
+            import_times(['-c', 'import poplar.missing'])
+
+    def test_cli(self):
+        self.check([os.path.join('scripts', 'poplar'), '--help'])
+
+    def test_data_modules(self):
+        for module in ['poplar.preprocess', 'poplar.dataset.links',
+                       'poplar.dataset.positives',
+                       'poplar.dataset.sequences', 'poplar.evaluate']:
+            self.check(['-c', f'import {module}'])
+
+    def test_torch_modules(self):
+        # the datasets that dataloader workers unpickle subclass the
+        # torch datasets, i.e. a DataLoader only streams an
+        # IterableDataset, so these modules need torch, but nothing
+        # heavier
+        for module in ['poplar.dataset.interactions',
+                       'poplar.dataset.contacts']:
+            self.check(['-c', f'import {module}'], max_seconds=10.,
+                       allowed=['torch'])
+
+
+if __name__ == '__main__':
+    unittest.main()
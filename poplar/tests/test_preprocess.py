@@ -0,0 +1,93 @@
+import os
+import glob
+import shutil
+import tempfile
+import unittest
+from poplar.preprocess import (
+    external_shuffle, external_sort, preprocess, link_key)
+
+
+class TestPreprocess(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.files = []
+        self.lines = []
+        for k in range(3):
+            fname = os.path.join(self.path, f'links{k}.txt')
+            lines = [f'{k}.p{i % 7}\t{k}.q{i}\tSTRING\t{(k * 31 + i) % 5}'
+                     f'\tTrain\n' for i in range(40)]
+            with open(fname, 'w') as fh:
+                fh.writelines(lines)
+            self.files.append(fname)
+            self.lines += lines
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def read(self, files):
+        res = []
+        for fname in files:
+            with open(fname) as fh:
+                res += fh.readlines()
+        return res
+
+    def test_external_shuffle(self):
+        out = os.path.join(self.path, 'train')
+        res = external_shuffle(self.files, out, split_size=50,
+                               buffer_size=16, seed=0)
+        self.assertEqual(len(res), 3)
+        self.assertListEqual(sorted(glob.glob(f'{out}/*')), res)
+        lines = self.read(res)
+        self.assertEqual(len(self.read(res[:1])), 50)
+        self.assertListEqual(sorted(lines), sorted(self.lines))
+        self.assertNotEqual(lines, self.lines)
+
+        # the shuffle is reproducible
+        out2 = os.path.join(self.path, 'train2')
+        res2 = external_shuffle(self.files, out2, split_size=50,
+                                buffer_size=16, seed=0)
+        self.assertListEqual(self.read(res2), lines)
+
+    def test_external_shuffle_max_open_files(self):
+        # 8 buckets are scattered across 3 files, and then 3 each
+        out = os.path.join(self.path, 'train')
+        res = external_shuffle(self.files, out, split_size=50,
+                               buffer_size=16, seed=0, max_open_files=3)
+        self.assertListEqual(sorted(glob.glob(f'{out}/*')), res)
+        lines = self.read(res)
+        self.assertListEqual(sorted(lines), sorted(self.lines))
+        self.assertNotEqual(lines, self.lines)
+        with self.assertRaises(ValueError):
+            external_shuffle(self.files, out, max_open_files=1)
+
+    def test_external_sort_max_open_files(self):
+        out = os.path.join(self.path, 'sorted.txt')
+        # 8 runs are merged in 3 passes
+        external_sort(self.files, out, buffer_size=16, max_open_files=2)
+        lines = self.read([out])
+        self.assertListEqual(lines, sorted(self.lines, key=link_key))
+
+    def test_external_sort(self):
+        out = os.path.join(self.path, 'sorted.txt')
+        external_sort(self.files, out, buffer_size=16)
+        lines = self.read([out])
+        self.assertListEqual(lines, sorted(self.lines, key=link_key))
+
+    def test_external_sort_processes(self):
+        out = os.path.join(self.path, 'sorted.txt')
+        external_sort(self.files, out, buffer_size=16, processes=2)
+        lines = self.read([out])
+        self.assertListEqual(lines, sorted(self.lines, key=link_key))
+
+    def test_preprocess(self):
+        out = os.path.join(self.path, 'out')
+        preprocess(self.files[:2], self.files[2:], [], out,
+                   split_size=30, buffer_size=16)
+        self.assertEqual(len(glob.glob(f'{out}/train/*')), 3)
+        self.assertTrue(os.path.exists(f'{out}/test.txt'))
+        self.assertFalse(os.path.exists(f'{out}/validation.txt'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import torch
+import torch.nn as nn
+from poplar.summary import (
+    CheckpointWriter, checkpoint, trainable_state_dict, training_state,
+    load_training_state, rng_state, set_rng_state)
+
+
+class Head(nn.Module):
+    def __init__(self):
+        super(Head, self).__init__()
+        self.peptide_model = nn.Sequential(nn.Linear(3, 4),
+                                           nn.BatchNorm1d(4))
+        self.u_embeddings = nn.Linear(4, 2)
+        for p in self.peptide_model.parameters():
+            p.requires_grad = False
+
+
+class TestCheckpointWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'model')
+        self.model = Head()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_trainable_state_dict(self):
+        res = trainable_state_dict(self.model)
+        self.assertListEqual(sorted(res),
+                             ['u_embeddings.bias', 'u_embeddings.weight'])
+        res = trainable_state_dict(nn.DataParallel(self.model))
+        self.assertEqual(len(res), 2)
+
+    def test_save(self):
+        saver = CheckpointWriter(self.path)
+        fname = saver.save(self.model, suffix='1')
+        # the snapshot isn't affected by later updates
+        exp = self.model.u_embeddings.weight.detach().clone()
+        with torch.no_grad():
+            self.model.u_embeddings.weight.add_(1)
+        saver.close()
+        res = torch.load(fname)
+        self.assertTrue(torch.equal(res['u_embeddings.weight'], exp))
+        self.assertNotIn('peptide_model.0.weight', res)
+        self.assertListEqual(os.listdir(self.tmp), ['model1'])
+
+    def test_full(self):
+        saver = CheckpointWriter(self.path, head_only=False)
+        fname = saver.save(self.model, suffix='1')
+        saver.close()
+        self.assertIn('peptide_model.0.weight', torch.load(fname))
+
+    def test_keep(self):
+        saver = CheckpointWriter(self.path, keep=2)
+        for i in range(4):
+            saver.save({'step': torch.tensor(i)}, suffix=str(i))
+        saver.wait()
+        self.assertListEqual(sorted(os.listdir(self.tmp)),
+                             ['model2', 'model3'])
+        saver.close()
+
+    def test_error(self):
+        saver = CheckpointWriter(os.path.join(self.tmp, 'file', 'model'))
+        with open(os.path.join(self.tmp, 'file'), 'w') as fh:
+            fh.write('not a directory')
+        saver.save({'step': 0})
+        with self.assertRaises(Exception):
+            saver.wait()
+        saver.close()
+
+    def test_checkpoint(self):
+        saver = CheckpointWriter(self.path)
+        t = checkpoint(self.model, self.path, 100, 0, None,
+                       checkpoint_writer=saver)
+        self.assertGreater(t, 0)
+        # not saved until the interval has passed
+        self.assertEqual(checkpoint(self.model, self.path, 100, t, None,
+                                    checkpoint_writer=saver), t)
+        saver.close()
+        self.assertEqual(len(os.listdir(self.tmp)), 1)
+
+
+class TestTrainingState(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'model')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def build(self):
+        model = Head()
+        optimizer = torch.optim.AdamW(
+            [p for p in model.parameters() if p.requires_grad], lr=0.1)
+        scheduler = torch.optim.lr_scheduler.LambdaLR(
+            optimizer, lambda step: 1 / (1 + step))
+        return model, optimizer, scheduler
+
+    def step(self, model, optimizer, scheduler):
+        x = torch.randn(5, 4)
+        model.u_embeddings(x).pow(2).sum().backward()
+        optimizer.step()
+        scheduler.step()
+        optimizer.zero_grad()
+
+    def test_rng_state(self):
+        state = rng_state()
+        exp = (np.random.rand(), torch.rand(1))
+        set_rng_state(state)
+        res = (np.random.rand(), torch.rand(1))
+        self.assertEqual(res[0], exp[0])
+        self.assertTrue(torch.equal(res[1], exp[1]))
+
+    def test_resume(self):
+        model, optimizer, scheduler = self.build()
+        for _ in range(3):
+            self.step(model, optimizer, scheduler)
+        saver = CheckpointWriter(self.path)
+        position = {'epoch': 1, 'dataset': 2, 'batch': 3, 'it': 30}
+        fname = saver.save(training_state(model, optimizer, scheduler,
+                                          position))
+        saver.close()
+        self.assertNotIn('peptide_model.0.weight', torch.load(
+            fname, weights_only=False)['model'])
+
+        # the frozen weights come from the pretrained model
+        resumed = self.build()
+        resumed[0].peptide_model.load_state_dict(
+            model.peptide_model.state_dict())
+        state = load_training_state(fname, *resumed)
+        self.assertDictEqual(state['position'], position)
+        # resumed training takes the same steps
+        set_rng_state(state['rng'])
+        self.step(*resumed)
+        set_rng_state(state['rng'])
+        self.step(model, optimizer, scheduler)
+        for k, v in model.state_dict().items():
+            self.assertTrue(torch.allclose(resumed[0].state_dict()[k], v))
+        self.assertEqual(resumed[2].last_epoch, scheduler.last_epoch)
+
+    def test_mismatch(self):
+        model, optimizer, scheduler = self.build()
+        torch.save(training_state(nn.Linear(2, 2), optimizer), self.path)
+        with self.assertRaises(ValueError):
+            load_training_state(self.path, model)
+
+
+if __name__ == '__main__':
+    unittest.main()
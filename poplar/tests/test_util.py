@@ -0,0 +1,48 @@
+import unittest
+import numpy as np
+import numpy.testing as npt
+from poplar.util import (
+    dictionary, encode, encode_batch, to_tokens, PAD, UNKNOWN)
+
+
+class TestEncode(unittest.TestCase):
+
+    def test_encode(self):
+        res = encode('MKV').numpy()
+        exp = [dictionary['M'], dictionary['K'], dictionary['V']]
+        npt.assert_array_equal(res, exp)
+        self.assertEqual(res.dtype, np.int64)
+
+    def test_to_tokens_unknown(self):
+        res = to_tokens('M*k', unknown=0)
+        npt.assert_array_equal(res, [dictionary['M'], 0, dictionary['K']])
+
+    def test_encode_batch(self):
+        tokens, lengths, mask = encode_batch(['MKV', 'A', 'CD'])
+        exp = np.array([
+            [dictionary['M'], dictionary['K'], dictionary['V']],
+            [dictionary['A'], PAD, PAD],
+            [dictionary['C'], dictionary['D'], PAD]
+        ])
+        npt.assert_array_equal(tokens.numpy(), exp)
+        npt.assert_array_equal(lengths.numpy(), [3, 1, 2])
+        npt.assert_array_equal(mask.numpy(), exp != PAD)
+
+    def test_encode_batch_tokens(self):
+        # mixing strings and uint8 tokens
+        tokens, lengths, mask = encode_batch(
+            ['MK?', to_tokens('MKV')], padding_idx=-1)
+        exp = np.array([
+            [dictionary['M'], dictionary['K'], UNKNOWN],
+            [dictionary['M'], dictionary['K'], dictionary['V']]
+        ])
+        npt.assert_array_equal(tokens.numpy(), exp)
+        self.assertTrue(mask.all())
+
+    def test_encode_batch_empty(self):
+        tokens, lengths, mask = encode_batch([])
+        self.assertEqual(tuple(tokens.shape), (0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,185 +1,255 @@
 import os
 import time
-import datetime
-import numpy as np
-from tqdm import tqdm
 import torch
-import torch.optim as optim
-from fairseq.models.roberta import RobertaModel
-from poplar.transformer import RobertaConstrastiveHead
-from poplar.dataset import InteractionDataDirectory
-from poplar.util import encode, tokenize
-from torch.utils.tensorboard import SummaryWriter
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+from poplar.model.contactmap import (
+    ContactMapLinear, contact_mask, residue_features)
+from poplar.model.cache import EmbeddingCache, model_fingerprint
+from poplar.dataset.contacts import ContactMapStore, PackedContactMapDataset
+from poplar.summary import (
+    summarize_gradients, checkpoint, initialize_logging, CheckpointWriter)
 from torch.nn.utils import clip_grad_norm_
-from transformers import AdamW, WarmupLinearSchedule
+
+
+def warmup_linear_schedule(optimizer, warmup_steps, t_total):
+    """ Linear warmup, followed by a linear decay to zero. """
+    def f(step):
+        if step < warmup_steps:
+            return step / max(1, warmup_steps)
+        return max(0., (t_total - step) / max(1, t_total - warmup_steps))
+    return torch.optim.lr_scheduler.LambdaLR(optimizer, f)
+
+
+def contact_loss(pred, contacts, mask):
+    """ Mean squared error over the scored residue pairs.
+
+    Parameters
+    ----------
+    pred : torch.Tensor
+        Predicted contact maps of shape (batch, length, length).
+    contacts : torch.Tensor
+        True contact maps of shape (batch, length, length).
+    mask : torch.Tensor of torch.bool
+        Residues that aren't padding, of shape (batch, length).
+    """
+    pairs = contact_mask(mask)
+    return F.mse_loss(pred[pairs], contacts[pairs])
 
 
 def contactmap_train(
-        pretrained_model, dataloader,
-        logging_path=None,
-        emb_dimension=100, max_steps=0,
+        contact_model, pretrained_model, dataloader, cache=None,
+        logging_path=None, epochs=1,
         learning_rate=5e-5, warmup_steps=1000,
         gradient_accumulation_steps=1,
         clip_norm=10., summary_interval=100, checkpoint_interval=100,
-        model_path='model', device=None):
+        model_path='model', max_batch_size=None, keep_checkpoints=3,
+        device='cpu'):
     """ Train the contact map prediction model.
 
+    The pretrained model is frozen, so the features of each protein
+    are computed once and reused across epochs if there is a cache.
+
     Parameters
     ----------
-        pretrained_model : fairseq.models.roberta.RobertaModel
+    contact_model : poplar.model.contactmap.ContactMapLinear
+        Contact map prediction model.
+    pretrained_model : fairseq.models.roberta.RobertaModel
         Pretrained Roberta model.
-    directory_dataloader : InteractionDataDirectory
-        Creates dataloaders
-    emb_dimension : int
-        Number of dimensions to train the model.
+    dataloader : torch.utils.data.DataLoader
+        Dataloader of a `PackedContactMapDataset`.
+    cache : poplar.model.cache.EmbeddingCache
+        Cache of per residue features (optional).
     logging_path : path
         Path of logging file.
-    max_steps : int
-        Maximum number of steps to run for. Each step corresponds to
-        the evaluation of a protein pair. If this is zero, then it'll
-        default to one epochs worth of protein pairs (ie one pass through
-        all of the protein pairs in the training dataset).
+    epochs : int
+        Number of passes through the contact maps.
     learning_rate : float
         Learning rate of ADAM
     warmup_steps : int
         Number of warmup steps for scheduler
+    gradient_accumulation_steps : int
+        Number of batches before the gradients are applied.
     clip_norm : float
         Clipping norm of gradients
     summary_interval : int
-        Number of steps before saving summary.
+        Number of seconds before saving summary.
     checkpoint_interval : int
-        Number of steps before saving checkpoint.
+        Number of seconds before saving checkpoint.
+    model_path : path
+        Prefix of the model checkpoints.
+    max_batch_size : int
+        Maximum number of proteins passed through the language
+        model at once.
+    keep_checkpoints : int
+        Number of checkpoints to keep. Checkpoints are written in the
+        background and leave out the frozen language model.
     device : str
         Name of device to run (specifies gpu or not)
 
     Returns
     -------
-    finetuned_model : poplar.contactmap.ContactMapLinear
-
+    contact_model : poplar.model.contactmap.ContactMapLinear
     """
-    roberta_dim = int(list(list(pretrained_model.parameters())[-1].shape)[0])
-    finetuned_model = ContactMapLinear(roberta_dim, emb_dimension)
-
-    optimizer = AdamW(finetuned_model.parameters(), lr=learning_rate)
-    scheduler = WarmupLinearSchedule(optimizer, warmup_steps=warmup_steps, t_total=t_total)
-    loss_f = torch.nn.MSELoss()
-
-    finetuned_model.to(device)
-    n_gpu = torch.cuda.device_count()
-    print(os.environ["CUDA_VISIBLE_DEVICES"], 'devices available')
-    print("Utilizing ", torch.cuda.device_count(), device)
-    if n_gpu > 1:
-        finetuned_model = torch.nn.DataParallel(finetuned_model)
-
-    # Initialize logging path
-    if logging_path is None:
-        basename = "logdir"
-        suffix = datetime.datetime.now().strftime("%y%m%d_%H%M%S")
-        logging_path = "_".join([basename, suffix])
-    it = 0
-    writer = SummaryWriter(logging_path)
-
-    # metrics to report
-    err, cv_err, batch_size = 0, 0, 0
-
-    now = time.time()
-    last_now = time.time()
-
+    last_summary_time, last_checkpoint_time = time.time(), time.time()
+    gradient_accumulation_steps = max(1, gradient_accumulation_steps)
+    t_total = max(1, epochs * len(dataloader) // gradient_accumulation_steps)
+    optimizer = torch.optim.AdamW(contact_model.parameters(),
+                                  lr=learning_rate)
+    scheduler = warmup_linear_schedule(optimizer, warmup_steps, t_total)
+    for param in pretrained_model.parameters():
+        param.requires_grad = False
+
+    writer = initialize_logging(logging_path=logging_path)
+    saver = CheckpointWriter(model_path, keep=keep_checkpoints)
+    it = 0  # number of proteins
+    residues, elapsed = 0, 0.
+    print('Number of proteins', len(dataloader.dataset))
     print('Number of epochs', epochs)
     for e in range(epochs):
-        for k, dataloader in enumerate(directory_dataloader):
-            finetuned_model.train()
-            train_dataloader, test_dataloader = dataloader
-            num_batches = len(train_dataloader)
-            num_cv_batches = len(test_dataloader)
-            batch_size = train_dataloader.batch_size
-
-            print(f'dataset {k}, num_batches {num_batches}, num_cvs {num_cv_batches}, '
-                  f'seconds / batch {now - last_now}')
-            for j, (gene, contacts) in enumerate(train_dataloader):
-                last_now = now
-                now = time.time()
-                g = pretrained_model.extract_features(encode(x))
-                pred = finetuned_model.forward(g)
-                loss = loss_f(pred, contacts)
-
-                if n_gpu > 1:
-                    loss = loss.mean()
-                if gradient_accumulation_steps > 1:
-                    loss = loss / gradient_accumulation_steps
-                loss.backward()
-                clip_grad_norm_(finetuned_model.parameters(), clip_norm)
-
-                it += len(gene)
-                err = loss.item()
-                print(f'epoch {e}, dataset {k}, batch {j}, err {err}, total batches {num_batches}, '
-                      f'seconds / batch {now - last_now}')
-
-                # write down summary stats
-                if (now - last_summary_time) > summary_interval:
-                    writer.add_scalar('train_error', err, it)
-                    # add gradients to histogram
-                    for name, param in finetuned_model.named_parameters():
-                        writer.add_histogram('grad/%s' %  name, param.grad, it)
-                    last_summary_time = now
-
-                # clean up
-                del loss, g
-                if 'cuda' in device:
-                    torch.cuda.empty_cache()
-
-                if (now - last_checkpoint_time) > checkpoint_interval:
-                    suffix = datetime.datetime.now().strftime("%y%m%d_%H%M%S")
-                    model_path_ = model_path + suffix
-                    # for parallel training
-                    try:
-                        state_dict = finetuned_model.module.state_dict()
-                    except AttributeError:
-                        state_dict = finetuned_model.state_dict()
-                    torch.save(state_dict, model_path_)
-                    last_checkpoint_time = now
-
-                # accumulate gradients - so that we do backprop after loss
-                # has been calculated on entire batch
-                if j % gradient_accumulation_steps == 0:
-                    optimizer.step()
-                    scheduler.step()
-                    finetuned_model.zero_grad()
-
-            # cross validation after each dataset is processed
-            with torch.no_grad():
-                cv_loss = 0
-                for j, (cv_gene, cv_contacts) in enumerate(test_dataloader):
-                    cv_pred = pretrained_model.extract_features(encode(x))
-                    cv_loss += loss_f(cv_pred, cv_contacts).item()
-
-                    #clean up
-                    del cv_pred, cv_contacts, cv_loss
-                    if 'cuda' in device:
-                        torch.cuda.empty_cache()
-
-                if len(test_dataloader) > 0:
-                    cv_err = cv_err / len(test_dataloader)
-                    tpr = tpr / len(test_dataloader)
-                    print(f'epoch {e}, dataset {k}, cv_err {cv_err}, '
-                          f'total batches {num_cv_batches}, '
-                          f'seconds / batch {now - last_now}')
-                    writer.add_scalar('test_error', cv_loss, it)
-
-    # save hparams
-    writer.add_hparams(
-        hparam_dict={
-            'emb_dimension': emb_dimension,
-            'learning_rate': learning_rate,
-            'warmup_steps': warmup_steps,
-            'gradient_accumulation_steps': gradient_accumulation_steps,
-            'batch_size': batch_size
-            },
-        metric_dict={
-            'train_error': err,
-            'test_error': cv_err
-        }
-    )
-
+        contact_model.train()
+        for j, (tokens, contacts, mask) in enumerate(dataloader):
+            start = time.time()
+            features, _ = residue_features(
+                pretrained_model, tokens, cache=cache,
+                max_batch_size=max_batch_size, device=device)
+            contacts, mask = contacts.to(device), mask.to(device)
+            pred = contact_model(features, mask)
+            loss = contact_loss(pred, contacts, mask)
+            if gradient_accumulation_steps > 1:
+                loss = loss / gradient_accumulation_steps
+            loss.backward()
+            clip_grad_norm_(contact_model.parameters(), clip_norm)
+            if (j + 1) % gradient_accumulation_steps == 0:
+                optimizer.step()
+                scheduler.step()
+                contact_model.zero_grad()
+
+            # throughput of the whole step, including feature extraction
+            if 'cuda' in device:
+                torch.cuda.synchronize()
+            n = int(mask.sum().item())
+            seconds = time.time() - start
+            residues, elapsed = residues + n, elapsed + seconds
+            it += len(tokens)
+            err = loss.item()
+            writer.add_scalar('train_error', err, it)
+            writer.add_scalar('residues_per_sec', n / max(seconds, 1e-9), it)
+            print(f'epoch {e}, batch {j}, err {err}, '
+                  f'residues / sec {n / max(seconds, 1e-9):.1f}')
+
+            last_summary_time = summarize_gradients(
+                contact_model, summary_interval,
+                last_summary_time, it, writer)
+            last_checkpoint_time = checkpoint(
+                contact_model, model_path, checkpoint_interval,
+                last_checkpoint_time, writer, checkpoint_writer=saver)
+
+        rate = residues / max(elapsed, 1e-9)
+        writer.add_scalar('epoch/residues_per_sec', rate, e)
+        if cache is not None:
+            writer.add_scalar('epoch/cache_hits', cache.hits, e)
+        print(f'epoch {e}, residues / sec {rate:.1f}')
+
+    saver.close()
     writer.close()
-    return finetuned_model
+    return contact_model
+
+
+def contact_map(contact_directory, checkpoint_path, data_dir, model_path,
+                logging_path=None, store_path=None, key='A_ca_10A',
+                emb_dimension=100, epochs=1, learning_rate=5e-5,
+                warmup_steps=1000, gradient_accumulation_steps=1,
+                clip_norm=10., batch_size=10, max_batch_size=None,
+                num_workers=1, summary_interval=100,
+                checkpoint_interval=1000, cache_memory=4096,
+                keep_checkpoints=3, device='cpu'):
+    """ Train contact map prediction model
+
+    Parameters
+    ----------
+    contact_directory : filepath
+        Directory of npz contact maps, see
+        `poplar.dataset.contacts.ContactMapDataset`.
+    checkpoint_path : path
+        Path for roberta model.
+    data_dir : path
+        Path to data used for pretraining.
+    model_path : path
+        Path for finetuned model.
+    logging_path : path
+        Path for logging information.
+    store_path : path
+        Directory of the packed contact maps (optional). They are
+        packed there on the first run and memory mapped afterwards.
+        See `poplar.dataset.contacts.ContactMapStore`.
+    key : str
+        Contact map to train on.
+    emb_dimension : int
+        Number of embedding dimensions.
+    epochs : int
+        Number of passes through the contact maps.
+    learning_rate : float
+        Learning rate of ADAM
+    warmup_steps : int
+        Number of warmup steps for scheduler
+    gradient_accumulation_steps : int
+        Number of batches before the gradients are applied.
+    clip_norm : float
+        Clipping norm of gradients
+    batch_size : int
+        Number of proteins per batch.
+    max_batch_size : int
+        Maximum number of proteins passed through the language
+        model at once.
+    num_workers : int
+        Number of dataloader workers.
+    summary_interval : int
+        Number of seconds for a summary update.
+    checkpoint_interval : int
+        Number of seconds before saving checkpoint.
+    cache_memory : int
+        Megabytes of per residue features cached in memory. Features
+        are cached in half precision, so a protein takes
+        (length + 1) * dim * 2 bytes, e.g. 2.6 MB for 1024 residues
+        of a 1280 dimensional model.
+    keep_checkpoints : int
+        Number of checkpoints to keep.
+    device : str
+        Name of device to run on.
+    """
+    from fairseq.models.roberta import RobertaModel
+
+    if store_path is not None and os.path.exists(store_path):
+        store = ContactMapStore.load(store_path)
+    else:
+        store = ContactMapStore.from_directory(
+            contact_directory, path=store_path, key=key)
+    dataset = PackedContactMapDataset(store)
+    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True,
+                            num_workers=num_workers,
+                            collate_fn=dataset.collate,
+                            pin_memory='cuda' in device)
+
+    pretrained_model = RobertaModel.from_pretrained(
+        checkpoint_path, 'checkpoint_best.pt', data_dir)
+    pretrained_model.to(device)
+    # the dimensionality of the roberta model
+    roberta_dim = int(list(list(pretrained_model.parameters())[-1].shape)[0])
+    contact_model = ContactMapLinear(roberta_dim, emb_dimension)
+    contact_model.to(device)
+    cache = EmbeddingCache(model_fingerprint(pretrained_model),
+                           capacity=None, max_bytes=cache_memory * 2**20)
+
+    finetuned_model = contactmap_train(
+        contact_model, pretrained_model, dataloader, cache=cache,
+        logging_path=logging_path, epochs=epochs,
+        learning_rate=learning_rate, warmup_steps=warmup_steps,
+        gradient_accumulation_steps=gradient_accumulation_steps,
+        clip_norm=clip_norm, summary_interval=summary_interval,
+        checkpoint_interval=checkpoint_interval, model_path=model_path,
+        max_batch_size=max_batch_size, keep_checkpoints=keep_checkpoints,
+        device=device)
+
+    # save the last model checkpoint
+    torch.save(finetuned_model.state_dict(), model_path + 'last')
@@ -1,22 +1,20 @@
 import os
 import time
-import datetime
-import numpy as np
-from tqdm import tqdm
 import torch
-import torch.optim as optim
-from fairseq.models.roberta import RobertaModel
-from poplar.model.ppibinder import PPIBinder
+from poplar.model.ppibinder import PPIBinder, peptide_ids
+from poplar.model.encoders import ConvEncoder
+from poplar.model.cache import (
+    EmbeddingCache, EmbeddingStore, model_fingerprint)
 from poplar.dataset.interactions import InteractionDataDirectory
-from poplar.dataset.interactions import ValidationDataset
-from poplar.dataset.interactions import NegativeSampler
+from poplar.dataset.interactions import ValidationDataset, nbytes
+from poplar.dataset.stream import prefetch, Gate
 from poplar.util import encode, tokenize
 from poplar.evaluate import pairwise_auc
 from poplar.summary import (
-    summarize_gradients, checkpoint, initialize_logging)
-from torch.utils.tensorboard import SummaryWriter
+    summarize_gradients, initialize_logging, CheckpointWriter,
+    training_state, load_training_state, trainable_state_dict,
+    rng_state, set_rng_state)
 from torch.nn.utils import clip_grad_norm_
-from transformers import AdamW, WarmupLinearSchedule
 
 
 def train(ppi_model, directory_dataloader,
@@ -24,7 +22,8 @@ def train(ppi_model, directory_dataloader,
           learning_rate=5e-5, warmup_steps=1000,
           gradient_accumulation_steps=1,
           clip_norm=10., summary_interval=100, checkpoint_interval=100,
-          model_path='model', device='cpu'):
+          model_path='model', prefetch_depth=1, prefetch_memory=None,
+          keep_checkpoints=3, resume=None, stream=False, device='cpu'):
     """ Train the protein-protein interaction model.
 
     Parameters
@@ -32,7 +31,9 @@ def train(ppi_model, directory_dataloader,
     ppi_model : fairseq.models.roberta.RobertaModel
         Protein interaction prediction model
     directory_dataloader : InteractionDataDirectory
-        Creates dataloaders.
+        Creates dataloaders. Their workers are forked while the
+        links files aren't parsed and no checkpoints are written in
+        the background, see `poplar.dataset.stream.Gate`.
     *positive_dataloaders : list of dataloaders
         List of torch dataloaders for interactions. TODO!
     *negative_dataloaders : list of dataloaders
@@ -50,12 +51,35 @@ def train(ppi_model, directory_dataloader,
         Learning rate of ADAM
     warmup_steps : int
         Number of warmup steps for scheduler
+    gradient_accumulation_steps : int
+        Number of batches before the gradients are applied.
+        Checkpoints are only saved after the gradients are applied.
     clip_norm : float
         Clipping norm of gradients
     summary_interval : int
         Number of steps before saving summary.
     checkpoint_interval : int
         Number of steps before saving checkpoint.
+    prefetch_depth : int
+        Number of links files that are parsed in the background,
+        while the model trains on the current one.
+    prefetch_memory : int
+        Maximum number of bytes of links files parsed ahead (optional).
+    keep_checkpoints : int
+        Number of checkpoints to keep. Checkpoints are written in the
+        background and leave out the frozen language model, but
+        hold the optimizer, scheduler and random number generator
+        states and the position in the training data.
+    resume : path
+        Checkpoint to resume from (optional). Training continues
+        from the links file and batch that it was saved at. The
+        batches of that links file that were already trained on
+        are loaded again, but skipped.
+    stream : bool
+        Stream the training links of all of the links files from disk
+        instead of parsing one links file at a time, see
+        `InteractionDataDirectory.stream`. There is no cross
+        validation on the test links when streaming.
     device : str
         Name of device to run (specifies gpu or not)
 
@@ -77,6 +101,7 @@ def train(ppi_model, directory_dataloader,
        `peptide`, `fold` and `bind`, with abstract classes to
        allow for plug and play architectures.
     """
+    from transformers import AdamW, WarmupLinearSchedule
     last_summary_time, last_checkpoint_time = time.time(), time.time()
 
     # Estimate running time
@@ -91,26 +116,77 @@ def train(ppi_model, directory_dataloader,
 
     # Initialize logging path
     writer = initialize_logging(logging_path=None)
+    saver = CheckpointWriter(model_path, keep=keep_checkpoints)
     it = 0  # number of steps (iterations)
+    start = {'epoch': 0, 'dataset': 0, 'batch': 0}
+    if resume is not None:
+        resumed = load_training_state(resume, ppi_model, optimizer, scheduler)
+        start = resumed['position']
+        it = start['it']
+        print(f'Resuming from epoch {start["epoch"]}, '
+              f'dataset {start["dataset"]}, batch {start["batch"]}')
     print('Number of pairs', num_data)
     print('Number datasets', len(directory_dataloader))
     print('Number of epochs', epochs)
     # converts sequences to peptide encodings
     encode_f = lambda x: torch.stack(list(map(encode, x)))
-    for e in range(epochs):
-        for k, dataloader in enumerate(directory_dataloader):
+    # proteins that appear more than once in a batch are only
+    # tracked when the negatives are shared across the batch
+    shared = getattr(ppi_model, 'module', ppi_model).loss == 'shared'
+    # the links files are parsed and the checkpoints are written in
+    # background threads, which are held back while workers are forked
+    gate = Gate() if directory_dataloader.num_workers > 0 else None
+    if stream:
+        stream_dataloader = directory_dataloader.stream()
+    for e in range(start['epoch'], epochs):
+        first = start['dataset'] if e == start['epoch'] else 0
+        if stream:
+            # all of the links files are a single dataset
+            stream_dataloader.dataset.set_epoch(e)
+            dataloaders = [(stream_dataloader, None, None)]
+        else:
+            directory_dataloader.set_epoch(e, first)
+            # the next links files are parsed while this one trains
+            dataloaders = prefetch(
+                directory_dataloader, depth=prefetch_depth,
+                max_bytes=prefetch_memory, nbytes=nbytes, gate=gate)
+        for k, dataloader in enumerate(dataloaders, first):
             ppi_model.train()
             train_dataloader, test_dataloader, valid_dataloader = dataloader
-            num_batches = len(train_dataloader)
             batch_size = train_dataloader.batch_size
 
-            print(f'dataset {k}, num_batches {num_batches}')
-            for j, (gene, pos, neg) in enumerate(train_dataloader):
+            if stream:
+                print(f'streaming {len(directory_dataloader)} links files')
+            else:
+                print(f'dataset {k}, num_batches {len(train_dataloader)}')
+            skip = 0
+            if resume is not None and (e, k) == (start['epoch'],
+                                                 start['dataset']):
+                # replay the shuffle of the interrupted links file
+                skip = start['batch']
+                set_rng_state(start['shard_rng'])
+            shard_rng = rng_state()
+            if gate is not None:
+                # the workers are forked once the background threads
+                # are idle, and the next links files are parsed after
+                saver.wait()
+            batches = enumerate(train_dataloader)
+            if gate is not None:
+                gate.open()
+            for _ in range(skip):
+                next(batches, None)
+            if skip > 0:
+                set_rng_state(resumed['rng'])
+            for j, (gene, pos, neg) in batches:
                 # TODO: Need to work on encoding gene, pos and neg
                 g = ppi_model.encode(gene)
                 p = ppi_model.encode(pos)
                 n = ppi_model.encode(neg)
-                loss = ppi_model.forward(g, p, n)
+                if shared:
+                    loss = ppi_model(g, p, n, peptide_ids(gene),
+                                     peptide_ids(pos))
+                else:
+                    loss = ppi_model.forward(g, p, n)
 
                 if torch.cuda.device_count() > 1:
                     loss = loss.mean()
@@ -132,11 +208,6 @@ def train(ppi_model, directory_dataloader,
                 if 'cuda' in device:
                     torch.cuda.empty_cache()
 
-                # checkpoint
-                last_checkpoint_time = checkpoint(
-                    ppi_model, logging_path, checkpoint_interval,
-                    last_checkpoint_time, writer)
-
                 # accumulate gradients - so that we do backprop after loss
                 # has been calculated on entire batch
                 if j % gradient_accumulation_steps == 0:
@@ -144,9 +215,23 @@ def train(ppi_model, directory_dataloader,
                     scheduler.step()
                     ppi_model.zero_grad()
 
+                    # checkpoint, which is written in the background.
+                    # Only right after an optimizer step, so that no
+                    # accumulated gradients are lost on resume.
+                    now = time.time()
+                    if (now - last_checkpoint_time) > checkpoint_interval:
+                        position = {'epoch': e, 'dataset': k,
+                                    'batch': j + 1, 'it': it,
+                                    'shard_rng': shard_rng}
+                        saver.save(training_state(ppi_model, optimizer,
+                                                  scheduler, position),
+                                   suffix=f'_epoch{e}_file{k}_batch{j + 1}')
+                        last_checkpoint_time = now
+
             # cross validation after each dataset is processed
-            tpr = pairwise_auc(ppi_model, test_dataloader,
-                               'Main/test', it, writer, device)
+            if test_dataloader is not None:
+                tpr = pairwise_auc(ppi_model, test_dataloader,
+                                   'Main/test', it, writer, device)
 
 
     # save hparams (TODO: hparams isn't importing correctly)
@@ -166,6 +251,7 @@ def train(ppi_model, directory_dataloader,
     #     }
     # )
 
+    saver.close()
     writer.close()
     return ppi_model
 
@@ -179,7 +265,12 @@ def ppi(fasta_file, training_directory,
         warmup_steps=1000, gradient_accumulation_steps=1,
         clip_norm=10, batch_size=10, num_workers=10,
         summary_interval=1, checkpoint_interval=1000,
-        device='cpu'):
+        embedding_path=None, cache_size=100000,
+        sampling='uniform', reject_positives=False, loss='sampled',
+        max_tokens=None, prefetch_depth=1, prefetch_memory=None,
+        peptide_encoder='roberta', encoder_dimension=128,
+        keep_checkpoints=3, resume=None, stream=False,
+        sequence_path=None, positive_path=None, device='cpu'):
     """ Train protein-protein interaction model
 
     Parameters
@@ -218,6 +309,55 @@ z        the evaluation of a protein pair.
         Number of protein triples to analyze in a given batch.
     summary_interval : int
         Number of seconds for a summary update.
+    embedding_path : path
+        Directory of precomputed embeddings (optional).
+        See `poplar.model.cache.EmbeddingStore`.
+    cache_size : int
+        Number of peptide embeddings to cache in memory.
+    sampling : str
+        Distribution of the negative samples, one of 'uniform',
+        'degree' or 'taxon'. See
+        `poplar.dataset.interactions.NegativeSampler`.
+    reject_positives : bool
+        Redraw negative samples that are known positives.
+    loss : str
+        'sampled' scores each protein against its own negative sample,
+        and 'shared' scores it against all of the negative samples and
+        other positives in the batch. See `poplar.model.PPIBinder`.
+    max_tokens : int
+        Maximum number of padded tokens per batch. If this is
+        specified, proteins of similar lengths are batched together
+        instead of using a fixed batch size, and the negatives are
+        passed through the language model in batches of at most
+        `max_tokens` padded tokens.
+    prefetch_depth : int
+        Number of links files that are parsed in the background,
+        while the model trains on the current one.
+    prefetch_memory : int
+        Maximum number of bytes of links files parsed ahead (optional).
+    peptide_encoder : str
+        'roberta' encodes peptides with the frozen pretrained model
+        in `checkpoint_path`. 'conv' trains a
+        `poplar.model.encoders.ConvEncoder` from scratch alongside the
+        interaction model, which is fast enough to run on a CPU.
+    encoder_dimension : int
+        Number of dimensions of the 'conv' encoder.
+    keep_checkpoints : int
+        Number of checkpoints to keep.
+    resume : path
+        Checkpoint to resume training from (optional).
+    stream : bool
+        Stream the training links from disk, instead of parsing one
+        links file at a time. Only uniform sampling can be streamed.
+    sequence_path : path
+        Directory of the on-disk sequence store (optional). It is
+        written on the first run and memory mapped afterwards, see
+        `poplar.dataset.sequences.read_sequences`.
+    positive_path : path
+        File of the index of known interactions used by
+        `reject_positives` (optional). It is written on the first run
+        and memory mapped afterwards, see
+        `poplar.dataset.positives.PositiveIndex`.
     device : str
         Name of device to run on.
 
@@ -233,16 +373,33 @@ z        the evaluation of a protein pair.
     # roberta = FairseqRobertaModel.from_pretrained(
     #     roberta_checkpoint_path, 'checkpoint_best.pt', data_dir)
 
-    pretrained_model = RobertaModel.from_pretrained(
-        checkpoint_path, 'checkpoint_best.pt', data_dir)
-    pretrained_model.to(device)
-    # the dimensionality of the roberta model
-    roberta_dim = int(list(list(pretrained_model.parameters())[-1].shape)[0])
-    # freeze the weights of the pre-trained model
-    for param in pretrained_model.parameters():
-        param.requires_grad = False
+    if peptide_encoder == 'conv':
+        encoder = ConvEncoder(hidden_size=encoder_dimension)
+        ppi_model = PPIBinder(encoder.hidden_size, emb_dimension, encoder,
+                              loss=loss, max_tokens=max_tokens)
+    elif peptide_encoder == 'roberta':
+        from fairseq.models.roberta import RobertaModel
+        pretrained_model = RobertaModel.from_pretrained(
+            checkpoint_path, 'checkpoint_best.pt', data_dir)
+        pretrained_model.to(device)
+        # the dimensionality of the roberta model
+        roberta_dim = int(
+            list(list(pretrained_model.parameters())[-1].shape)[0])
+        # freeze the weights of the pre-trained model
+        for param in pretrained_model.parameters():
+            param.requires_grad = False
+
+        # the pretrained model is frozen, so its embeddings can be cached
+        fingerprint = model_fingerprint(pretrained_model)
+        store = None
+        if embedding_path is not None:
+            store = EmbeddingStore(embedding_path, fingerprint)
+        cache = EmbeddingCache(fingerprint, capacity=cache_size, store=store)
 
-    ppi_model = PPIBinder(roberta_dim, emb_dimension, pretrained_model)
+        ppi_model = PPIBinder(roberta_dim, emb_dimension, pretrained_model,
+                              cache=cache, loss=loss, max_tokens=max_tokens)
+    else:
+        raise ValueError(f'Unknown peptide encoder {peptide_encoder}')
     ppi_model.to(device)
 
     n_gpu = torch.cuda.device_count()
@@ -254,10 +411,12 @@ z        the evaluation of a protein pair.
 
     batch_size = max(batch_size, batch_size * n_gpu)
     interaction_directory = InteractionDataDirectory(
-        fasta_file, training_directory, training_column,
-        batch_size, num_workers, 'cuda' in device
+        fasta_file, training_directory, training_column=training_column,
+        num_neg=num_neg, batch_size=batch_size, num_workers=num_workers,
+        arm_the_gpu='cuda' in device, sequence_path=sequence_path,
+        sampling=sampling, reject_positives=reject_positives,
+        positive_path=positive_path, max_tokens=max_tokens
     )
-    sampler = NegativeSampler(fasta_file)
 
     # TODO: add in positive and negative dataloaders
 
@@ -270,9 +429,11 @@ z        the evaluation of a protein pair.
         gradient_accumulation_steps=gradient_accumulation_steps,
         clip_norm=clip_norm, summary_interval=summary_interval,
         checkpoint_interval=checkpoint_interval,
-        model_path=model_path, device=device)
+        model_path=model_path, prefetch_depth=prefetch_depth,
+        prefetch_memory=prefetch_memory, keep_checkpoints=keep_checkpoints,
+        resume=resume, stream=stream, device=device)
 
-    # save the last model checkpoint
+    # save the last model checkpoint, without the frozen language model
     suffix = 'last'
     model_path_ = model_path + suffix
-    torch.save(finetuned_model.state_dict(), model_path_)
+    torch.save(trainable_state_dict(finetuned_model), model_path_)
@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+import unittest
+import torch
+from torch.utils.data import DataLoader
+from poplar.train.contact_ppi import contactmap_train, contact_loss
+from poplar.model.contactmap import ContactMapLinear
+from poplar.model.cache import EmbeddingCache
+from poplar.model.dummy import DummyModel
+from poplar.dataset.contacts import ContactMapStore, PackedContactMapDataset
+from poplar.util import dictionary
+
+
+class TestContactMapTraining(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.tmp = tempfile.mkdtemp()
+        directory = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 '../../dataset/tests/data')
+        store = ContactMapStore.from_directory(directory)
+        self.dataset = PackedContactMapDataset(store)
+        self.dataloader = DataLoader(self.dataset, batch_size=3,
+                                     collate_fn=self.dataset.collate)
+        self.peptide_model = DummyModel(len(dictionary) + 1, 8)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_contact_loss(self):
+        pred = torch.ones(1, 3, 3)
+        contacts = torch.zeros(1, 3, 3)
+        mask = torch.tensor([[True, True, False]])
+        # only the (1, 0) pair is scored
+        contacts[0, 1, 0] = 3
+        self.assertAlmostEqual(contact_loss(pred, contacts, mask).item(), 4)
+
+    def test_train(self):
+        model = ContactMapLinear(8, 2)
+        cache = EmbeddingCache('dummy')
+        before = model.P.detach().clone()
+        res = contactmap_train(
+            model, self.peptide_model, self.dataloader, cache=cache,
+            logging_path=os.path.join(self.tmp, 'logging'), epochs=2,
+            learning_rate=1e-2, warmup_steps=0,
+            model_path=os.path.join(self.tmp, 'model'))
+        self.assertFalse(torch.equal(before, res.P.detach()))
+        # the language model is only run once per protein
+        self.assertEqual(cache.misses, 7)
+        self.assertEqual(cache.hits, 7)
+        self.assertFalse(any(p.requires_grad
+                             for p in self.peptide_model.parameters()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+import os
+import sys
+import types
+import shutil
+import tempfile
+import unittest
+import torch
+from poplar.train.ppi import ppi, train
+from poplar.train.contact_ppi import warmup_linear_schedule
+from poplar.model.ppibinder import PPIBinder
+from poplar.model.encoders import ConvEncoder
+from poplar.dataset.interactions import InteractionDataDirectory
+from poplar.util import get_data_path
+
+
+def fake_transformers():
+    """ Stands in for transformers, which the training loop only
+    needs for its optimizer and learning rate schedule. """
+    module = types.ModuleType('transformers')
+    module.AdamW = torch.optim.AdamW
+    module.WarmupLinearSchedule = (
+        lambda optimizer, warmup_steps, t_total:
+        warmup_linear_schedule(optimizer, warmup_steps, t_total))
+    return module
+
+
+class TestResume(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        # train() writes its tensorboard logs to the working directory
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp)
+        self.fasta_file = get_data_path('prots.fa')
+        # 5 and 4 training batches
+        self.links_dir = get_data_path('links_files')
+        # only transformers is swapped, since restoring all of
+        # sys.modules would unload parts of torch
+        self.transformers = sys.modules.get('transformers')
+        sys.modules['transformers'] = fake_transformers()
+
+    def tearDown(self):
+        if self.transformers is None:
+            del sys.modules['transformers']
+        else:
+            sys.modules['transformers'] = self.transformers
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def run_train(self, name, resume=None, num_workers=0, **kwargs):
+        """ Trains on every batch of the links files once. """
+        torch.manual_seed(0)
+        model = PPIBinder(8, 4, ConvEncoder(hidden_size=8))
+        directory = InteractionDataDirectory(
+            self.fasta_file, self.links_dir, batch_size=10,
+            num_workers=num_workers)
+        path = os.path.join(self.tmp, name)
+        # checkpoint after every optimizer step
+        train(model, directory, max_steps=directory.total(),
+              learning_rate=1e-2, warmup_steps=0, summary_interval=1e9,
+              checkpoint_interval=-1, keep_checkpoints=100,
+              model_path=path, resume=resume, **kwargs)
+        return model, path
+
+    def assertModelEqual(self, res, exp):
+        for (name, a), b in zip(res.state_dict().items(),
+                                exp.state_dict().values()):
+            self.assertTrue(torch.equal(a, b), name)
+
+    def test_resume(self):
+        exp, path = self.run_train('full')
+        res, _ = self.run_train(
+            'resumed', resume=path + '_epoch0_file0_batch3')
+        self.assertModelEqual(res, exp)
+
+    def test_resume_next_file(self):
+        exp, path = self.run_train('full')
+        res, _ = self.run_train(
+            'resumed', resume=path + '_epoch0_file1_batch2')
+        self.assertModelEqual(res, exp)
+
+    def test_prefetch(self):
+        exp, _ = self.run_train('foreground', prefetch_depth=0)
+        res, _ = self.run_train('prefetched', prefetch_depth=2)
+        self.assertModelEqual(res, exp)
+        # a file is always let through if nothing else is held
+        res, _ = self.run_train('bounded', prefetch_depth=2,
+                                prefetch_memory=1)
+        self.assertModelEqual(res, exp)
+
+    def test_prefetch_workers(self):
+        # the workers are forked while the next links files aren't
+        # being parsed in the background
+        res, path = self.run_train('workers', prefetch_depth=2,
+                                   num_workers=2)
+        self.assertTrue(os.path.exists(path + '_epoch0_file0_batch5'))
+        self.assertTrue(os.path.exists(path + '_epoch0_file1_batch4'))
+
+    def test_prefetch_resume(self):
+        exp, path = self.run_train('full', prefetch_depth=2)
+        res, resumed = self.run_train(
+            'resumed', resume=path + '_epoch0_file1_batch2',
+            prefetch_depth=2, prefetch_memory=1)
+        self.assertModelEqual(res, exp)
+        # the links files are numbered from the one resumed from
+        self.assertFalse(os.path.exists(resumed + '_epoch0_file0_batch5'))
+        self.assertFalse(os.path.exists(resumed + '_epoch0_file1_batch2'))
+        self.assertTrue(os.path.exists(resumed + '_epoch0_file1_batch3'))
+        self.assertTrue(os.path.exists(resumed + '_epoch0_file1_batch4'))
+
+    def test_stream(self):
+        exp, path = self.run_train('full', stream=True)
+        # the links files are streamed as a single dataset
+        self.assertTrue(os.path.exists(path + '_epoch0_file0_batch9'))
+        self.assertFalse(os.path.exists(path + '_epoch0_file1_batch1'))
+        res, _ = self.run_train(
+            'resumed', resume=path + '_epoch0_file0_batch7', stream=True)
+        self.assertModelEqual(res, exp)
+
+    def test_ppi_stores(self):
+        sequence_path = os.path.join(self.tmp, 'sequences')
+        positive_path = os.path.join(self.tmp, 'positives.npy')
+        model_path = os.path.join(self.tmp, 'model')
+        ppi(self.fasta_file, self.links_dir, None, None, model_path, None,
+            emb_dimension=4, num_neg=1, max_steps=99, warmup_steps=0,
+            num_workers=0, reject_positives=True,
+            peptide_encoder='conv', encoder_dimension=8,
+            sequence_path=sequence_path, positive_path=positive_path)
+        self.assertTrue(os.path.exists(sequence_path))
+        self.assertTrue(os.path.exists(positive_path))
+        self.assertTrue(os.path.exists(model_path + 'last'))
+
+    def test_gradient_accumulation(self):
+        exp, path = self.run_train('full', gradient_accumulation_steps=2)
+        # only saved right after the gradients are applied
+        self.assertFalse(os.path.exists(path + '_epoch0_file0_batch2'))
+        self.assertTrue(os.path.exists(path + '_epoch0_file0_batch3'))
+        res, _ = self.run_train(
+            'resumed', resume=path + '_epoch0_file0_batch3',
+            gradient_accumulation_steps=2)
+        self.assertModelEqual(res, exp)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,5 @@
 import os
 import inspect
-import torch
 import numpy as np
 import numbers
 
@@ -97,27 +96,96 @@ dictionary = {
 }
 
 
+# padding token, which isn't used by the dictionary
+PAD = 0
+# unknown residues are treated as `X`
+UNKNOWN = dictionary['X']
+_lookup_tables = {}
+
+
+def lookup_table(unknown=UNKNOWN):
+    """ 256 entry byte -> token lookup table.
+
+    Parameters
+    ----------
+    unknown : int
+        Token for characters that aren't in the dictionary.
+    """
+    if unknown not in _lookup_tables:
+        table = np.full(256, unknown, dtype=np.uint8)
+        for k, v in dictionary.items():
+            table[ord(k)] = v
+            table[ord(k.lower())] = v
+        _lookup_tables[unknown] = table
+    return _lookup_tables[unknown]
+
+
+def to_tokens(x, unknown=UNKNOWN):
+    """ Convert a string to uint8 tokens.
+
+    Token arrays (i.e. from a SequenceStore) are returned as is.
+    """
+    if isinstance(x, np.ndarray):
+        return x
+    table = lookup_table(unknown)
+    return table[np.frombuffer(str(x).encode('ascii'), dtype=np.uint8)]
+
+
+def encode_batch(x, unknown=UNKNOWN, padding_idx=PAD):
+    """ Convert a batch of sequences to padded tokens.
+
+    Parameters
+    ----------
+    x : list of str or list of np.array
+        Sequences, or their uint8 tokens.
+    unknown : int
+        Token for residues that aren't in the dictionary.
+    padding_idx : int
+        Token used to pad sequences to the longest sequence.
+
+    Returns
+    -------
+    tokens : torch.LongTensor
+        Padded tokens of shape (batch, max length).
+    lengths : torch.LongTensor
+        Length of each sequence.
+    mask : torch.BoolTensor
+        Attention mask of shape (batch, max length), which is
+        True for residues and False for padding.
+    """
+    import torch
+    seqs = [to_tokens(s, unknown) for s in x]
+    lengths = np.array([len(s) for s in seqs], dtype=np.int64)
+    width = lengths.max() if len(lengths) > 0 else 0
+    mask = np.arange(width) < lengths[:, None]
+    tokens = np.full((len(seqs), width), padding_idx, dtype=np.int64)
+    if len(seqs) > 0:
+        tokens[mask] = np.concatenate(seqs)
+    return (torch.from_numpy(tokens), torch.from_numpy(lengths),
+            torch.from_numpy(mask))
+
+
 def encode(x):
     """ Convert string to tokens. """
-    tokens = list(map(lambda i: dictionary[i], list(x)))
-    tokens = torch.Tensor(tokens)
-    tokens = tokens.long()
-    return tokens
+    import torch
+    return torch.from_numpy(to_tokens(x).astype(np.int64))
 
 
 def tokenize(gene, pos, neg, model, device, pad=1024):
+    import torch
+    from poplar.model.ppibinder import cls_features
     if len(gene) == len(pos) and len(gene) == len(neg):
-        # extract features, and take <CLS> token
-        g = list(map(lambda x: model.extract_features(encode(x))[:, 0, :], gene))
-        p = list(map(lambda x: model.extract_features(encode(x))[:, 0, :], pos))
-        n = list(map(lambda x: model.extract_features(encode(x))[:, 0, :], neg))
-
-        g_ = torch.cat(g, 0)
-        p_ = torch.cat(p, 0)
-        n_ = torch.cat(n, 0)
+        seqs = [gene, pos, neg]
     else:
-        g_ = model.extract_features(encode(gene))[:, 0, :]
-        p_ = model.extract_features(encode(pos))[:, 0, :]
-        n_ = model.extract_features(encode(neg))[:, 0, :]
+        seqs = [[gene], [pos], [neg]]
 
+    res = []
+    for x in seqs:
+        tokens, lengths, _ = encode_batch(x)
+        tokens = tokens.to(device)
+        # extract features, and take <CLS> token
+        f = [cls_features(model, tokens[i, :n])
+             for i, n in enumerate(lengths.tolist())]
+        res.append(torch.cat(f, 0))
+    g_, p_, n_ = res
     return g_, p_, n_